@@ -1,3 +1,5 @@
+import hashlib
+import json
 import os
 import time
 
@@ -9,6 +11,11 @@ from keras.utils import plot_model
 
 from lib import metrics
 from lib import utils
+from lib.data_correction import data_correction_v3
+from lib.flow_selection import calculate_consecutive_loss, ConsecutiveLossTracker, masked_mae_per_flow, \
+    smallest_k_indices
+from lib.indicator import INDICATOR_DTYPE, to_indicator, save_indicator, load_indicator, find_indicator
+from lib.windowing import sliding_windows
 
 
 def _get_log_dir_lstm_based(kwargs):
@@ -65,12 +72,18 @@ def _get_log_dir_graph_based(kwargs):
 
 
 class AbstractModel(object):
+    # True for the supervisors whose test model has no randomness (no dropout or sampling at test time): only then
+    # are the test runs of a deterministic flow selection identical.
+    _deterministic_test_model = False
 
     def __init__(self, **kwargs):
         self._kwargs = kwargs
 
         self._alg = kwargs.get('alg')
-        self._data_kwargs = kwargs.get('data')
+        # Copy: the seed is part of the key of the prepared data sets (lib.utils._prepare_training_data), but it must
+        # not be added to the config saved with the model.
+        self._data_kwargs = dict(kwargs.get('data'))
+        self._data_kwargs.setdefault('seed', kwargs.get('seed'))
         self._train_kwargs = kwargs.get('train')
         self._test_kwargs = kwargs.get('test')
         self._model_kwargs = kwargs.get('model')
@@ -98,8 +111,20 @@ class AbstractModel(object):
         # Test's args
         self._flow_selection = self._test_kwargs.get('flow_selection')
         self._run_times = self._test_kwargs.get('run_times')
+        self._batched_runs = self._test_kwargs.get('batched_runs', False)
+        # Carry the rnn state over the test time-steps and feed only the newest row (approximates the re-encoding
+        # of the whole window). Only the test loops which never rewrite a row once it is encoded support it (DCRNN,
+        # DCLSTM): the fw/bw models correct the past rows of the window with the backward outputs.
+        self._stateful_inference = self._test_kwargs.get('stateful_inference', False)
+        # Every #stateful_check_every test time-steps, the window is also re-encoded and the largest absolute
+        # difference between the stateful and the windowed outputs is logged (0: no check)
+        self._stateful_check_every = int(self._test_kwargs.get('stateful_check_every', 0))
+        # Consecutive loss trackers of the measurement matrices of the current test runs
+        self._cl_trackers = {}
         # Data preparation
         self._day_size = self._data_kwargs.get('day_size')
+        # Number of batches prepared in background while the current step runs (0: no prefetching)
+        self._prefetch = int(self._data_kwargs.get('prefetch', 0))
 
     @staticmethod
     def _get_log_dir(kwargs):
@@ -141,7 +166,7 @@ class AbstractModel(object):
         np.save(self._log_dir + '/g_truth{}'.format(tag), g_truth)
         np.save(self._log_dir + '/pred_tm_{}'.format(tag), pred_tm)
         if self._flow_selection != 'Random':
-            np.save(self._log_dir + '/m_indicator{}'.format(tag), m_indicator)
+            save_indicator(self._log_dir + '/m_indicator{}'.format(tag), m_indicator)
 
     def plot_models(self, model, tag=None):
         if tag is None:
@@ -151,12 +176,14 @@ class AbstractModel(object):
         plot_model(model=model, to_file=self._log_dir + model_name, show_shapes=True)
 
     def _calculate_metrics(self, prediction_results, metrics_summary, scaler, runId, data_norm, n_metrics=4):
-        # y_preds:  a list of (batch_size, horizon, num_nodes, output_dim)
+        # y_preds: shape(#time-steps, horizon, num_nodes), or a list of (batch_size, horizon, num_nodes)
         y_preds = prediction_results['y_preds']
-        y_preds = np.concatenate(y_preds, axis=0)
+        if isinstance(y_preds, list):
+            y_preds = np.concatenate(y_preds, axis=0)
 
         y_truths = prediction_results['y_truths']
-        y_truths = np.concatenate(y_truths, axis=0)
+        if isinstance(y_truths, list):
+            y_truths = np.concatenate(y_truths, axis=0)
         predictions = []
 
         for horizon_i in range(self._horizon):
@@ -211,11 +238,46 @@ class AbstractModel(object):
         results_summary['er'] = metrics_summary[:, -1]
         results_summary.to_csv(self._log_dir + 'results_summary.csv', index=False)
 
-    def _prepare_input_dcrnn(self, data, m_indicator):
-        x = np.zeros(shape=(self._seq_len, self._nodes, self._input_dim), dtype='float32')
-        x[:, :, 0] = data
-        x[:, :, 1] = m_indicator
-        return np.expand_dims(x, axis=0)
+    def _prepare_input_dcrnn(self, data, m_indicator, out=None):
+        """
+
+        :param data: shape(#seq_len, #nflows)
+        :param m_indicator: shape(#seq_len, #nflows)
+        :param out: buffer of shape(1, #seq_len, #nflows, #input_dim) reused over the time-steps (default: a new array).
+        :return: x: shape(1, #seq_len, #nflows, #input_dim)
+        """
+        x = np.zeros(shape=(1, self._seq_len, self._nodes, self._input_dim), dtype='float32') if out is None else out
+        x[0, :, :, 0] = data
+        x[0, :, :, 1] = m_indicator
+        return x
+
+    def _prepare_step_input_dcrnn(self, data, m_indicator, out=None):
+        """
+
+        :param data: the newest row of the traffic matrix, shape(#nflows)
+        :param m_indicator: shape(#nflows)
+        :param out: buffer of shape(1, #nflows, #input_dim) reused over the time-steps (default: a new array).
+        :return: x: shape(1, #nflows, #input_dim)
+        """
+        x = np.zeros(shape=(1, self._nodes, self._input_dim), dtype='float32') if out is None else out
+        x[0, :, 0] = data
+        x[0, :, 1] = m_indicator
+        return x
+
+    def _prepare_input_dcrnn_batch(self, data, m_indicator, out=None):
+        """
+
+        :param data: shape(#batch, #seq_len, #nflows)
+        :param m_indicator: shape(#batch, #seq_len, #nflows)
+        :param out: buffer of shape(#batch, #seq_len, #nflows, #input_dim) reused over the time-steps.
+        :return: x: shape(#batch, #seq_len, #nflows, #input_dim)
+        """
+        x = out
+        if x is None:
+            x = np.zeros(shape=(data.shape[0], self._seq_len, self._nodes, self._input_dim), dtype='float32')
+        x[..., 0] = data
+        x[..., 1] = m_indicator
+        return x
 
     def _prepare_input_lstm(self, data, m_indicator):
 
@@ -230,58 +292,179 @@ class AbstractModel(object):
         return dataX
 
     def _init_data_test(self, test_data_norm, runId):
+        self._cl_trackers = {}
+
         tm_pred = np.zeros(shape=(test_data_norm.shape[0] - self._horizon, self._nodes), dtype='float32')
         tm_pred[0:self._seq_len] = test_data_norm[:self._seq_len]
 
         # Initialize measurement matrix
         if self._flow_selection == 'Random':
-            save_m_indicator = os.path.join(self._base_dir + '/random_m_indicator_{}_{}_{}/'.format(
-                self._seq_len, self._horizon, self._mon_ratio))
-            if not os.path.isfile(os.path.join(save_m_indicator + '/m_indicator{}.npy'.format(runId))):
+            m_indicator_file = self._random_m_indicator_file(runId)
+            if not os.path.isfile(m_indicator_file):
                 m_indicator = np.random.choice([1.0, 0.0],
                                                size=(test_data_norm.shape[0] - self._horizon -
                                                      self._seq_len, test_data_norm.shape[1]),
                                                p=(self._mon_ratio, 1.0 - self._mon_ratio))
-                if not os.path.isdir(save_m_indicator):
-                    os.makedirs(save_m_indicator)
-                np.save(save_m_indicator + '/m_indicator{}.npy'.format(runId), m_indicator)
+                m_indicator = to_indicator(m_indicator)
+                if not os.path.isdir(os.path.dirname(m_indicator_file)):
+                    os.makedirs(os.path.dirname(m_indicator_file))
+                save_indicator(m_indicator_file, m_indicator)
             else:
-                m_indicator = np.load(os.path.join(save_m_indicator + '/m_indicator{}.npy'.format(runId)))
+                m_indicator = load_indicator(m_indicator_file)
 
-            m_indicator = np.concatenate([np.ones(shape=(self._seq_len, self._nodes)), m_indicator], axis=0)
+            m_indicator = np.concatenate([np.ones(shape=(self._seq_len, self._nodes), dtype=INDICATOR_DTYPE),
+                                          m_indicator], axis=0)
         else:
             m_indicator = np.zeros(shape=(test_data_norm.shape[0] - self._horizon, self._nodes),
-                                   dtype='float32')
-            m_indicator[0:self._seq_len] = np.ones(shape=(self._seq_len, self._nodes))
+                                   dtype=INDICATOR_DTYPE)
+            m_indicator[0:self._seq_len] = 1
 
         return tm_pred, m_indicator
 
-    @staticmethod
-    def _calculate_consecutive_loss(m_indicator):
+    def _init_results_test(self, test_data_norm, n_runs=None):
+        """
+        Preallocated outputs of a test run and its ground truth.
+        :param test_data_norm:
+        :param n_runs: number of runs predicted together (None: a single run).
+        :return: y_preds: shape([#n_runs,] #time-steps, #horizon, #nflows), filled by the prediction loop;
+                 y_truths: shape(#time-steps, #horizon, #nflows), read-only strided view of test_data_norm.
+        """
+        n_steps = test_data_norm.shape[0] - self._horizon - self._seq_len
+        shape = (n_steps, self._horizon, self._nodes)
+        y_preds = np.zeros(shape=shape if n_runs is None else (n_runs,) + shape, dtype='float32')
+        y_truths = sliding_windows(test_data_norm[self._seq_len:], self._horizon, n_windows=n_steps)
+        return y_preds, y_truths
 
-        consecutive_losses = []
-        for flow_id in range(m_indicator.shape[1]):
-            flows_labels = m_indicator[:, flow_id]
-            if flows_labels[-1] == 1:
-                consecutive_losses.append(1)
-            else:
-                measured_idx = np.argwhere(flows_labels == 1)
-                if measured_idx.size == 0:
-                    consecutive_losses.append(m_indicator.shape[0])
-                else:
-                    consecutive_losses.append(m_indicator.shape[0] - measured_idx[-1][0])
+    def _random_m_indicator_file(self, runId):
+        """
+        Saved measurement matrix of a run with the 'Random' flow selection: the bit-packed .npz file (or the .npy
+        file saved by the previous versions).
+        """
+        save_m_indicator = os.path.join(self._base_dir + '/random_m_indicator_{}_{}_{}/'.format(
+            self._seq_len, self._horizon, self._mon_ratio))
+        m_indicator_file = os.path.join(save_m_indicator + '/m_indicator{}'.format(runId))
+        return find_indicator(m_indicator_file) or m_indicator_file + '.npz'
+
+    def _deterministic_runs(self):
+        """
+        Only the 'Random' flow selection draws a different measurement matrix in each test run; with the other
+        policies all the runs of test() are identical, unless the test model itself is random (e.g. dropout kept at
+        test time).
+        """
+        return self._deterministic_test_model and self._flow_selection != 'Random'
+
+    def _test_results_cache_file(self, runId):
+        """
+        File of the cached prediction results of a test run, keyed by the hash of the checkpoint, of the data
+        preparation and of the test configuration (None when test.cache_results is off or the checkpoint cannot be
+        identified).
+        """
+        model_filename = self._train_kwargs.get('model_filename')
+        if not self._test_kwargs.get('cache_results', False) or model_filename is None:
+            return None
+        checkpoint = [f for f in [model_filename, model_filename + '.index'] if os.path.isfile(f)]
+        if not checkpoint:
+            return None
+
+        m_indicator_file = self._random_m_indicator_file(runId)
+        params = {
+            'alg': self._alg,
+            'checkpoint': [os.path.abspath(checkpoint[0]), os.path.getmtime(checkpoint[0])],
+            'data_name': self._data_kwargs.get('data_name'),
+            # Inputs of the data preparation (the normalized test set depends on them)
+            'data': {k: self._data_kwargs.get(k) for k in ('day_size', 'data_size', 'seed')},
+            'scaler': self._kwargs.get('scaler'),
+            'mon_ratio': self._mon_ratio,
+            'model': self._model_kwargs,
+            'test': {k: v for k, v in self._test_kwargs.items() if k not in ('run_times', 'cache_results')},
+            'runId': runId,
+            'm_indicator': os.path.getmtime(m_indicator_file) if self._flow_selection == 'Random' and
+                                                                 os.path.isfile(m_indicator_file) else None
+        }
+        key = hashlib.sha1(json.dumps(params, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+        return os.path.join(self._base_dir, 'test_cache', key + '.npz')
+
+    def _cached_test_results(self, runId, run_tm_prediction):
+        cache_file = self._test_results_cache_file(runId)
+        if cache_file is not None and os.path.isfile(cache_file):
+            self._logger.info('|--- Load the results of run {}: {}'.format(runId, cache_file))
+            with np.load(cache_file) as cached:
+                list_keys = set(cached['list_keys'])
+                return {k: [cached[k]] if k in list_keys else cached[k] for k in cached.files if k != 'list_keys'}
+
+        results = run_tm_prediction(runId)
+
+        cache_file = self._test_results_cache_file(runId)
+        if cache_file is not None:
+            if not os.path.isdir(os.path.dirname(cache_file)):
+                os.makedirs(os.path.dirname(cache_file))
+            list_keys = [k for k, v in results.items() if isinstance(v, list)]
+            np.savez(cache_file, list_keys=np.array(list_keys),
+                     **{k: np.concatenate(v, axis=0) if k in list_keys else v for k, v in results.items()})
+        return results
+
+    def _test_runs(self, run_tm_prediction, metrics_summary, data_norm):
+        """
+        Run the #run_times test runs and fill their rows of metrics_summary. With a deterministic flow selection,
+        only the first run is executed and its metrics are copied to the other rows.
+        :param run_tm_prediction: function(runId) returning the prediction results of a run.
+        :param metrics_summary:
+        :param data_norm: the normalized test set.
+        :return: metrics_summary
+        """
+        n_runs = 1 if self._deterministic_runs() else self._run_times
+        for i in range(n_runs):
+            self._logger.info('|--- Run time: {}'.format(i))
 
-        consecutive_losses = np.asarray(consecutive_losses)
-        return consecutive_losses
+            test_results = self._cached_test_results(i, run_tm_prediction)
 
-    def _set_measured_flow_fairness(self, m_indicator):
+            metrics_summary = self._calculate_metrics(prediction_results=test_results, metrics_summary=metrics_summary,
+                                                      scaler=self._data['scaler'],
+                                                      runId=i, data_norm=data_norm)
+
+        if n_runs < self._run_times:
+            self._logger.info('|--- {} flow selection is deterministic: the results of run 0 are used for the {} '
+                              'runs'.format(self._flow_selection, self._run_times))
+            metrics_summary[n_runs:self._run_times] = metrics_summary[0]
+        return metrics_summary
+
+    @staticmethod
+    def _calculate_consecutive_loss(m_indicator):
+        return calculate_consecutive_loss(m_indicator)
+
+    def _tracked_consecutive_loss(self, time_slot, m_indicator):
+        """
+        Consecutive loss of the window m_indicator[time_slot: time_slot + seq_len], updated incrementally from the
+        tracker of this measurement matrix when the window only slid by one time-step since the last call.
+        :param time_slot:
+        :param m_indicator: the full measurement matrix of a run.
+        :return: shape(#nflows)
+        """
+        end = time_slot + self._seq_len
+        # A run is identified by its measurement matrix (which is filled in place). The matrix is kept with its
+        # tracker, so that its id cannot be reused by another array while the tracker exists.
+        tracked_m_indicator, tracker = self._cl_trackers.get(id(m_indicator), (None, None))
+        if tracked_m_indicator is not m_indicator:
+            tracker = None
+        if tracker is not None and tracker.end == end - 1:
+            tracker.update(m_indicator[end - 1])
+        elif tracker is None or tracker.end != end:
+            tracker = ConsecutiveLossTracker(m_indicator[time_slot:end], end=end)
+            self._cl_trackers[id(m_indicator)] = (m_indicator, tracker)
+
+        return tracker.consecutive_losses
+
+    def _set_measured_flow_fairness(self, m_indicator, cl=None):
         """
 
         :param m_indicator: shape(#seq_len, #nflows)
+        :param cl: consecutive loss of each flow (computed from m_indicator if not given)
         :return:
         """
 
-        cl = self._calculate_consecutive_loss(m_indicator).astype(float)
+        if cl is None:
+            cl = self._calculate_consecutive_loss(m_indicator)
+        cl = cl.astype(float)
 
         w = 1 / cl
 
@@ -294,54 +477,47 @@ class AbstractModel(object):
 
         return sampling
 
-    def _calculate_flows_weights(self, fw_losses, m_indicator, lamda):
+    def _calculate_flows_weights(self, fw_losses, m_indicator, lamda, cl=None):
         """
 
         :param fw_losses: shape(#n_flows)
         :param m_indicator: shape(#seq_len, #nflows)
+        :param cl: consecutive loss of each flow (computed from m_indicator if not given)
         :return: w: flow_weight shape(#n_flows)
         """
 
-        cl = self._calculate_consecutive_loss(m_indicator)
+        if cl is None:
+            cl = self._calculate_consecutive_loss(m_indicator)
 
         w = 1 / (fw_losses * lamda[0] +
                  cl * lamda[1])
 
         return w
 
-    def _set_measured_flow(self, rnn_input, pred_forward, m_indicator, lamda):
+    def _set_measured_flow(self, rnn_input, pred_forward, m_indicator, lamda, cl=None):
         """
 
         :param rnn_input: shape(#seq_len, #nflows)
         :param pred_forward: shape(#seq_len, #nflows)
         :param m_indicator: shape(#seq_len, #nflows)
+        :param cl: consecutive loss of each flow (computed from m_indicator if not given)
         :return:
         """
 
-        n_flows = rnn_input.shape[0]
+        n_flows = rnn_input.shape[1]
 
-        fw_losses = []
-        for flow_id in range(m_indicator.shape[1]):
-            idx_fw = m_indicator[1:, flow_id]
-
-            # fw_losses.append(error_ratio(y_true=rnn_input[1:, flow_id][idx_fw == 1.0],
-            #                              y_pred=pred_forward[:-1, flow_id][idx_fw == 1.0],
-            #                              measured_matrix=np.zeros(idx_fw[idx_fw == 1.0].shape)))
-            fw_losses.append(metrics.masked_mae_np(preds=pred_forward[:-1, flow_id][idx_fw == 1.0],
-                                                   labels=rnn_input[1:, flow_id][idx_fw == 1.0]))
-
-        fw_losses = np.array(fw_losses)
+        # MAE of the forward prediction of each flow over its measured time-steps
+        fw_losses = masked_mae_per_flow(preds=pred_forward[:-1], labels=rnn_input[1:], m_indicator=m_indicator[1:])
         fw_losses[fw_losses == 0.] = np.max(fw_losses)
 
         w = self._calculate_flows_weights(fw_losses=fw_losses,
-                                          m_indicator=m_indicator, lamda=lamda)
+                                          m_indicator=m_indicator, lamda=lamda, cl=cl)
 
         sampling = np.zeros(shape=n_flows)
         m = int(self._mon_ratio * n_flows)
 
         w = w.flatten()
-        sorted_idx_w = np.argsort(w)
-        sampling[sorted_idx_w[:m]] = 1
+        sampling[smallest_k_indices(w, m)] = 1
 
         return sampling
 
@@ -349,51 +525,22 @@ class AbstractModel(object):
         if self._flow_selection == 'Random':
             sampling = m_indicator[time_slot + self._seq_len]
         elif self._flow_selection == 'Fairness':
-            sampling = self._set_measured_flow_fairness(m_indicator=m_indicator[time_slot: time_slot + self._seq_len])
+            sampling = self._set_measured_flow_fairness(m_indicator=m_indicator[time_slot: time_slot + self._seq_len],
+                                                        cl=self._tracked_consecutive_loss(time_slot, m_indicator))
             m_indicator[time_slot + self._seq_len] = sampling
         else:
             sampling = self._set_measured_flow(rnn_input=tm_pred[time_slot: time_slot + self._seq_len],
                                                pred_forward=fw_outputs,
-                                               m_indicator=m_indicator[time_slot: time_slot + self._seq_len].T,
-                                               lamda=lamda)
+                                               m_indicator=m_indicator[time_slot: time_slot + self._seq_len],
+                                               lamda=lamda,
+                                               cl=self._tracked_consecutive_loss(time_slot, m_indicator))
             m_indicator[time_slot + self._seq_len] = sampling
 
         return sampling
 
     def _data_correction_v3(self, rnn_input, pred_backward, labels, r):
-        # Shape = (#n_flows, #time-steps)
-        _rnn_input = np.copy(rnn_input.T)
-        _labels = np.copy(labels.T)
-
-        beta = np.zeros(_rnn_input.shape)
-
-        corrected_range = int(self._seq_len / r)
-
-        for i in range(_rnn_input.shape[1] - corrected_range):
-            mu = np.sum(_labels[:, i + 1:i + corrected_range + 1], axis=1) / corrected_range
-
-            h = np.arange(1, corrected_range + 1)
-
-            rho = (1 / (np.log(corrected_range) + 1)) * np.sum(
-                _labels[:, i + 1:i + corrected_range + 1] / h, axis=1)
-
-            beta[:, i] = mu * rho
-
-        considered_backward = pred_backward[:, 1:]
-        considered_rnn_input = _rnn_input[:, 0:-1]
-
-        beta[beta > 0.5] = 0.5
-
-        alpha = 1.0 - beta
-
-        alpha = alpha[:, 0:-1]
-        beta = beta[:, 0:-1]
-        # gamma = gamma[:, 1:-1]
-
-        # corrected_data = considered_rnn_input * alpha + considered_rnn_input * beta + considered_backward * gamma
-        corrected_data = considered_rnn_input * alpha + considered_backward * beta
-
-        return corrected_data.T
+        return data_correction_v3(rnn_input=rnn_input, pred_backward=pred_backward, labels=labels,
+                                  corrected_range=int(self._seq_len / r))
 
     def _calculate_pred_err(self, pred, tm, m_indicator, beta=0.1):
         """
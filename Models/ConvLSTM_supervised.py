@@ -12,6 +12,8 @@ from keras.utils import plot_model
 from tqdm import tqdm
 
 from lib import utils, metrics
+from lib.flow_selection import calculate_consecutive_loss
+from lib.indicator import save_indicator
 
 
 class TimeHistory(keras_callbacks.Callback):
@@ -232,21 +234,7 @@ class ConvLSTM():
 
     @staticmethod
     def _calculate_consecutive_loss(m_indicator):
-
-        consecutive_losses = []
-        for flow_id in range(m_indicator.shape[1]):
-            flows_labels = m_indicator[:, flow_id]
-            if flows_labels[-1] == 1:
-                consecutive_losses.append(1)
-            else:
-                measured_idx = np.argwhere(flows_labels == 1)
-                if measured_idx.size == 0:
-                    consecutive_losses.append(m_indicator.shape[0])
-                else:
-                    consecutive_losses.append(m_indicator.shape[0] - measured_idx[-1][0])
-
-        consecutive_losses = np.asarray(consecutive_losses)
-        return consecutive_losses
+        return calculate_consecutive_loss(m_indicator)
 
     def _set_measured_flow_fairness(self, m_indicator):
 
@@ -388,7 +376,7 @@ class ConvLSTM():
     def _save_results(self, g_truth, pred_tm, m_indicator, tag):
         np.save(self._log_dir + '/g_truth{}'.format(tag), g_truth)
         np.save(self._log_dir + '/pred_tm_{}'.format(tag), pred_tm)
-        np.save(self._log_dir + '/m_indicator{}'.format(tag), m_indicator)
+        save_indicator(self._log_dir + '/m_indicator{}'.format(tag), m_indicator)
 
     def plot_models(self):
         plot_model(model=self.model, to_file=self._log_dir + '/model.png', show_shapes=True)
@@ -2,7 +2,6 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
-import numpy as np
 import tensorflow as tf
 from tensorflow.contrib.rnn import RNNCell
 
@@ -40,27 +39,9 @@ class DCLSTMCell(RNNCell):
         self._num_proj = num_proj
         self._num_units = num_units
         self._max_diffusion_step = max_diffusion_step
-        self._supports = []
         self._use_gc_for_ru = use_gc_for_ru
-        supports = []
-        if filter_type == "laplacian":
-            supports.append(utils.calculate_scaled_laplacian(adj_mx, lambda_max=None))
-        elif filter_type == "random_walk":
-            supports.append(utils.calculate_random_walk_matrix(adj_mx).T)
-        elif filter_type == "dual_random_walk":
-            supports.append(utils.calculate_random_walk_matrix(adj_mx).T)
-            supports.append(utils.calculate_random_walk_matrix(adj_mx.T).T)
-        else:
-            supports.append(utils.calculate_scaled_laplacian(adj_mx))
-        for support in supports:
-            self._supports.append(self._build_sparse_matrix(support))
-
-    @staticmethod
-    def _build_sparse_matrix(L):
-        L = L.tocoo()
-        indices = np.column_stack((L.row, L.col))
-        L = tf.SparseTensor(indices, L.data, L.shape)
-        return tf.sparse_reorder(L)
+        # Cached: shared by all the cells using the same adjacency matrix
+        self._supports = utils.build_sparse_supports(adj_mx, filter_type)
 
     @property
     def state_size(self):
@@ -112,11 +93,17 @@ class DCLSTMCell(RNNCell):
             if self._num_proj is not None:
                 with tf.variable_scope("projection"):
                     w = tf.get_variable('w', shape=(self._num_units, self._num_proj))
-                    batch_size = inputs.get_shape()[0].value
                     output = tf.reshape(output, shape=(-1, self._num_units))
-                    output = tf.reshape(tf.matmul(output, w), shape=(batch_size, self.output_size))
+                    output = tf.reshape(tf.matmul(output, w), shape=(-1, self.output_size))
         return output, state
 
+    def _node_dim(self, x):
+        """
+        :param x: (B, num_nodes * dim)
+        :return: dim
+        """
+        return x.get_shape()[-1].value // self._num_nodes
+
     @staticmethod
     def _concat(x, x_):
         x_ = tf.expand_dims(x_, 0)
@@ -124,9 +111,9 @@ class DCLSTMCell(RNNCell):
 
     def _fc(self, inputs, state, output_size, bias_start=0.0):
         dtype = inputs.dtype
-        batch_size = inputs.get_shape()[0].value
-        inputs = tf.reshape(inputs, (batch_size * self._num_nodes, -1))
-        state = tf.reshape(state, (batch_size * self._num_nodes, -1))
+        batch_size = tf.shape(inputs)[0]
+        inputs = tf.reshape(inputs, (batch_size * self._num_nodes, self._node_dim(inputs)))
+        state = tf.reshape(state, (batch_size * self._num_nodes, self._node_dim(state)))
         inputs_and_state = tf.concat([inputs, state], axis=-1)
         input_size = inputs_and_state.get_shape()[-1].value
         weights = tf.get_variable(
@@ -149,9 +136,10 @@ class DCLSTMCell(RNNCell):
         :return:
         """
         # Reshape input and state to (batch_size, num_nodes, input_dim/state_dim)
-        batch_size = inputs.get_shape()[0].value
-        inputs = tf.reshape(inputs, (batch_size, self._num_nodes, -1))
-        state = tf.reshape(state, (batch_size, self._num_nodes, -1))
+        # The batch dimension may be dynamic (None): only the per-node dims are read from the static shapes.
+        batch_size = tf.shape(inputs)[0]
+        inputs = tf.reshape(inputs, (batch_size, self._num_nodes, self._node_dim(inputs)))
+        state = tf.reshape(state, (batch_size, self._num_nodes, self._node_dim(state)))
         inputs_and_state = tf.concat([inputs, state], axis=2)
         input_size = inputs_and_state.get_shape()[2].value
         dtype = inputs.dtype
@@ -6,10 +6,11 @@ import tensorflow as tf
 from tensorflow.contrib import legacy_seq2seq
 
 from Models.dclstm.dclstm_cell import DCLSTMCell
+from lib import utils
 
 
 class DCLSTMModel(object):
-    def __init__(self, is_training, batch_size, scaler, adj_mx, **model_kwargs):
+    def __init__(self, is_training, batch_size, scaler, adj_mx, stateful=False, **model_kwargs):
         # Scaler for data normalization.
         self._scaler = scaler
 
@@ -30,6 +31,8 @@ class DCLSTMModel(object):
         use_curriculum_learning = bool(model_kwargs.get('use_curriculum_learning', False))
         input_dim = int(model_kwargs.get('input_dim', 1))
         output_dim = int(model_kwargs.get('output_dim', 1))
+        # 'static' (unrolled) or 'dynamic' (tf.while_loop) encoder
+        encoder_type = model_kwargs.get('encoder', 'static')
 
         # Input (batch_size, timesteps, num_sensor, input_dim)
         self._inputs = tf.placeholder(tf.float32, shape=(batch_size, seq_len, num_nodes, input_dim), name='inputs')
@@ -37,7 +40,8 @@ class DCLSTMModel(object):
         self._labels = tf.placeholder(tf.float32, shape=(batch_size, horizon, num_nodes, 1), name='labels')
 
         # GO_SYMBOL = tf.zeros(shape=(batch_size, num_nodes * input_dim))
-        GO_SYMBOL = tf.zeros(shape=(batch_size, num_nodes * output_dim))
+        # batch_size may be None: one graph serves every batch size.
+        GO_SYMBOL = tf.zeros(shape=(tf.shape(self._inputs)[0], num_nodes * output_dim))
 
         cell = DCLSTMCell(rnn_units, adj_mx, max_diffusion_step=max_diffusion_step, num_nodes=num_nodes,
                           filter_type=filter_type)
@@ -52,10 +56,10 @@ class DCLSTMModel(object):
         global_step = tf.train.get_or_create_global_step()
         # Outputs: (batch_size, timesteps, num_nodes, output_dim)
         with tf.variable_scope('DCLSTM_SEQ'):
-            inputs = tf.unstack(tf.reshape(self._inputs, (batch_size, seq_len, num_nodes * input_dim)), axis=1)
+            inputs = tf.unstack(tf.reshape(self._inputs, (-1, seq_len, num_nodes * input_dim)), axis=1)
             # inputs = tf.reshape(self._inputs, (batch_size, seq_len, num_nodes * input_dim))
             labels = tf.unstack(
-                tf.reshape(self._labels[..., :output_dim], (batch_size, horizon, num_nodes * output_dim)), axis=1)
+                tf.reshape(self._labels[..., :output_dim], (-1, horizon, num_nodes * output_dim)), axis=1)
             labels.insert(0, GO_SYMBOL)
 
             def _loop_function(prev, i):
@@ -72,7 +76,7 @@ class DCLSTMModel(object):
                     result = prev
                 return result
 
-            _, enc_state = tf.contrib.rnn.static_rnn(encoding_cells, inputs, dtype=tf.float32)
+            _, enc_state = utils.rnn_encoder(encoding_cells, inputs, encoder_type=encoder_type)
 
             # encoder_layers = RNN(encoding_cells, return_state=True, return_sequences=True)
             # _, enc_state = encoder_layers(inputs)
@@ -81,7 +85,28 @@ class DCLSTMModel(object):
 
         # Project the output to output_dim.
         outputs = tf.stack(outputs[:-1], axis=1)
-        self._outputs = tf.reshape(outputs, (batch_size, horizon, num_nodes, output_dim), name='outputs')
+        self._outputs = tf.reshape(outputs, (-1, horizon, num_nodes, output_dim), name='outputs')
+        self._final_states = enc_state
+
+        # Single step of the encoder (sharing the variables) for the stateful inference: feed the newest time-step
+        # and the encoder states of the previous step, then decode from the new states.
+        self._step_inputs, self._init_states = None, None
+        self._step_outputs, self._step_states = None, None
+        if stateful:
+            self._step_inputs = tf.placeholder(tf.float32, shape=(batch_size, num_nodes, input_dim),
+                                               name='step_inputs')
+            self._init_states = tuple(tf.placeholder(tf.float32, shape=(batch_size, cell.state_size),
+                                                     name='init_state_{}'.format(i))
+                                      for i in range(num_rnn_layers))
+            step_go = tf.zeros(shape=(tf.shape(self._step_inputs)[0], num_nodes * output_dim))
+            with tf.variable_scope('DCLSTM_SEQ', reuse=True):
+                _, self._step_states = encoding_cells(
+                    tf.reshape(self._step_inputs, (-1, num_nodes * input_dim)), self._init_states)
+                step_outputs, _ = legacy_seq2seq.rnn_decoder([step_go] * (horizon + 1), self._step_states,
+                                                             decoding_cells, loop_function=_loop_function)
+            step_outputs = tf.stack(step_outputs[:-1], axis=1)
+            self._step_outputs = tf.reshape(step_outputs, (-1, horizon, num_nodes, output_dim),
+                                            name='step_outputs')
         self._merged = tf.summary.merge_all()
 
     @staticmethod
@@ -117,3 +142,23 @@ class DCLSTMModel(object):
     @property
     def outputs(self):
         return self._outputs
+
+    @property
+    def final_states(self):
+        return self._final_states
+
+    @property
+    def step_inputs(self):
+        return self._step_inputs
+
+    @property
+    def init_states(self):
+        return self._init_states
+
+    @property
+    def step_outputs(self):
+        return self._step_outputs
+
+    @property
+    def step_states(self):
+        return self._step_states
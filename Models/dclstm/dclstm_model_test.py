@@ -0,0 +1,50 @@
+import unittest
+
+import numpy as np
+import tensorflow as tf
+
+from Models.dclstm.dclstm_model import DCLSTMModel
+
+
+class StatefulInferenceTestCase(unittest.TestCase):
+    def setUp(self):
+        np.random.seed(0)
+        self.seq_len = 4
+        self.model_kwargs = dict(max_diffusion_step=2, filter_type='dual_random_walk', horizon=2, num_nodes=6,
+                                 num_rnn_layers=2, rnn_units=8, seq_len=self.seq_len, input_dim=2, output_dim=1,
+                                 use_curriculum_learning=True)
+        self.adj_mx = (np.random.rand(6, 6) > 0.5).astype('float32')
+
+    def _build(self, stateful):
+        # Same layout as DCLSTMSupervisor: the test model reuses the variables of the training model.
+        graph = tf.Graph()
+        with graph.as_default():
+            with tf.name_scope('Train'), tf.variable_scope('DCLSTM', reuse=False):
+                DCLSTMModel(is_training=True, batch_size=3, scaler=None, adj_mx=self.adj_mx, **self.model_kwargs)
+            with tf.name_scope('Test'), tf.variable_scope('DCLSTM', reuse=True):
+                model = DCLSTMModel(is_training=False, batch_size=None, scaler=None, adj_mx=self.adj_mx,
+                                    stateful=stateful, **self.model_kwargs)
+            var_names = sorted(v.name for v in tf.global_variables())
+        return graph, model, var_names
+
+    def test_step_graph_creates_no_variables(self):
+        _, _, var_names = self._build(stateful=False)
+        _, _, stateful_var_names = self._build(stateful=True)
+        self.assertEqual(var_names, stateful_var_names)
+
+    def test_steps_from_zero_states_match_the_window(self):
+        graph, model, _ = self._build(stateful=True)
+        x = np.random.rand(1, self.seq_len, 6, 2).astype('float32')
+        with graph.as_default(), tf.Session() as sess:
+            sess.run(tf.global_variables_initializer())
+            outputs = sess.run(model.outputs, feed_dict={model.inputs: x})
+            states = [np.zeros((1, int(s.shape[1])), dtype='float32') for s in model.init_states]
+            for t in range(self.seq_len):
+                feed_dict = {model.step_inputs: x[:, t]}
+                feed_dict.update(zip(model.init_states, states))
+                step_outputs, states = sess.run([model.step_outputs, model.step_states], feed_dict=feed_dict)
+        np.testing.assert_allclose(step_outputs, outputs, atol=1e-6)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -23,6 +23,8 @@ class DCLSTMSupervisor(AbstractModel):
     """
     Do experiments using Graph Random Walk RNN model.
     """
+    # No dropout at test time.
+    _deterministic_test_model = True
 
     def __init__(self, is_training=False, **kwargs):
         super(DCLSTMSupervisor, self).__init__(**kwargs)
@@ -46,23 +48,16 @@ class DCLSTMSupervisor(AbstractModel):
                                                 batch_size=self._data_kwargs['batch_size'],
                                                 adj_mx=self._data['adj_mx'], **self._model_kwargs)
 
-        with tf.name_scope('Val'):
-            with tf.variable_scope('DCLSTM', reuse=True):
-                self._val_model = DCLSTMModel(is_training=False, scaler=scaler,
-                                              batch_size=self._data_kwargs['val_batch_size'],
-                                              adj_mx=self._data['adj_mx'], **self._model_kwargs)
-
-        with tf.name_scope('Eval'):
-            with tf.variable_scope('DCLSTM', reuse=True):
-                self._eval_model = DCLSTMModel(is_training=False, scaler=scaler,
-                                               batch_size=self._data_kwargs['eval_batch_size'],
-                                               adj_mx=self._data['adj_mx'], **self._model_kwargs)
-
+        # A single inference graph (dynamic batch dimension) is shared by the validation, evaluation and test.
         with tf.name_scope('Test'):
             with tf.variable_scope('DCLSTM', reuse=True):
                 self._test_model = DCLSTMModel(is_training=False, scaler=scaler,
-                                               batch_size=self._data_kwargs['test_batch_size'],
-                                               adj_mx=self._data['adj_mx'], **self._model_kwargs)
+                                               batch_size=None,
+                                               adj_mx=self._data['adj_mx'],
+                                               stateful=self._stateful_inference,
+                                               **self._model_kwargs)
+        self._val_model = self._test_model
+        self._eval_model = self._test_model
 
         # Learning rate.
         self._lr = tf.get_variable('learning_rate', shape=(), initializer=tf.constant_initializer(0.01),
@@ -132,6 +127,7 @@ class DCLSTMSupervisor(AbstractModel):
                 'outputs': model.outputs
             })
 
+        data_generator = utils.prefetch_iterator(data_generator, self._prefetch)
         for _, (x, y) in enumerate(data_generator):
 
             feed_dict = {
@@ -171,12 +167,14 @@ class DCLSTMSupervisor(AbstractModel):
 
     def _run_tm_prediction(self, sess, model, runId, writer=None):
 
-        test_data_norm = self._data['test_data_norm']
+        test_data_norm = self._data['test_set']
 
         # Initialize traffic matrix data
         tm_pred, m_indicator = self._init_data_test(test_data_norm, runId)
 
-        y_preds = []
+        y_preds, y_truths = self._init_results_test(test_data_norm)
+        inputs = np.zeros(shape=(1, self._seq_len, self._nodes, self._input_dim), dtype='float32')
+        step_inputs = np.zeros(shape=(1, self._nodes, self._input_dim), dtype='float32')
         fetches = {
             'global_step': tf.train.get_or_create_global_step()
         }
@@ -185,24 +183,53 @@ class DCLSTMSupervisor(AbstractModel):
             'outputs': model.outputs
         })
 
-        y_truths = []
+        stateful = model.step_inputs is not None
+        if stateful:
+            fetches['states'] = model.final_states
+            step_fetches = {
+                'global_step': tf.train.get_or_create_global_step(),
+                'outputs': model.step_outputs,
+                'states': model.step_states
+            }
+        states = None
+        # Largest absolute differences between the stateful and the windowed outputs at the checked time-steps
+        stateful_errors = []
 
         for ts in tqdm(range(test_data_norm.shape[0] - self._horizon - self._seq_len)):
 
-            x = self._prepare_input_dcrnn(
-                data=tm_pred[ts:ts + self._seq_len],
-                m_indicator=m_indicator[ts:ts + self._seq_len]
-            )
-
-            y_truths.append(
-                np.expand_dims(test_data_norm[ts + self._seq_len:ts + self._seq_len + self._horizon].copy(), axis=0))
-
-            feed_dict = {
-                model.inputs: x,
-            }
-
-            vals = sess.run(fetches, feed_dict=feed_dict)
-            y_preds.append(np.squeeze(vals['outputs'], axis=-1))
+            if stateful and ts > 0:
+                # Only the newest time-step of the window is encoded.
+                x = self._prepare_step_input_dcrnn(
+                    data=tm_pred[ts + self._seq_len - 1],
+                    m_indicator=m_indicator[ts + self._seq_len - 1],
+                    out=step_inputs
+                )
+                feed_dict = {
+                    model.step_inputs: x,
+                }
+                feed_dict.update(zip(model.init_states, states))
+                vals = sess.run(step_fetches, feed_dict=feed_dict)
+
+                if self._stateful_check_every > 0 and ts % self._stateful_check_every == 0:
+                    x = self._prepare_input_dcrnn(
+                        data=tm_pred[ts:ts + self._seq_len],
+                        m_indicator=m_indicator[ts:ts + self._seq_len],
+                        out=inputs
+                    )
+                    windowed_outputs = sess.run(model.outputs, feed_dict={model.inputs: x})
+                    stateful_errors.append(np.max(np.abs(vals['outputs'] - windowed_outputs)))
+            else:
+                x = self._prepare_input_dcrnn(
+                    data=tm_pred[ts:ts + self._seq_len],
+                    m_indicator=m_indicator[ts:ts + self._seq_len],
+                    out=inputs
+                )
+                feed_dict = {
+                    model.inputs: x,
+                }
+                vals = sess.run(fetches, feed_dict=feed_dict)
+            states = vals.get('states')
+            y_preds[ts] = vals['outputs'][0, :, :, 0]
 
             if writer is not None and 'merged' in vals:
                 writer.add_summary(vals['merged'], global_step=vals['global_step'])
@@ -221,6 +248,12 @@ class DCLSTMSupervisor(AbstractModel):
             # Concatenating new_input into current rnn_input
             tm_pred[ts + self._seq_len] = new_input
 
+        if stateful_errors:
+            self._logger.info('|--- Stateful inference: max |stateful - windowed| output difference: {:.6f} '
+                              '(mean {:.6f}) over {} checked time-steps'.format(np.max(stateful_errors),
+                                                                                np.mean(stateful_errors),
+                                                                                len(stateful_errors)))
+
         results = {'y_preds': y_preds,
                    'tm_pred': tm_pred[self._seq_len:],
                    'm_indicator': m_indicator[self._seq_len:],
@@ -322,15 +355,9 @@ class DCLSTMSupervisor(AbstractModel):
         # Metrics: MSE, MAE, RMSE, MAPE, ER
         metrics_summary = np.zeros(shape=(self._run_times + 3, self._horizon * n_metrics + 1))
 
-        for i in range(self._run_times):
-            self._logger.info('|--- Run time: {}'.format(i))
-            # y_test = self._prepare_test_set()
-
-            test_results = self._run_tm_prediction(sess, model=self._test_model, runId=i)
-
-            metrics_summary = self._calculate_metrics(prediction_results=test_results, metrics_summary=metrics_summary,
-                                                      scaler=self._data['scaler'],
-                                                      runId=i, data_norm=self._data['test_data_norm'])
+        metrics_summary = self._test_runs(
+            lambda runId: self._run_tm_prediction(sess, model=self._test_model, runId=runId),
+            metrics_summary=metrics_summary, data_norm=self._data['test_set'])
 
         self._summarize_results(metrics_summary=metrics_summary, n_metrics=n_metrics)
 
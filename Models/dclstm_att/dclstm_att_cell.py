@@ -2,47 +2,43 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
-import numpy as np
 import tensorflow as tf
 from tensorflow.contrib.rnn import RNNCell
 
 from lib import utils
 
 
-def attn_head(seq, out_sz, bias_mat, activation, in_drop=0.0, coef_drop=0.0, residual=False):
+def sp_attn_head(seq, out_sz, edges, nb_nodes, in_drop=0.0, coef_drop=0.0):
     """
-
-    :param seq: inputs
+    Attention coefficients computed on the edges of the graph only (softmax over the edges of each row), for any
+    batch size.
+    :param seq: inputs (batch_size, nb_nodes, input_dim)
     :param out_sz: output's size
-    :param bias_mat: bias matrix
-    :param activation: activation_fn
+    :param edges: (rows, cols) of the edges (see utils.adj_to_edges)
+    :param nb_nodes: number of nodes
     :param in_drop: input_drop
     :param coef_drop:
-    :param residual:
-    :return:
+    :return: the coefficients (num_edges, batch_size)
     """
-    with tf.name_scope('my_attn'):
+    with tf.name_scope('sp_attn'):
         if in_drop != 0.0:
             seq = tf.nn.dropout(seq, 1.0 - in_drop)
 
         seq_fts = tf.layers.conv1d(seq, out_sz, 1, use_bias=False)
 
-        # print('seq_fts shape: ', seq_fts.shape)
-
         # simplest self-attention possible
         f_1 = tf.layers.conv1d(seq_fts, 1, 1)
         f_2 = tf.layers.conv1d(seq_fts, 1, 1)
 
-        # print('f_1 shape: ', f_1.shape)
-        # print('f_2 shape: ', tf.transpose(f_2, [0, 2, 1]).shape)
+        # (nb_nodes, batch_size)
+        f_1 = tf.transpose(tf.squeeze(f_1, axis=-1))
+        f_2 = tf.transpose(tf.squeeze(f_2, axis=-1))
 
-        logits = f_1 + tf.transpose(f_2, [0, 2, 1])
-        # print('logits shape: ', logits.shape)
+        rows, cols = edges
+        logits = tf.gather(f_1, rows) + tf.gather(f_2, cols)
 
         # alpha_ij
-        coefs = tf.nn.softmax(tf.nn.leaky_relu(logits) + bias_mat)
-
-        # print('coefs shape: ', coefs.shape)
+        coefs = utils.edge_softmax(tf.nn.leaky_relu(logits), rows, nb_nodes)
 
         if coef_drop != 0.0:
             coefs = tf.nn.dropout(coefs, 1.0 - coef_drop)
@@ -81,34 +77,10 @@ class DCLSTMCellAtt(RNNCell):
         self._num_proj = num_proj
         self._num_units = num_units
         self._max_diffusion_step = max_diffusion_step
-        self._supports = []
         self._use_gc_for_ru = use_gc_for_ru
-        supports = []
-        if filter_type == "laplacian":
-            supports.append(utils.calculate_scaled_laplacian(adj_mx, lambda_max=None))
-        elif filter_type == "random_walk":
-            supports.append(utils.calculate_random_walk_matrix(adj_mx).T)
-        elif filter_type == "dual_random_walk":
-            supports.append(utils.calculate_random_walk_matrix(adj_mx).T)
-            supports.append(utils.calculate_random_walk_matrix(adj_mx.T).T)
-        else:
-            supports.append(utils.calculate_scaled_laplacian(adj_mx))
-        for support in supports:
-            self._supports.append(self._build_sparse_matrix(support))
-
-        self._bias_mt = tf.convert_to_tensor(utils.adj_to_bias(np.expand_dims(adj_mx, axis=0),
-                                                               [self._num_nodes], nhood=1), dtype=tf.float32)
-        _adj_mx = tf.convert_to_tensor(adj_mx)
-        self._adj_mx_repeat = tf.tile(tf.expand_dims(_adj_mx, axis=0), [batch_size, 1, 1])
-        for support in self._supports:
-            self._supports_dense.append(tf.sparse.to_dense(support))
-
-    @staticmethod
-    def _build_sparse_matrix(L):
-        L = L.tocoo()
-        indices = np.column_stack((L.row, L.col))
-        L = tf.SparseTensor(indices, L.data, L.shape)
-        return tf.sparse_reorder(L)
+        # The attention is only computed on the edges of the graph (and the self-loops).
+        self._edges = utils.adj_to_edges(adj_mx)
+        self._support_edges = utils.support_edges(adj_mx, filter_type, self._edges)
 
     @property
     def state_size(self):
@@ -165,11 +137,6 @@ class DCLSTMCellAtt(RNNCell):
                     output = tf.reshape(tf.matmul(output, w), shape=(batch_size, self.output_size))
         return output, state
 
-    @staticmethod
-    def _concat(x, x_):
-        x_ = tf.expand_dims(x_, 0)
-        return tf.concat([x, x_], axis=0)
-
     def _fc(self, inputs, state, output_size, bias_start=0.0):
         dtype = inputs.dtype
         batch_size = inputs.get_shape()[0].value
@@ -199,42 +166,38 @@ class DCLSTMCellAtt(RNNCell):
         batch_size = inputs.get_shape()[0].value
         inputs = tf.reshape(inputs, (batch_size, self._num_nodes, -1))
 
-        _att_weights = attn_head(inputs, bias_mat=self._bias_mt, out_sz=1, activation=tf.nn.elu,
-                                 in_drop=0.5, coef_drop=0.5, residual=False)
+        # (num_edges, batch_size)
+        _att_weights = sp_attn_head(inputs, out_sz=1, edges=self._edges, nb_nodes=self._num_nodes,
+                                    in_drop=0.5, coef_drop=0.5)
 
         state = tf.reshape(state, (batch_size, self._num_nodes, -1))
         inputs_and_state = tf.concat([inputs, state], axis=2)
         input_size = inputs_and_state.get_shape()[2].value
         dtype = inputs.dtype
 
-        xb = inputs_and_state
-
-        num_matrices = len(self._supports) * self._max_diffusion_step + 1  # Adds for x itself.
+        x0 = tf.transpose(inputs_and_state, perm=[1, 0, 2])  # (num_nodes, batch_size, input_size)
+        xk = [x0]  # results of diffusion process on each input x
 
-        x = tf.zeros(shape=(0, num_matrices, self._num_nodes, input_size))
+        num_matrices = len(self._support_edges) * self._max_diffusion_step + 1  # Adds for x itself.
 
         scope = tf.get_variable_scope()
         with tf.variable_scope(scope):
-            for batch_idx in range(batch_size):
-                x0 = xb[batch_idx]  # (num_node, arg_size)
-                xk = tf.expand_dims(x0, axis=0)  # results of diffusion process on each input x (1, num_node, arg_size)
-                if self._max_diffusion_step == 0:
-                    pass
-                else:
-                    for support_dense in self._supports_dense:
-                        # pw (num_nodes, num_nodes)
-                        pw = _att_weights[batch_idx] * support_dense
-                        x1 = tf.matmul(pw, x0)  # (num_node, arg_size)
-                        xk = self._concat(xk, x1)
-
-                        for k in range(2, self._max_diffusion_step + 1):
-                            x2 = 2 * tf.matmul(pw, x1) - x0
-                            xk = self._concat(xk, x2)
-                            x1, x0 = x2, x1
-
-                x = self._concat(x, xk)
-
-            x = tf.transpose(x, perm=[0, 2, 3, 1])  # shape (batch, nodes, size, nsupport)
+            if self._max_diffusion_step == 0:
+                pass
+            else:
+                for support_idx, rows, cols, values in self._support_edges:
+                    # pw (num_edges, batch_size): the support weighted by the attention of each batch element
+                    pw = tf.gather(_att_weights, support_idx) * values
+                    x1 = utils.edge_matmul(pw, rows, cols, x0, self._num_nodes)
+                    xk.append(x1)
+
+                    for k in range(2, self._max_diffusion_step + 1):
+                        x2 = 2 * utils.edge_matmul(pw, rows, cols, x1, self._num_nodes) - x0
+                        xk.append(x2)
+                        x1, x0 = x2, x1
+
+            x = tf.stack(xk, axis=-1)  # shape (nodes, batch, size, nsupport)
+            x = tf.transpose(x, perm=[1, 0, 2, 3])  # shape (batch, nodes, size, nsupport)
             x = tf.reshape(x, shape=[batch_size * self._num_nodes, input_size * num_matrices])
 
             weights = tf.get_variable(
@@ -6,6 +6,7 @@ import tensorflow as tf
 from tensorflow.contrib import legacy_seq2seq
 
 from Models.dclstm_att.dclstm_att_cell import DCLSTMCellAtt
+from lib import utils
 
 
 class DCLSTMAttModel(object):
@@ -30,6 +31,8 @@ class DCLSTMAttModel(object):
         use_curriculum_learning = bool(model_kwargs.get('use_curriculum_learning', False))
         input_dim = int(model_kwargs.get('input_dim', 1))
         output_dim = int(model_kwargs.get('output_dim', 1))
+        # 'static' (unrolled) or 'dynamic' (tf.while_loop) encoder
+        encoder_type = model_kwargs.get('encoder', 'static')
 
         # Input (batch_size, timesteps, num_sensor, input_dim)
         self._inputs = tf.placeholder(tf.float32, shape=(batch_size, seq_len, num_nodes, input_dim), name='inputs')
@@ -73,7 +76,7 @@ class DCLSTMAttModel(object):
                     result = prev
                 return result
 
-            _, enc_state = tf.contrib.rnn.static_rnn(encoding_cells, inputs, dtype=tf.float32)
+            _, enc_state = utils.rnn_encoder(encoding_cells, inputs, encoder_type=encoder_type)
 
             # encoder_layers = RNN(encoding_cells, return_state=True, return_sequences=True)
             # _, enc_state = encoder_layers(inputs)
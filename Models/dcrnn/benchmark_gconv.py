@@ -0,0 +1,72 @@
+import argparse
+import time
+
+import numpy as np
+import tensorflow as tf
+
+from lib import utils
+
+# The adjacency matrices written by lib.utils.adj_mx_contruction ('<adj_method>-<pos_thres>.npy' next to the data
+# set), e.g. for dataset_dir: Dataset/Abilene2d.npy and pos_thres: 0.7:
+# python -m Models.dcrnn.benchmark_gconv --adj_mx Dataset/OD-0.7.npy Dataset/SD-0.7.npy
+
+
+def _time_op(sess, op, n_runs):
+    # Run the op without fetching its output (the copy to numpy is not part of the diffusion).
+    sess.run(op.op)
+    start = time.time()
+    for _ in range(n_runs):
+        sess.run(op.op)
+    return (time.time() - start) / n_runs * 1000
+
+
+def benchmark(adj_mx, filter_type, n_columns, n_runs):
+    """
+    Time of the diffusion step (support x (num_nodes, batch_size * input_size)) with a sparse and a dense support.
+    :return: a list of (density, sparse time (ms), dense time (ms)), one per support.
+    """
+    results = []
+    for support in utils.calculate_supports(adj_mx, filter_type):
+        tf.reset_default_graph()
+        # A variable, not a constant: with constant operands the products are folded when the graph is optimized.
+        x = tf.Variable(np.random.rand(support.shape[0], n_columns), dtype=tf.float32)
+        sparse_op = tf.sparse_tensor_dense_matmul(utils.build_sparse_matrix(support), x)
+        dense_op = tf.matmul(tf.constant(support.toarray(), dtype=tf.float32), x)
+        with tf.Session() as sess:
+            sess.run(x.initializer)
+            results.append((utils.support_density(support),
+                            _time_op(sess, sparse_op, n_runs),
+                            _time_op(sess, dense_op, n_runs)))
+    return results
+
+
+def random_adj_mx(num_nodes, density):
+    adj_mx = (np.random.rand(num_nodes, num_nodes) < density).astype('float32')
+    np.fill_diagonal(adj_mx, 1.0)
+    return adj_mx
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--adj_mx', nargs='*', default=[], help='Adjacency matrices (.npy) of the topologies.')
+    parser.add_argument('--num_nodes', nargs='*', type=int, default=[144, 529],
+                        help='Number of nodes of the random graphs (when no adj_mx is given).')
+    parser.add_argument('--densities', nargs='*', type=float, default=[0.01, 0.02, 0.05, 0.1, 0.2, 0.5],
+                        help='Densities of the random graphs.')
+    parser.add_argument('--filter_type', default='dual_random_walk', type=str)
+    parser.add_argument('--n_columns', default=64 * 66, type=int, help='batch_size * (input_dim + rnn_units)')
+    parser.add_argument('--n_runs', default=100, type=int)
+    args = parser.parse_args()
+
+    # float32, as in the data loaders (lib.utils.load_dataset_dcrnn).
+    topologies = [(path, np.load(path).astype('float32')) for path in args.adj_mx]
+    if not topologies:
+        for num_nodes in args.num_nodes:
+            for density in args.densities:
+                topologies.append(('random_{}_{}'.format(num_nodes, density), random_adj_mx(num_nodes, density)))
+
+    print('topology\tdensity\tsparse (ms)\tdense (ms)')
+    for name, adj_mx in topologies:
+        for density, sparse_time, dense_time in benchmark(adj_mx, args.filter_type, args.n_columns, args.n_runs):
+            print('{}\t{:.4f}\t{:.3f}\t{:.3f}{}'.format(name, density, sparse_time, dense_time,
+                                                       '\t*' if dense_time < sparse_time else ''))
@@ -2,12 +2,16 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
-import numpy as np
 import tensorflow as tf
 from tensorflow.contrib.rnn import RNNCell
 
 from lib import utils
 
+# Default of the model's dense_support_threshold: supports at least this dense use a dense matmul in the diffusion.
+# Crossover measured with Models/dcrnn/benchmark_gconv.py (TF 1.15 CPU, batch_size 64): ~0.07 for 144 and 529 nodes;
+# Abilene OD (density 0.083) and SD (0.160) are faster dense, Geant OD (0.044) sparse.
+DENSE_SUPPORT_THRESHOLD = 0.07
+
 
 class DCGRUCell(RNNCell):
     """Graph Convolution Gated Recurrent Unit cell.
@@ -20,7 +24,8 @@ class DCGRUCell(RNNCell):
         pass
 
     def __init__(self, num_units, adj_mx, max_diffusion_step, num_nodes, num_proj=None,
-                 activation=tf.nn.tanh, reuse=None, filter_type="laplacian", use_gc_for_ru=True):
+                 activation=tf.nn.tanh, reuse=None, filter_type="laplacian", use_gc_for_ru=True,
+                 dense_threshold=DENSE_SUPPORT_THRESHOLD):
         """
 
         :param num_units:
@@ -33,6 +38,7 @@ class DCGRUCell(RNNCell):
         :param reuse:
         :param filter_type: "laplacian", "random_walk", "dual_random_walk".
         :param use_gc_for_ru: whether to use Graph convolution to calculate the reset and update gates.
+        :param dense_threshold: the supports with a density >= dense_threshold are dense (None: always sparse).
         """
         super(DCGRUCell, self).__init__(_reuse=reuse)
         self._activation = activation
@@ -40,27 +46,9 @@ class DCGRUCell(RNNCell):
         self._num_proj = num_proj
         self._num_units = num_units
         self._max_diffusion_step = max_diffusion_step
-        self._supports = []
         self._use_gc_for_ru = use_gc_for_ru
-        supports = []
-        if filter_type == "laplacian":
-            supports.append(utils.calculate_scaled_laplacian(adj_mx, lambda_max=None))
-        elif filter_type == "random_walk":
-            supports.append(utils.calculate_random_walk_matrix(adj_mx).T)
-        elif filter_type == "dual_random_walk":
-            supports.append(utils.calculate_random_walk_matrix(adj_mx).T)
-            supports.append(utils.calculate_random_walk_matrix(adj_mx.T).T)
-        else:
-            supports.append(utils.calculate_scaled_laplacian(adj_mx))
-        for support in supports:
-            self._supports.append(self._build_sparse_matrix(support))
-
-    @staticmethod
-    def _build_sparse_matrix(L):
-        L = L.tocoo()
-        indices = np.column_stack((L.row, L.col))
-        L = tf.SparseTensor(indices, L.data, L.shape)
-        return tf.sparse_reorder(L)
+        # Cached: shared by all the cells using the same adjacency matrix
+        self._supports = utils.build_supports(adj_mx, filter_type, dense_threshold=dense_threshold)
 
     @property
     def state_size(self):
@@ -104,21 +92,22 @@ class DCGRUCell(RNNCell):
                 with tf.variable_scope("projection"):
                     w = tf.get_variable('w', shape=(self._num_units, self._num_proj),
                                         initializer=tf.contrib.layers.xavier_initializer())
-                    batch_size = inputs.get_shape()[0].value
                     output = tf.reshape(new_state, shape=(-1, self._num_units))
-                    output = tf.reshape(tf.matmul(output, w), shape=(batch_size, self.output_size))
+                    output = tf.reshape(tf.matmul(output, w), shape=(-1, self.output_size))
         return output, new_state
 
-    @staticmethod
-    def _concat(x, x_):
-        x_ = tf.expand_dims(x_, 0)
-        return tf.concat([x, x_], axis=0)
+    def _node_dim(self, x):
+        """
+        :param x: (B, num_nodes * dim)
+        :return: dim
+        """
+        return x.get_shape()[-1].value // self._num_nodes
 
     def _fc(self, inputs, state, output_size, bias_start=0.0):
         dtype = inputs.dtype
-        batch_size = inputs.get_shape()[0].value
-        inputs = tf.reshape(inputs, (batch_size * self._num_nodes, -1))
-        state = tf.reshape(state, (batch_size * self._num_nodes, -1))
+        batch_size = tf.shape(inputs)[0]
+        inputs = tf.reshape(inputs, (batch_size * self._num_nodes, self._node_dim(inputs)))
+        state = tf.reshape(state, (batch_size * self._num_nodes, self._node_dim(state)))
         inputs_and_state = tf.concat([inputs, state], axis=-1)
         input_size = inputs_and_state.get_shape()[-1].value
         weights = tf.get_variable(
@@ -130,6 +119,12 @@ class DCGRUCell(RNNCell):
         value = tf.nn.bias_add(value, biases)
         return value
 
+    @staticmethod
+    def _diffuse(support, x):
+        if isinstance(support, tf.SparseTensor):
+            return tf.sparse_tensor_dense_matmul(support, x)
+        return tf.matmul(support, x)
+
     def _gconv(self, inputs, state, output_size, bias_start=0.0):
         """Graph convolution between input and the graph matrix.
 
@@ -141,17 +136,17 @@ class DCGRUCell(RNNCell):
         :return:
         """
         # Reshape input and state to (batch_size, num_nodes, input_dim/state_dim)
-        batch_size = inputs.get_shape()[0].value
-        inputs = tf.reshape(inputs, (batch_size, self._num_nodes, -1))
-        state = tf.reshape(state, (batch_size, self._num_nodes, -1))
+        # The batch dimension may be dynamic (None): only the per-node dims are read from the static shapes.
+        batch_size = tf.shape(inputs)[0]
+        inputs = tf.reshape(inputs, (batch_size, self._num_nodes, self._node_dim(inputs)))
+        state = tf.reshape(state, (batch_size, self._num_nodes, self._node_dim(state)))
         inputs_and_state = tf.concat([inputs, state], axis=2)
         input_size = inputs_and_state.get_shape()[2].value
         dtype = inputs.dtype
 
-        x = inputs_and_state
-        x0 = tf.transpose(x, perm=[1, 2, 0])  # (num_nodes, total_arg_size, batch_size)
-        x0 = tf.reshape(x0, shape=[self._num_nodes, input_size * batch_size])
-        x = tf.expand_dims(x0, axis=0)
+        x0 = tf.transpose(inputs_and_state, perm=[1, 0, 2])  # (num_nodes, batch_size, total_arg_size)
+        x0 = tf.reshape(x0, shape=[self._num_nodes, -1])
+        xs = [x0]
 
         scope = tf.get_variable_scope()
         with tf.variable_scope(scope):
@@ -159,26 +154,28 @@ class DCGRUCell(RNNCell):
                 pass
             else:
                 for support in self._supports:
-                    x1 = tf.sparse_tensor_dense_matmul(support, x0)
-                    x = self._concat(x, x1)
+                    x1 = self._diffuse(support, x0)
+                    xs.append(x1)
 
                     for k in range(2, self._max_diffusion_step + 1):
-                        x2 = 2 * tf.sparse_tensor_dense_matmul(support, x1) - x0
-                        x = self._concat(x, x2)
+                        x2 = 2 * self._diffuse(support, x1) - x0
+                        xs.append(x2)
                         x1, x0 = x2, x1
 
             num_matrices = len(self._supports) * self._max_diffusion_step + 1  # Adds for x itself.
-            x = tf.reshape(x, shape=[num_matrices, self._num_nodes, input_size, batch_size])
-            x = tf.transpose(x, perm=[3, 1, 2, 0])  # (batch_size, num_nodes, input_size, order)
-            x = tf.reshape(x, shape=[batch_size * self._num_nodes, input_size * num_matrices])
+            # All the orders are stacked last: (num_nodes, batch_size * input_size, order), i.e. the rows are
+            # (node, batch) and the features (input_size, order), the layout of the weights.
+            x = tf.stack(xs, axis=-1)
+            x = tf.reshape(x, shape=[-1, input_size * num_matrices])
 
             weights = tf.get_variable(
                 'weights', [input_size * num_matrices, output_size], dtype=dtype,
                 initializer=tf.contrib.layers.xavier_initializer())
-            x = tf.matmul(x, weights)  # (batch_size * self._num_nodes, output_size)
+            x = tf.matmul(x, weights)  # (self._num_nodes * batch_size, output_size)
 
             biases = tf.get_variable("biases", [output_size], dtype=dtype,
                                      initializer=tf.constant_initializer(bias_start, dtype=dtype))
             x = tf.nn.bias_add(x, biases)
-        # Reshape res back to 2D: (batch_size, num_node, state_dim) -> (batch_size, num_node * state_dim)
+        # Back to (batch_size, num_node * output_size): only the output is transposed.
+        x = tf.transpose(tf.reshape(x, [self._num_nodes, -1, output_size]), perm=[1, 0, 2])
         return tf.reshape(x, [batch_size, self._num_nodes * output_size])
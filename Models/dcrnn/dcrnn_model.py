@@ -4,14 +4,15 @@ from __future__ import print_function
 
 import tensorflow as tf
 
-from Models.dcrnn.dcrnn_cell import DCGRUCell
+from Models.dcrnn.dcrnn_cell import DCGRUCell, DENSE_SUPPORT_THRESHOLD
+from lib import utils
 
 
 # from tensorflow.contrib import legacy_seq2seq
 
 
 class DCRNNModel(object):
-    def __init__(self, batch_size, scaler, adj_mx, **model_kwargs):
+    def __init__(self, batch_size, scaler, adj_mx, stateful=False, **model_kwargs):
         # Scaler for data normalization.
         self._scaler = scaler
 
@@ -29,6 +30,10 @@ class DCRNNModel(object):
         seq_len = int(model_kwargs.get('seq_len'))
         input_dim = int(model_kwargs.get('input_dim', 1))
         output_dim = int(model_kwargs.get('output_dim', 1))
+        # 'static' (unrolled) or 'dynamic' (tf.while_loop) encoder
+        encoder_type = model_kwargs.get('encoder', 'static')
+        # Supports at least this dense use a dense matmul in the diffusion (null: always sparse)
+        dense_threshold = model_kwargs.get('dense_support_threshold', DENSE_SUPPORT_THRESHOLD)
 
         # Input (batch_size, timesteps, num_sensor, input_dim)
         self._inputs = tf.placeholder(tf.float32, shape=(batch_size, seq_len, num_nodes, input_dim), name='inputs')
@@ -36,21 +41,37 @@ class DCRNNModel(object):
         self._labels = tf.placeholder(tf.float32, shape=(batch_size, horizon, num_nodes, 1), name='labels')
 
         cell = DCGRUCell(rnn_units, adj_mx, max_diffusion_step=max_diffusion_step, num_nodes=num_nodes,
-                         filter_type=filter_type)
+                         filter_type=filter_type, dense_threshold=dense_threshold)
         cell_with_projection = DCGRUCell(rnn_units, adj_mx, max_diffusion_step=max_diffusion_step, num_nodes=num_nodes,
-                                         num_proj=output_dim, filter_type=filter_type)
+                                         num_proj=output_dim, filter_type=filter_type, dense_threshold=dense_threshold)
 
         encoding_cells = [cell] * (num_rnn_layers - 1) + [cell_with_projection]
         encoding_cells = tf.contrib.rnn.MultiRNNCell(encoding_cells, state_is_tuple=True)
 
         # Outputs: (batch_size, timesteps, num_nodes, output_dim)
         with tf.variable_scope('DCRNN_SEQ'):
-            inputs = tf.unstack(tf.reshape(self._inputs, (batch_size, seq_len, num_nodes * input_dim)), axis=1)
+            inputs = tf.unstack(tf.reshape(self._inputs, (-1, seq_len, num_nodes * input_dim)), axis=1)
 
-            outputs, _ = tf.contrib.rnn.static_rnn(encoding_cells, inputs, dtype=tf.float32)
+            outputs, self._final_states = utils.rnn_encoder(encoding_cells, inputs, encoder_type=encoder_type)
 
         # Project the output to output_dim.
-        self._outputs = tf.reshape(outputs[-1], (batch_size, horizon, num_nodes, output_dim), name='outputs')
+        self._outputs = tf.reshape(outputs[-1], (-1, horizon, num_nodes, output_dim), name='outputs')
+
+        # Single step of the encoder (sharing the variables) for the stateful inference: feed the newest time-step
+        # and the states of the previous step.
+        self._step_inputs, self._init_states = None, None
+        self._step_outputs, self._step_states = None, None
+        if stateful:
+            self._step_inputs = tf.placeholder(tf.float32, shape=(batch_size, num_nodes, input_dim),
+                                               name='step_inputs')
+            self._init_states = tuple(tf.placeholder(tf.float32, shape=(batch_size, cell.state_size),
+                                                     name='init_state_{}'.format(i))
+                                      for i in range(num_rnn_layers))
+            with tf.variable_scope('DCRNN_SEQ', reuse=True):
+                step_output, self._step_states = encoding_cells(
+                    tf.reshape(self._step_inputs, (-1, num_nodes * input_dim)), self._init_states)
+            self._step_outputs = tf.reshape(step_output, (-1, horizon, num_nodes, output_dim),
+                                            name='step_outputs')
         self._merged = tf.summary.merge_all()
 
     @staticmethod
@@ -86,3 +107,23 @@ class DCRNNModel(object):
     @property
     def outputs(self):
         return self._outputs
+
+    @property
+    def final_states(self):
+        return self._final_states
+
+    @property
+    def step_inputs(self):
+        return self._step_inputs
+
+    @property
+    def init_states(self):
+        return self._init_states
+
+    @property
+    def step_outputs(self):
+        return self._step_outputs
+
+    @property
+    def step_states(self):
+        return self._step_states
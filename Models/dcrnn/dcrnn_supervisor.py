@@ -23,6 +23,8 @@ class DCRNNSupervisor(AbstractModel):
     """
     Do experiments using Graph Random Walk RNN model.
     """
+    # No dropout at test time.
+    _deterministic_test_model = True
 
     def __init__(self, is_training=False, **kwargs):
         super(DCRNNSupervisor, self).__init__(**kwargs)
@@ -45,9 +47,12 @@ class DCRNNSupervisor(AbstractModel):
                                     batch_size=self._data_kwargs['batch_size'],
                                     adj_mx=self._data['adj_mx'], **self._model_kwargs)
         else:
+            # Dynamic batch dimension: the same graph serves the single runs and the batched runs (one row per run).
             self.model = DCRNNModel(scaler=scaler,
-                                    batch_size=1,
-                                    adj_mx=self._data['adj_mx'], **self._model_kwargs)
+                                    batch_size=None,
+                                    adj_mx=self._data['adj_mx'],
+                                    stateful=self._stateful_inference and not self._batched_runs,
+                                    **self._model_kwargs)
 
         # Learning rate.
         self._lr = tf.get_variable('learning_rate', shape=(), initializer=tf.constant_initializer(0.01),
@@ -117,6 +122,7 @@ class DCRNNSupervisor(AbstractModel):
                 'outputs': model.outputs
             })
 
+        data_generator = utils.prefetch_iterator(data_generator, self._prefetch)
         for _, (x, y) in enumerate(data_generator):
 
             feed_dict = {
@@ -161,7 +167,9 @@ class DCRNNSupervisor(AbstractModel):
         # Initialize traffic matrix data
         tm_pred, m_indicator = self._init_data_test(test_data_norm, runId)
 
-        y_preds = []
+        y_preds, y_truths = self._init_results_test(test_data_norm)
+        inputs = np.zeros(shape=(1, self._seq_len, self._nodes, self._input_dim), dtype='float32')
+        step_inputs = np.zeros(shape=(1, self._nodes, self._input_dim), dtype='float32')
         fetches = {
             'global_step': tf.train.get_or_create_global_step()
         }
@@ -170,24 +178,53 @@ class DCRNNSupervisor(AbstractModel):
             'outputs': model.outputs
         })
 
-        y_truths = []
+        stateful = model.step_inputs is not None
+        if stateful:
+            fetches['states'] = model.final_states
+            step_fetches = {
+                'global_step': tf.train.get_or_create_global_step(),
+                'outputs': model.step_outputs,
+                'states': model.step_states
+            }
+        states = None
+        # Largest absolute differences between the stateful and the windowed outputs at the checked time-steps
+        stateful_errors = []
 
         for ts in tqdm(range(test_data_norm.shape[0] - self._horizon - self._seq_len)):
 
-            x = self._prepare_input_dcrnn(
-                data=tm_pred[ts:ts + self._seq_len],
-                m_indicator=m_indicator[ts:ts + self._seq_len]
-            )
-
-            y_truths.append(
-                np.expand_dims(test_data_norm[ts + self._seq_len:ts + self._seq_len + self._horizon].copy(), axis=0))
-
-            feed_dict = {
-                model.inputs: x,
-            }
-
-            vals = sess.run(fetches, feed_dict=feed_dict)
-            y_preds.append(np.squeeze(vals['outputs'], axis=-1))
+            if stateful and ts > 0:
+                # Only the newest time-step of the window is encoded.
+                x = self._prepare_step_input_dcrnn(
+                    data=tm_pred[ts + self._seq_len - 1],
+                    m_indicator=m_indicator[ts + self._seq_len - 1],
+                    out=step_inputs
+                )
+                feed_dict = {
+                    model.step_inputs: x,
+                }
+                feed_dict.update(zip(model.init_states, states))
+                vals = sess.run(step_fetches, feed_dict=feed_dict)
+
+                if self._stateful_check_every > 0 and ts % self._stateful_check_every == 0:
+                    x = self._prepare_input_dcrnn(
+                        data=tm_pred[ts:ts + self._seq_len],
+                        m_indicator=m_indicator[ts:ts + self._seq_len],
+                        out=inputs
+                    )
+                    windowed_outputs = sess.run(model.outputs, feed_dict={model.inputs: x})
+                    stateful_errors.append(np.max(np.abs(vals['outputs'] - windowed_outputs)))
+            else:
+                x = self._prepare_input_dcrnn(
+                    data=tm_pred[ts:ts + self._seq_len],
+                    m_indicator=m_indicator[ts:ts + self._seq_len],
+                    out=inputs
+                )
+                feed_dict = {
+                    model.inputs: x,
+                }
+                vals = sess.run(fetches, feed_dict=feed_dict)
+            states = vals.get('states')
+            y_preds[ts] = vals['outputs'][0, :, :, 0]
 
             if writer is not None and 'merged' in vals:
                 writer.add_summary(vals['merged'], global_step=vals['global_step'])
@@ -206,6 +243,12 @@ class DCRNNSupervisor(AbstractModel):
             # Concatenating new_input into current rnn_input
             tm_pred[ts + self._seq_len] = new_input
 
+        if stateful_errors:
+            self._logger.info('|--- Stateful inference: max |stateful - windowed| output difference: {:.6f} '
+                              '(mean {:.6f}) over {} checked time-steps'.format(np.max(stateful_errors),
+                                                                                np.mean(stateful_errors),
+                                                                                len(stateful_errors)))
+
         results = {'y_preds': y_preds,
                    'tm_pred': tm_pred[self._seq_len:],
                    'm_indicator': m_indicator[self._seq_len:],
@@ -213,6 +256,72 @@ class DCRNNSupervisor(AbstractModel):
                    }
         return results
 
+    def _run_tm_prediction_batch(self, sess, model, writer=None):
+        """
+        Run all the test runs together. Each run is one row of the batch and has its own m_indicator.
+        :return: a list of results (one per run) with the same format as _run_tm_prediction.
+        """
+
+        test_data_norm = self._data['test_set']
+
+        # Initialize traffic matrix data of every run: shape(#run_times, #time-steps, #nflows)
+        tm_pred, m_indicator = [], []
+        for runId in range(self._run_times):
+            _tm_pred, _m_indicator = self._init_data_test(test_data_norm, runId)
+            tm_pred.append(_tm_pred)
+            m_indicator.append(_m_indicator)
+        tm_pred = np.stack(tm_pred, axis=0)
+        m_indicator = np.stack(m_indicator, axis=0)
+        # The same view of each run is passed at every time-step (the consecutive loss trackers are kept per array).
+        run_m_indicators = list(m_indicator)
+
+        y_preds, y_truths = self._init_results_test(test_data_norm, n_runs=self._run_times)
+        inputs = np.zeros(shape=(self._run_times, self._seq_len, self._nodes, self._input_dim), dtype='float32')
+        fetches = {
+            'global_step': tf.train.get_or_create_global_step()
+        }
+
+        fetches.update({
+            'outputs': model.outputs
+        })
+
+        for ts in tqdm(range(test_data_norm.shape[0] - self._horizon - self._seq_len)):
+
+            x = self._prepare_input_dcrnn_batch(
+                data=tm_pred[:, ts:ts + self._seq_len],
+                m_indicator=m_indicator[:, ts:ts + self._seq_len],
+                out=inputs
+            )
+
+            feed_dict = {
+                model.inputs: x,
+            }
+
+            vals = sess.run(fetches, feed_dict=feed_dict)
+
+            if writer is not None and 'merged' in vals:
+                writer.add_summary(vals['merged'], global_step=vals['global_step'])
+
+            ground_true = test_data_norm[ts + self._seq_len]
+            y_preds[:, ts] = vals['outputs'][..., 0]
+
+            for runId in range(self._run_times):
+                pred = vals['outputs'][runId, 0, :, 0]
+
+                sampling = self._monitored_flows_slection(time_slot=ts, m_indicator=run_m_indicators[runId])
+
+                # Merge value from pred_input and measured_input
+                tm_pred[runId, ts + self._seq_len] = pred * (1.0 - sampling) + ground_true * sampling
+
+        results = []
+        for runId in range(self._run_times):
+            results.append({'y_preds': y_preds[runId],
+                            'tm_pred': tm_pred[runId, self._seq_len:],
+                            'm_indicator': m_indicator[runId, self._seq_len:],
+                            'y_truths': y_truths
+                            })
+        return results
+
     def get_lr(self, sess):
         return sess.run(self._lr).item()
 
@@ -305,15 +414,22 @@ class DCRNNSupervisor(AbstractModel):
         # Metrics: MSE, MAE, RMSE, MAPE, ER
         metrics_summary = np.zeros(shape=(self._run_times + 3, self._horizon * n_metrics + 1))
 
-        for i in range(self._run_times):
-            self._logger.info('|--- Run time: {}'.format(i))
-            # y_test = self._prepare_test_set()
-
-            test_results = self._run_tm_prediction(sess, model=self.model, runId=i)
-
-            metrics_summary = self._calculate_metrics(prediction_results=test_results, metrics_summary=metrics_summary,
-                                                      scaler=self._data['scaler'],
-                                                      runId=i, data_norm=self._data['test_set'])
+        if self._batched_runs and not self._deterministic_runs():
+            self._logger.info('|--- Run {} times in batch'.format(self._run_times))
+            batch_results = self._run_tm_prediction_batch(sess, model=self.model)
+            for i in range(self._run_times):
+                self._logger.info('|--- Run time: {}'.format(i))
+                metrics_summary = self._calculate_metrics(prediction_results=batch_results[i],
+                                                          metrics_summary=metrics_summary,
+                                                          scaler=self._data['scaler'],
+                                                          runId=i, data_norm=self._data['test_set'])
+
+            self._summarize_results(metrics_summary=metrics_summary, n_metrics=n_metrics)
+            return
+
+        metrics_summary = self._test_runs(
+            lambda runId: self._run_tm_prediction(sess, model=self.model, runId=runId),
+            metrics_summary=metrics_summary, data_norm=self._data['test_set'])
 
         self._summarize_results(metrics_summary=metrics_summary, n_metrics=n_metrics)
 
@@ -5,6 +5,7 @@ from __future__ import print_function
 import tensorflow as tf
 
 from Models.dcrnn_att.dcrnn_cell_att import DCGRUCell
+from lib import utils
 
 
 # from tensorflow.contrib import legacy_seq2seq
@@ -29,6 +30,8 @@ class DCRNN_ATT_Model(object):
         seq_len = int(model_kwargs.get('seq_len'))
         input_dim = int(model_kwargs.get('input_dim', 1))
         output_dim = int(model_kwargs.get('output_dim', 1))
+        # 'static' (unrolled) or 'dynamic' (tf.while_loop) encoder
+        encoder_type = model_kwargs.get('encoder', 'static')
 
         # Input (batch_size, timesteps, num_sensor, input_dim)
         self._inputs = tf.placeholder(tf.float32, shape=(batch_size, seq_len, num_nodes, input_dim), name='inputs')
@@ -46,7 +49,7 @@ class DCRNN_ATT_Model(object):
         # Outputs: (batch_size, timesteps, num_nodes, output_dim)
         with tf.variable_scope('DCRNN_SEQ'):
             inputs = tf.unstack(tf.reshape(self._inputs, (batch_size, seq_len, num_nodes * input_dim)), axis=1)
-            outputs, _ = tf.contrib.rnn.static_rnn(encoding_cells, inputs, dtype=tf.float32)
+            outputs, _ = utils.rnn_encoder(encoding_cells, inputs, encoder_type=encoder_type)
 
         # Project the output to output_dim.
         self._outputs = tf.reshape(outputs[-1], (batch_size, horizon, num_nodes, output_dim), name='outputs')
@@ -117,6 +117,7 @@ class DCRNN_ATT_Supervisor(AbstractModel):
                 'outputs': model.outputs
             })
 
+        data_generator = utils.prefetch_iterator(data_generator, self._prefetch)
         for _, (x, y) in enumerate(data_generator):
 
             feed_dict = {
@@ -161,7 +162,8 @@ class DCRNN_ATT_Supervisor(AbstractModel):
         # Initialize traffic matrix data
         tm_pred, m_indicator = self._init_data_test(test_data_norm, runId)
 
-        y_preds = []
+        y_preds, y_truths = self._init_results_test(test_data_norm)
+        inputs = np.zeros(shape=(1, self._seq_len, self._nodes, self._input_dim), dtype='float32')
         fetches = {
             'global_step': tf.train.get_or_create_global_step()
         }
@@ -170,24 +172,20 @@ class DCRNN_ATT_Supervisor(AbstractModel):
             'outputs': model.outputs
         })
 
-        y_truths = []
-
         for ts in tqdm(range(test_data_norm.shape[0] - self._horizon - self._seq_len)):
 
             x = self._prepare_input_dcrnn(
                 data=tm_pred[ts:ts + self._seq_len],
-                m_indicator=m_indicator[ts:ts + self._seq_len]
+                m_indicator=m_indicator[ts:ts + self._seq_len],
+                out=inputs
             )
 
-            y_truths.append(
-                np.expand_dims(test_data_norm[ts + self._seq_len:ts + self._seq_len + self._horizon].copy(), axis=0))
-
             feed_dict = {
                 model.inputs: x,
             }
 
             vals = sess.run(fetches, feed_dict=feed_dict)
-            y_preds.append(np.squeeze(vals['outputs'], axis=-1))
+            y_preds[ts] = vals['outputs'][0, :, :, 0]
 
             if writer is not None and 'merged' in vals:
                 writer.add_summary(vals['merged'], global_step=vals['global_step'])
@@ -305,15 +303,9 @@ class DCRNN_ATT_Supervisor(AbstractModel):
         # Metrics: MSE, MAE, RMSE, MAPE, ER
         metrics_summary = np.zeros(shape=(self._run_times + 3, self._horizon * n_metrics + 1))
 
-        for i in range(self._run_times):
-            self._logger.info('|--- Run time: {}'.format(i))
-            # y_test = self._prepare_test_set()
-
-            test_results = self._run_tm_prediction(sess, model=self.model, runId=i)
-
-            metrics_summary = self._calculate_metrics(prediction_results=test_results, metrics_summary=metrics_summary,
-                                                      scaler=self._data['scaler'],
-                                                      runId=i, data_norm=self._data['test_set'])
+        metrics_summary = self._test_runs(
+            lambda runId: self._run_tm_prediction(sess, model=self.model, runId=runId),
+            metrics_summary=metrics_summary, data_norm=self._data['test_set'])
 
         self._summarize_results(metrics_summary=metrics_summary, n_metrics=n_metrics)
 
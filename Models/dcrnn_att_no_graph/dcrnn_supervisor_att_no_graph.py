@@ -132,6 +132,7 @@ class DCRNNSupervisor(AbstractModel):
                 'outputs': model.outputs
             })
 
+        data_generator = utils.prefetch_iterator(data_generator, self._prefetch)
         for _, (x, y) in enumerate(data_generator):
 
             feed_dict = {
@@ -16,6 +16,7 @@ from Models.dcrnn_fc.dcrnn_fc_model import DCRNNModel
 from common.error_utils import error_ratio
 from lib import utils, metrics
 from lib.AMSGrad import AMSGrad
+from lib.indicator import save_indicator
 from lib.metrics import masked_mse_loss
 
 
@@ -53,6 +54,7 @@ class DCRNNSupervisor(object):
         self._run_times = self._test_kwargs.get('run_times')
         # Data preparation
         self._day_size = self._data_kwargs.get('day_size')
+        self._prefetch = int(self._data_kwargs.get('prefetch', 0))
         self._data = utils.load_dataset_dcrnn(seq_len=self._model_kwargs.get('seq_len'),
                                               horizon=self._model_kwargs.get('horizon'),
                                               input_dim=self._model_kwargs.get('input_dim'),
@@ -197,6 +199,7 @@ class DCRNNSupervisor(object):
                 'outputs': model.outputs
             })
 
+        data_generator = utils.prefetch_iterator(data_generator, self._prefetch)
         for _, (x, y) in enumerate(data_generator):
 
             feed_dict = {
@@ -595,7 +598,7 @@ class DCRNNSupervisor(object):
     def _save_results(self, g_truth, pred_tm, m_indicator, tag):
         np.save(self._log_dir + '/g_truth{}'.format(tag), g_truth)
         np.save(self._log_dir + '/pred_tm_{}'.format(tag), pred_tm)
-        np.save(self._log_dir + '/m_indicator{}'.format(tag), m_indicator)
+        save_indicator(self._log_dir + '/m_indicator{}'.format(tag), m_indicator)
 
     def save(self, sess, val_loss):
         config = dict(self._kwargs)
@@ -5,7 +5,8 @@ from __future__ import print_function
 import tensorflow as tf
 from tensorflow.contrib import legacy_seq2seq
 
-from Models.dcrnn.dcrnn_cell import DCGRUCell
+from Models.dcrnn.dcrnn_cell import DCGRUCell, DENSE_SUPPORT_THRESHOLD
+from lib import utils
 
 
 class DCRNNModel(object):
@@ -30,6 +31,10 @@ class DCRNNModel(object):
         use_curriculum_learning = bool(model_kwargs.get('use_curriculum_learning', False))
         input_dim = int(model_kwargs.get('input_dim', 1))
         output_dim = int(model_kwargs.get('output_dim', 1))
+        # 'static' (unrolled) or 'dynamic' (tf.while_loop) encoder
+        encoder_type = model_kwargs.get('encoder', 'static')
+        # Supports at least this dense use a dense matmul in the diffusion (null: always sparse)
+        dense_threshold = model_kwargs.get('dense_support_threshold', DENSE_SUPPORT_THRESHOLD)
 
         # Input (batch_size, timesteps, num_sensor, input_dim)
         self._inputs = tf.placeholder(tf.float32, shape=(batch_size, seq_len, num_nodes, input_dim), name='inputs')
@@ -43,12 +48,13 @@ class DCRNNModel(object):
                                              name='enc_labels_bw')
 
         # GO_SYMBOL = tf.zeros(shape=(batch_size, num_nodes * input_dim))
-        GO_SYMBOL = tf.zeros(shape=(batch_size, num_nodes * output_dim))
+        # batch_size may be None: one graph serves every batch size.
+        GO_SYMBOL = tf.zeros(shape=(tf.shape(self._inputs)[0], num_nodes * output_dim))
 
         cell = DCGRUCell(rnn_units, adj_mx, max_diffusion_step=max_diffusion_step, num_nodes=num_nodes,
-                         filter_type=filter_type)
+                         filter_type=filter_type, dense_threshold=dense_threshold)
         cell_with_projection = DCGRUCell(rnn_units, adj_mx, max_diffusion_step=max_diffusion_step, num_nodes=num_nodes,
-                                         num_proj=output_dim, filter_type=filter_type)
+                                         num_proj=output_dim, filter_type=filter_type, dense_threshold=dense_threshold)
 
         encoding_cells_fw = [cell] * num_rnn_layers
         decoding_cells_fw = [cell] * (num_rnn_layers - 1) + [cell_with_projection]
@@ -58,9 +64,9 @@ class DCRNNModel(object):
         global_step = tf.train.get_or_create_global_step()
         # Outputs: (batch_size, timesteps, num_nodes, output_dim)
         with tf.variable_scope('DCRNN_SEQ'):
-            inputs_fw = tf.unstack(tf.reshape(self._inputs, (batch_size, seq_len, num_nodes * input_dim)), axis=1)
+            inputs_fw = tf.unstack(tf.reshape(self._inputs, (-1, seq_len, num_nodes * input_dim)), axis=1)
             labels_fw = tf.unstack(
-                tf.reshape(self._labels_fw[..., :output_dim], (batch_size, horizon, num_nodes * output_dim)), axis=1)
+                tf.reshape(self._labels_fw[..., :output_dim], (-1, horizon, num_nodes * output_dim)), axis=1)
             labels_fw.insert(0, GO_SYMBOL)
 
             def _loop_function_fw(prev_fw, i):
@@ -78,7 +84,7 @@ class DCRNNModel(object):
                 return result_fw
 
             # enc_outputs_fw, enc_state_fw = tf.contrib.rnn.static_rnn(encoding_cells_fw, inputs_fw, dtype=tf.float32)
-            _, enc_state_fw = tf.contrib.rnn.static_rnn(encoding_cells_fw, inputs_fw, dtype=tf.float32)
+            _, enc_state_fw = utils.rnn_encoder(encoding_cells_fw, inputs_fw, encoder_type=encoder_type)
 
             # encoder_layers = RNN(encoding_cells, return_state=True, return_sequences=True)
             # _, enc_state = encoder_layers(inputs)
@@ -88,24 +94,24 @@ class DCRNNModel(object):
         # Project the output to output_dim.
         outputs_fw = tf.stack(outputs_fw[:-1], axis=1)
 
-        self._outputs_fw = tf.reshape(outputs_fw, (batch_size, horizon, num_nodes, output_dim), name='outputs_fw')
+        self._outputs_fw = tf.reshape(outputs_fw, (-1, horizon, num_nodes, output_dim), name='outputs_fw')
 
         # construct backward network
         encoding_cells_bw = [cell] * (num_rnn_layers - 1) + [cell_with_projection]
         encoding_cells_bw = tf.contrib.rnn.MultiRNNCell(encoding_cells_bw, state_is_tuple=True)
 
         with tf.variable_scope('DCRNN_SEQ_BW'):
-            inputs_bw = tf.reshape(self._inputs, (batch_size, seq_len, num_nodes * input_dim))
+            inputs_bw = tf.reshape(self._inputs, (-1, seq_len, num_nodes * input_dim))
             inputs_bw = tf.reverse(inputs_bw, axis=[1])
             inputs_bw = tf.unstack(inputs_bw, axis=1)
 
-            enc_outputs_bw, enc_state_bw = tf.contrib.rnn.static_rnn(encoding_cells_bw, inputs_bw, dtype=tf.float32)
+            enc_outputs_bw, enc_state_bw = utils.rnn_encoder(encoding_cells_bw, inputs_bw, encoder_type=encoder_type)
 
         enc_outputs_bw = tf.stack(enc_outputs_bw, axis=1)
         enc_outputs_bw = tf.reverse(enc_outputs_bw, axis=[1])
         # enc_outputs_fw = tf.stack(enc_outputs_fw, axis=1)
 
-        enc_outputs_bw = tf.reshape(enc_outputs_bw, (batch_size, seq_len, num_nodes, output_dim))
+        enc_outputs_bw = tf.reshape(enc_outputs_bw, (-1, seq_len, num_nodes, output_dim))
         # enc_outputs_fw = tf.reshape(enc_outputs_fw, (batch_size, seq_len, num_nodes, output_dim))
 
         # enc_outputs_bw = tf.concat([enc_outputs_bw, self._inputs], axis=3)
@@ -121,7 +127,7 @@ class DCRNNModel(object):
         #     enc_outputs_bw)
         # enc_outputs_bw = Dropout(0.5, batch_input_shape=(batch_size, seq_len, 512))(enc_outputs_bw)
         # enc_outputs_bw = TimeDistributed(Dense(num_nodes), input_shape=(seq_len, 512))(enc_outputs_bw)
-        self._enc_outputs_bw = tf.reshape(enc_outputs_bw, (batch_size, seq_len, num_nodes, output_dim),
+        self._enc_outputs_bw = tf.reshape(enc_outputs_bw, (-1, seq_len, num_nodes, output_dim),
                                           name='enc_outputs_bw')
 
         self._merged = tf.summary.merge_all()
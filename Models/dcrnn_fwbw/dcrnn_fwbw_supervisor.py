@@ -23,6 +23,8 @@ class DCRNNSupervisor(AbstractModel):
     """
     Do experiments using Graph Random Walk RNN model.
     """
+    # No dropout at test time.
+    _deterministic_test_model = True
 
     def __init__(self, is_training=False, **kwargs):
         super(DCRNNSupervisor, self).__init__(**kwargs)
@@ -54,23 +56,14 @@ class DCRNNSupervisor(AbstractModel):
                                               batch_size=self._data_kwargs['batch_size'],
                                               adj_mx=self._data['adj_mx'], **self._model_kwargs)
 
-        with tf.name_scope('Val'):
-            with tf.variable_scope('DCRNN', reuse=True):
-                self.val_model = DCRNNModel(is_training=False, scaler=scaler,
-                                            batch_size=self._data_kwargs['val_batch_size'],
-                                            adj_mx=self._data['adj_mx'], **self._model_kwargs)
-
-        with tf.name_scope('Eval'):
-            with tf.variable_scope('DCRNN', reuse=True):
-                self.eval_model = DCRNNModel(is_training=False, scaler=scaler,
-                                             batch_size=self._data_kwargs['eval_batch_size'],
-                                             adj_mx=self._data['adj_mx'], **self._model_kwargs)
-
+        # A single inference graph (dynamic batch dimension) is shared by the validation, evaluation and test.
         with tf.name_scope('Test'):
             with tf.variable_scope('DCRNN', reuse=True):
                 self.test_model = DCRNNModel(is_training=False, scaler=scaler,
-                                             batch_size=self._data_kwargs['test_batch_size'],
+                                             batch_size=None,
                                              adj_mx=self._data['adj_mx'], **self._model_kwargs)
+        self.val_model = self.test_model
+        self.eval_model = self.test_model
 
         # Learning rate.
         self._lr = tf.get_variable('learning_rate', shape=(), initializer=tf.constant_initializer(0.01),
@@ -157,6 +150,7 @@ class DCRNNSupervisor(AbstractModel):
                 'outputs': model.outputs_fw
             })
 
+        data_generator = utils.prefetch_iterator(data_generator, self._prefetch)
         for _, (_inputs, _dec_labels_fw, _enc_labels_bw) in enumerate(data_generator):
             feed_dict = {
                 model.inputs: _inputs,
@@ -328,13 +322,8 @@ class DCRNNSupervisor(AbstractModel):
         # Metrics: MSE, MAE, RMSE, MAPE, ER
         metrics_summary = np.zeros(shape=(self._run_times + 3, self._horizon * n_metrics + 1))
 
-        for i in range(self._run_times):
-            # y_test = self._prepare_test_set()
-            test_results = self._run_tm_prediction(sess, runId=i)
-
-            metrics_summary = self._calculate_metrics(prediction_results=test_results, metrics_summary=metrics_summary,
-                                                      scaler=self._data['scaler'],
-                                                      runId=i, data_norm=self._data['test_data_norm'])
+        metrics_summary = self._test_runs(lambda runId: self._run_tm_prediction(sess, runId=runId),
+                                          metrics_summary=metrics_summary, data_norm=self._data['test_data_norm'])
 
         self._summarize_results(metrics_summary=metrics_summary, n_metrics=n_metrics)
 
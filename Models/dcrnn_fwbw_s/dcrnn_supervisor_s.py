@@ -25,6 +25,8 @@ class DCRNNSSupervisor(AbstractModel):
     """
     Do experiments using Graph Random Walk RNN model.
     """
+    # No dropout at test time (the keras Dropout layers are only active in training).
+    _deterministic_test_model = True
 
     def __init__(self, is_training=False, **kwargs):
         super(DCRNNSSupervisor, self).__init__(**kwargs)
@@ -48,23 +50,14 @@ class DCRNNSSupervisor(AbstractModel):
                                                batch_size=self._data_kwargs['batch_size'],
                                                adj_mx=self._data['adj_mx'], **self._model_kwargs)
 
-        with tf.name_scope('Val'):
-            with tf.variable_scope('DCRNN', reuse=True):
-                self._val_model = DCRNNModel(is_training=False, scaler=scaler,
-                                             batch_size=self._data_kwargs['val_batch_size'],
-                                             adj_mx=self._data['adj_mx'], **self._model_kwargs)
-
-        with tf.name_scope('Eval'):
-            with tf.variable_scope('DCRNN', reuse=True):
-                self._eval_model = DCRNNModel(is_training=False, scaler=scaler,
-                                              batch_size=self._data_kwargs['eval_batch_size'],
-                                              adj_mx=self._data['adj_mx'], **self._model_kwargs)
-
+        # A single inference graph (dynamic batch dimension) is shared by the validation, evaluation and test.
         with tf.name_scope('Test'):
             with tf.variable_scope('DCRNN', reuse=True):
                 self._test_model = DCRNNModel(is_training=False, scaler=scaler,
-                                              batch_size=self._data_kwargs['test_batch_size'],
+                                              batch_size=None,
                                               adj_mx=self._data['adj_mx'], **self._model_kwargs)
+        self._val_model = self._test_model
+        self._eval_model = self._test_model
 
         # Learning rate.
         self._lr = tf.get_variable('learning_rate', shape=(), initializer=tf.constant_initializer(0.01),
@@ -167,6 +160,7 @@ class DCRNNSSupervisor(AbstractModel):
                 'outputs': model.outputs
             })
 
+        data_generator = utils.prefetch_iterator(data_generator, self._prefetch)
         for _, (x, y) in enumerate(data_generator):
 
             feed_dict = {
@@ -211,7 +205,8 @@ class DCRNNSSupervisor(AbstractModel):
         # Initialize traffic matrix data
         tm_pred, m_indicator = self._init_data_test(test_data_norm, runId)
 
-        y_preds = []
+        y_preds, y_truths = self._init_results_test(test_data_norm)
+        inputs = np.zeros(shape=(1, self._seq_len, self._nodes, self._input_dim), dtype='float32')
         fetches = {
             'global_step': tf.train.get_or_create_global_step()
         }
@@ -220,26 +215,23 @@ class DCRNNSSupervisor(AbstractModel):
             'outputs': model.outputs
         })
 
-        y_truths = []
         _last_err = 1.0
         for ts in tqdm(range(test_data_norm.shape[0] - self._horizon - self._seq_len)):
 
             x = self._prepare_input_dcrnn(
                 data=tm_pred[ts:ts + self._seq_len],
-                m_indicator=m_indicator[ts:ts + self._seq_len]
+                m_indicator=m_indicator[ts:ts + self._seq_len],
+                out=inputs
             )
             x_bw = self._prepare_input_lstm(data=tm_pred[ts:ts + self._seq_len],
                                             m_indicator=m_indicator[ts:ts + self._seq_len])
 
-            y_truths.append(
-                np.expand_dims(test_data_norm[ts + self._seq_len:ts + self._seq_len + self._horizon].copy(), axis=0))
-
             feed_dict = {
                 model.inputs: x,
             }
 
             vals = sess.run(fetches, feed_dict=feed_dict)
-            y_preds.append(np.squeeze(vals['outputs'], axis=-1))
+            y_preds[ts] = vals['outputs'][0, :, :, 0]
 
             if writer is not None and 'merged' in vals:
                 writer.add_summary(vals['merged'], global_step=vals['global_step'])
@@ -367,15 +359,9 @@ class DCRNNSSupervisor(AbstractModel):
         # Metrics: MSE, MAE, RMSE, MAPE, ER
         metrics_summary = np.zeros(shape=(self._run_times + 3, self._horizon * n_metrics + 1))
 
-        for i in range(self._run_times):
-            self._logger.info('|--- Run time: {}'.format(i))
-            # y_test = self._prepare_test_set()
-
-            test_results = self._run_tm_prediction(sess, model=self._test_model, runId=i)
-
-            metrics_summary = self._calculate_metrics(prediction_results=test_results, metrics_summary=metrics_summary,
-                                                      scaler=self._data['scaler'],
-                                                      runId=i, data_norm=self._data['test_data_norm'])
+        metrics_summary = self._test_runs(
+            lambda runId: self._run_tm_prediction(sess, model=self._test_model, runId=runId),
+            metrics_summary=metrics_summary, data_norm=self._data['test_data_norm'])
 
         self._summarize_results(metrics_summary=metrics_summary, n_metrics=n_metrics)
 
@@ -5,8 +5,9 @@ from __future__ import print_function
 import tensorflow as tf
 from tensorflow.contrib import legacy_seq2seq
 
-from Models.dcrnn.dcrnn_cell import DCGRUCell
+from Models.dcrnn.dcrnn_cell import DCGRUCell, DENSE_SUPPORT_THRESHOLD
 from Models.dcrnn_weight.dcrnn_cell_weighted import DCGRUCellWeighted
+from lib import utils
 
 
 class DCRNNModelWeighted(object):
@@ -31,6 +32,10 @@ class DCRNNModelWeighted(object):
         use_curriculum_learning = bool(model_kwargs.get('use_curriculum_learning', False))
         input_dim = int(model_kwargs.get('input_dim', 1))
         output_dim = int(model_kwargs.get('output_dim', 1))
+        # 'static' (unrolled) or 'dynamic' (tf.while_loop) encoder
+        encoder_type = model_kwargs.get('encoder', 'static')
+        # Supports at least this dense use a dense matmul in the diffusion (null: always sparse)
+        dense_threshold = model_kwargs.get('dense_support_threshold', DENSE_SUPPORT_THRESHOLD)
 
         # Input (batch_size, timesteps, num_sensor, input_dim)
         self._inputs = tf.placeholder(tf.float32, shape=(batch_size, seq_len, num_nodes, input_dim), name='inputs')
@@ -44,11 +49,11 @@ class DCRNNModelWeighted(object):
                                    filter_type=filter_type, batch_size=batch_size)
 
         cell = DCGRUCell(rnn_units, adj_mx, max_diffusion_step=max_diffusion_step, num_nodes=num_nodes,
-                         filter_type=filter_type)
+                         filter_type=filter_type, dense_threshold=dense_threshold)
 
         cell_with_projection = DCGRUCell(rnn_units, adj_mx, max_diffusion_step=max_diffusion_step,
                                          num_nodes=num_nodes,
-                                         num_proj=output_dim, filter_type=filter_type)
+                                         num_proj=output_dim, filter_type=filter_type, dense_threshold=dense_threshold)
 
         encoding_cells = [cell_w] * num_rnn_layers
         decoding_cells = [cell] * (num_rnn_layers - 1) + [cell_with_projection]
@@ -78,7 +83,7 @@ class DCRNNModelWeighted(object):
                     result = prev
                 return result
 
-            _, enc_state = tf.contrib.rnn.static_rnn(encoding_cells, inputs, dtype=tf.float32)
+            _, enc_state = utils.rnn_encoder(encoding_cells, inputs, encoder_type=encoder_type)
 
             # encoder_layers = RNN(encoding_cells, return_state=True, return_sequences=True)
             # _, enc_state = encoder_layers(inputs)
@@ -16,7 +16,9 @@ from Models.dcrnn_weight.dcrnn_model_weighted import DCRNNModelWeighted
 from common.error_utils import error_ratio
 from lib import utils, metrics
 from lib.AMSGrad import AMSGrad
+from lib.indicator import save_indicator
 from lib.metrics import masked_mse_loss
+from lib.windowing import RollingRatioTracker
 
 
 class DCRNNSupervisorWeighted(object):
@@ -52,6 +54,7 @@ class DCRNNSupervisorWeighted(object):
         self._run_times = self._test_kwargs.get('run_times')
         # Data preparation
         self._day_size = self._data_kwargs.get('day_size')
+        self._prefetch = int(self._data_kwargs.get('prefetch', 0))
         self._data = utils.load_dataset_dcrnn_weighted(seq_len=self._model_kwargs.get('seq_len'),
                                                        horizon=self._model_kwargs.get('horizon'),
                                                        input_dim=self._model_kwargs.get('input_dim'),
@@ -200,6 +203,7 @@ class DCRNNSupervisorWeighted(object):
                 'outputs': model.outputs
             })
 
+        data_generator = utils.prefetch_iterator(data_generator, self._prefetch)
         for _, (x, y) in enumerate(data_generator):
 
             feed_dict = {
@@ -224,25 +228,37 @@ class DCRNNSupervisorWeighted(object):
             results['outputs'] = outputs
         return results
 
-    def _prepare_input(self, ground_truth, data, m_indicator):
+    def _measurement_ratios(self, ratio_tracker, ts):
+        """
+        Measurement ratio of each flow before each time-step of the window m_indicator[ts:ts + seq_len], over the
+        last min(ts, seq_len) time-steps (ones for ts = 0).
+        :param ratio_tracker: RollingRatioTracker of the measurement matrix (rows up to ts + seq_len).
+        :param ts:
+        :return: shape(#seq_len, #nflows)
+        """
+        _back = min(ts, self._seq_len)
+        if _back == 0:
+            return np.ones(shape=(self._seq_len, self._nodes))
+        return ratio_tracker.ratios(np.arange(ts, ts + self._seq_len), _back)
+
+    def _prepare_input(self, ground_truth, data, m_indicator, m_ratio):
+        """
+
+        :param ground_truth: shape(#horizon, #nflows)
+        :param data: shape(#seq_len, #nflows)
+        :param m_indicator: shape(#seq_len, #nflows)
+        :param m_ratio: measurement ratios of the window, shape(#seq_len, #nflows) (see _measurement_ratios)
+        :return: x, y
+        """
 
         # (seq_len, num_node, input_dim)
         x = np.zeros(shape=(self._seq_len, self._nodes, self._input_dim), dtype='float32')
         y = np.zeros(shape=(self._horizon, self._nodes), dtype='float32')
 
-        _back = m_indicator.shape[0] - self._seq_len
-
-        _w = np.zeros(shape=(self._seq_len, self._nodes, 1))
-
-        for i in range(self._seq_len):
-            if _back == 0:
-                _mr = np.ones(shape=(self._nodes,))
-            else:
-                _mr = m_indicator[i:(_back + i)].sum(axis=0) / _back
-            _w[i] = np.expand_dims(_mr, axis=1)
+        _w = np.expand_dims(m_ratio, axis=2)
 
         _x = np.expand_dims(data, axis=2)
-        _m = np.expand_dims(m_indicator[-self._seq_len:], axis=2)
+        _m = np.expand_dims(m_indicator, axis=2)
 
         x[:] = np.concatenate([_x, _m, _w], axis=2)
 
@@ -326,17 +342,17 @@ class DCRNNSupervisorWeighted(object):
 
         y_truths = []
 
-        for ts in tqdm(range(test_data_norm.shape[0] - self._horizon - self._seq_len)):
+        # Prefix sums of the measurement matrix, updated with each new row
+        ratio_tracker = RollingRatioTracker(m_indicator.shape[0], self._nodes)
+        ratio_tracker.extend(m_indicator[:self._seq_len])
 
-            if ts - self._seq_len <= 0:
-                _back = 0
-            else:
-                _back = ts - self._seq_len
+        for ts in tqdm(range(test_data_norm.shape[0] - self._horizon - self._seq_len)):
 
             x, y = self._prepare_input(
                 ground_truth=test_data_norm[ts + self._seq_len:ts + self._seq_len + self._horizon],
                 data=tm_pred[ts:ts + self._seq_len],
-                m_indicator=m_indicator[_back:ts + self._seq_len]
+                m_indicator=m_indicator[ts:ts + self._seq_len],
+                m_ratio=self._measurement_ratios(ratio_tracker, ts)
             )
 
             y_truths.append(y)
@@ -363,6 +379,7 @@ class DCRNNSupervisorWeighted(object):
                 sampling = self.set_measured_flow_fairness(labels=m_indicator[ts: ts + self._seq_len])
 
             m_indicator[ts + self._seq_len] = sampling
+            ratio_tracker.append(sampling)
             # invert of sampling: for choosing value from the original data
 
             ground_true = test_data_norm[ts + self._seq_len]
@@ -625,7 +642,7 @@ class DCRNNSupervisorWeighted(object):
     def _save_results(self, g_truth, pred_tm, m_indicator, tag):
         np.save(self._log_dir + '/g_truth{}'.format(tag), g_truth)
         np.save(self._log_dir + '/pred_tm_{}'.format(tag), pred_tm)
-        np.save(self._log_dir + '/m_indicator{}'.format(tag), m_indicator)
+        save_indicator(self._log_dir + '/m_indicator{}'.format(tag), m_indicator)
 
     def save(self, sess, val_loss):
         config = dict(self._kwargs)
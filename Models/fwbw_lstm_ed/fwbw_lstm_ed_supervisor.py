@@ -13,6 +13,9 @@ from tqdm import tqdm
 
 from lib import metrics
 from lib import utils
+from lib.data_correction import data_correction_v3
+from lib.flow_selection import calculate_consecutive_loss, masked_mae_per_flow, smallest_k_indices
+from lib.indicator import save_indicator
 
 
 class TimeHistory(keras_callbacks.Callback):
@@ -266,21 +269,7 @@ class FwbwLstmED():
 
     @staticmethod
     def _calculate_consecutive_loss(m_indicator):
-
-        consecutive_losses = []
-        for flow_id in range(m_indicator.shape[1]):
-            flows_labels = m_indicator[:, flow_id]
-            if flows_labels[-1] == 1:
-                consecutive_losses.append(1)
-            else:
-                measured_idx = np.argwhere(flows_labels == 1)
-                if measured_idx.size == 0:
-                    consecutive_losses.append(m_indicator.shape[0])
-                else:
-                    consecutive_losses.append(m_indicator.shape[0] - measured_idx[-1][0])
-
-        consecutive_losses = np.asarray(consecutive_losses)
-        return consecutive_losses
+        return calculate_consecutive_loss(m_indicator)
 
     def _set_measured_flow_fairness(self, m_indicator):
         """
@@ -326,19 +315,10 @@ class FwbwLstmED():
         :return:
         """
 
-        n_flows = rnn_input.shape[0]
-
-        fw_losses = []
-        for flow_id in range(m_indicator.shape[1]):
-            idx_fw = m_indicator[1:, flow_id]
-
-            # fw_losses.append(error_ratio(y_true=rnn_input[1:, flow_id][idx_fw == 1.0],
-            #                              y_pred=pred_forward[:-1, flow_id][idx_fw == 1.0],
-            #                              measured_matrix=np.zeros(idx_fw[idx_fw == 1.0].shape)))
-            fw_losses.append(metrics.masked_mae_np(preds=pred_forward[:-1, flow_id][idx_fw == 1.0],
-                                                   labels=rnn_input[1:, flow_id][idx_fw == 1.0]))
+        n_flows = rnn_input.shape[1]
 
-        fw_losses = np.array(fw_losses)
+        # MAE of the forward prediction of each flow over its measured time-steps
+        fw_losses = masked_mae_per_flow(preds=pred_forward[:-1], labels=rnn_input[1:], m_indicator=m_indicator[1:])
         fw_losses[fw_losses == 0.] = np.max(fw_losses)
 
         w = self._calculate_flows_weights(fw_losses=fw_losses,
@@ -348,45 +328,13 @@ class FwbwLstmED():
         m = int(self._mon_ratio * n_flows)
 
         w = w.flatten()
-        sorted_idx_w = np.argsort(w)
-        sampling[sorted_idx_w[:m]] = 1
+        sampling[smallest_k_indices(w, m)] = 1
 
         return sampling
 
     def _data_correction_v3(self, rnn_input, pred_backward, labels):
-        # Shape = (#n_flows, #time-steps)
-        _rnn_input = np.copy(rnn_input.T)
-        _labels = np.copy(labels.T)
-
-        beta = np.zeros(_rnn_input.shape)
-
-        corrected_range = int(self._seq_len / self._r)
-
-        for i in range(_rnn_input.shape[1] - corrected_range):
-            mu = np.sum(_labels[:, i + 1:i + corrected_range + 1], axis=1) / corrected_range
-
-            h = np.arange(1, corrected_range + 1)
-
-            rho = (1 / (np.log(corrected_range) + 1)) * np.sum(
-                _labels[:, i + 1:i + corrected_range + 1] / h, axis=1)
-
-            beta[:, i] = mu * rho
-
-        considered_backward = pred_backward[:, 1:]
-        considered_rnn_input = _rnn_input[:, 0:-1]
-
-        beta[beta > 0.5] = 0.5
-
-        alpha = 1.0 - beta
-
-        alpha = alpha[:, 0:-1]
-        beta = beta[:, 0:-1]
-        # gamma = gamma[:, 1:-1]
-
-        # corrected_data = considered_rnn_input * alpha + considered_rnn_input * beta + considered_backward * gamma
-        corrected_data = considered_rnn_input * alpha + considered_backward * beta
-
-        return corrected_data.T
+        return data_correction_v3(rnn_input=rnn_input, pred_backward=pred_backward, labels=labels,
+                                  corrected_range=int(self._seq_len / self._r))
 
     def _run_tm_prediction(self):
         test_data_norm = self._data['test_data_norm']
@@ -444,7 +392,7 @@ class FwbwLstmED():
             else:
                 sampling = self._set_measured_flow(rnn_input=tm_pred[ts: ts + self._seq_len],
                                                    pred_forward=fw_outputs,
-                                                   m_indicator=m_indicator[ts: ts + self._seq_len].T)
+                                                   m_indicator=m_indicator[ts: ts + self._seq_len])
 
             m_indicator[ts + self._seq_len] = sampling
             # invert of sampling: for choosing value from the original data
@@ -577,7 +525,7 @@ class FwbwLstmED():
     def _save_results(self, g_truth, pred_tm, m_indicator, tag):
         np.save(self._log_dir + '/g_truth{}'.format(tag), g_truth)
         np.save(self._log_dir + '/pred_tm_{}'.format(tag), pred_tm)
-        np.save(self._log_dir + '/m_indicator{}'.format(tag), m_indicator)
+        save_indicator(self._log_dir + '/m_indicator{}'.format(tag), m_indicator)
 
     def load(self):
         self.model.load_weights(self._log_dir + 'best_model.hdf5')
@@ -1,5 +1,7 @@
 import tensorflow as tf
 
+from lib import utils
+
 conv1d = tf.layers.conv1d
 
 
@@ -108,6 +110,61 @@ def sp_attn_head(seq, out_sz, adj_mat, activation, nb_nodes, in_drop=0.0, coef_d
         return activation(ret)  # activation
 
 
+# Sparse attention head for any batch size: the logits and the softmax are only computed on the edges of the graph,
+# so that the cost scales with the number of edges instead of nb_nodes^2.
+def sp_batch_attn_head(seq, out_sz, edges, activation, nb_nodes, in_drop=0.0, coef_drop=0.0, residual=False):
+    """
+
+    :param seq: inputs (batch_size, nb_nodes, input_dim)
+    :param out_sz: output's size
+    :param edges: (rows, cols) of the edges (see utils.adj_to_edges)
+    :param activation: activation_fn
+    :param nb_nodes: number of nodes
+    :param in_drop: input_drop
+    :param coef_drop:
+    :param residual:
+    :return:
+    """
+    with tf.name_scope('sp_batch_attn'):
+        if in_drop != 0.0:
+            seq = tf.nn.dropout(seq, 1.0 - in_drop)
+
+        seq_fts = tf.layers.conv1d(seq, out_sz, 1, use_bias=False)
+
+        # simplest self-attention possible
+        f_1 = tf.layers.conv1d(seq_fts, 1, 1)
+        f_2 = tf.layers.conv1d(seq_fts, 1, 1)
+
+        # (nb_nodes, batch_size)
+        f_1 = tf.transpose(tf.squeeze(f_1, axis=-1))
+        f_2 = tf.transpose(tf.squeeze(f_2, axis=-1))
+
+        rows, cols = edges
+        logits = tf.gather(f_1, rows) + tf.gather(f_2, cols)  # (num_edges, batch_size)
+
+        # alpha_ij
+        coefs = utils.edge_softmax(tf.nn.leaky_relu(logits), rows, nb_nodes)
+
+        if coef_drop != 0.0:
+            coefs = tf.nn.dropout(coefs, 1.0 - coef_drop)
+        if in_drop != 0.0:
+            seq_fts = tf.nn.dropout(seq_fts, 1.0 - in_drop)
+
+        vals = utils.edge_matmul(coefs, rows, cols, tf.transpose(seq_fts, [1, 0, 2]), nb_nodes)
+        vals = tf.transpose(vals, [1, 0, 2])
+        vals.set_shape(seq_fts.shape)
+        ret = tf.contrib.layers.bias_add(vals)
+
+        # residual connection
+        if residual:
+            if seq.shape[-1] != ret.shape[-1]:
+                ret = ret + conv1d(seq, ret.shape[-1], 1)  # activation
+            else:
+                ret = ret + seq
+
+        return activation(ret)  # activation
+
+
 class BaseGAttN:
     def loss(logits, labels, nb_classes, class_weights):
         sample_wts = tf.reduce_sum(tf.multiply(tf.one_hot(labels, nb_classes), class_weights), axis=-1)
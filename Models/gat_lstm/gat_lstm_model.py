@@ -5,6 +5,7 @@ from __future__ import print_function
 import tensorflow as tf
 import tensorflow.contrib.slim as slim
 
+from Models.gat_lstm.gat_lstm_cell import sp_batch_attn_head
 from lib.metrics import masked_mae_tf, masked_mse_tf
 
 
@@ -88,6 +89,8 @@ class GATLSTMModel(object):
         self.classif_loss = model_kwargs.get('classif_loss')
         self.learning_rate = model_kwargs.get('learning_rate')
         self.optimizer = model_kwargs.get('optimizer')
+        # Attention only over the edges of adj_mx (edge-list heads) instead of the dense (batch, N, N) bias matrix.
+        self.sparse_attention = model_kwargs.get('sparse_attention', False)
 
         self._build_placeholder()
         self._build_model()
@@ -98,7 +101,11 @@ class GATLSTMModel(object):
 
     def _build_placeholder(self):
         self.inputs = tf.placeholder(dtype=tf.float32, shape=(self.batch_size, self.num_nodes, self.input_dim))
-        self.adj_mx = tf.placeholder(dtype=tf.float32, shape=(self.batch_size, self.num_nodes, self.num_nodes))
+        if self.sparse_attention:
+            # (rows, cols) of the edges, see utils.adj_to_edges
+            self.edges = tf.placeholder(dtype=tf.int32, shape=(2, None))
+        else:
+            self.adj_mx = tf.placeholder(dtype=tf.float32, shape=(self.batch_size, self.num_nodes, self.num_nodes))
         self.labels = tf.placeholder(dtype=tf.float32, shape=(self.batch_size, self.num_nodes, self.output_dim))
         self.attn_drop = tf.placeholder(dtype=tf.float32, shape=())
         self.ffd_drop = tf.placeholder(dtype=tf.float32, shape=())
@@ -106,14 +113,22 @@ class GATLSTMModel(object):
         self.model_step = tf.Variable(
             0, name='model_step', trainable=False)
 
+    def _attn_head(self, seq, out_sz, activation, in_drop=0.0, coef_drop=0.0, residual=False):
+        if self.sparse_attention:
+            return sp_batch_attn_head(seq, out_sz=out_sz, edges=tf.unstack(self.edges), activation=activation,
+                                      nb_nodes=self.num_nodes, in_drop=in_drop, coef_drop=coef_drop, residual=residual)
+        else:
+            return attn_head(seq, out_sz=out_sz, bias_mat=self.adj_mx, activation=activation,
+                             in_drop=in_drop, coef_drop=coef_drop, residual=residual)
+
     def _build_model(self, reuse=None):
         with tf.variable_scope("gatlstm_model", reuse=reuse) as sc:
 
             attns = []
             for _ in range(self.n_heads[0]):
-                attns.append(attn_head(self.inputs, bias_mat=self.adj_mx,
-                                       out_sz=self.hid_units[0], activation=self.activation,
-                                       in_drop=self.ffd_drop, coef_drop=self.attn_drop, residual=False))
+                attns.append(self._attn_head(self.inputs,
+                                             out_sz=self.hid_units[0], activation=self.activation,
+                                             in_drop=self.ffd_drop, coef_drop=self.attn_drop, residual=False))
 
             h_1 = tf.concat(attns, axis=-1)  # the outputs for first layer are con catenated
 
@@ -123,18 +138,19 @@ class GATLSTMModel(object):
                 h_old = h_1
                 attns = []
                 for _ in range(self.n_heads[i]):
-                    attns.append(attn_head(h_1, bias_mat=self.adj_mx,
-                                           out_sz=self.hid_units[i], activation=self.activation,
-                                           in_drop=self.ffd_drop, coef_drop=self.attn_drop, residual=self.residual))
+                    attns.append(self._attn_head(h_1,
+                                                 out_sz=self.hid_units[i], activation=self.activation,
+                                                 in_drop=self.ffd_drop, coef_drop=self.attn_drop,
+                                                 residual=self.residual))
                 h_1 = tf.concat(attns, axis=-1)
 
             # Calculate output by applying averaging attention layer on the final layer of the network
             # n_heads[-1]: the number of head attention applied for the last layer
             out = []
             for i in range(self.n_heads[-1]):
-                out.append(attn_head(h_1, bias_mat=self.adj_mx,
-                                     out_sz=self.output_dim, activation=lambda x: x,
-                                     in_drop=self.ffd_drop, coef_drop=self.attn_drop, residual=False))
+                out.append(self._attn_head(h_1,
+                                           out_sz=self.output_dim, activation=lambda x: x,
+                                           in_drop=self.ffd_drop, coef_drop=self.attn_drop, residual=False))
             self.outputs = tf.add_n(out) / self.n_heads[-1]  # Averaging to obtain the output
             print('output shape: ', self.outputs.get_shape())
             self.merged = tf.summary.merge_all()
@@ -78,6 +78,7 @@ class GATLSTMSupervisor():
         self._run_times = self._test_kwargs.get('run_times')
         # Data preparation
         self._day_size = self._data_kwargs.get('day_size')
+        self._prefetch = int(self._data_kwargs.get('prefetch', 0))
 
         self._data = utils.load_dataset_gatlstm(num_nodes=self._model_kwargs.get('num_nodes'),
                                                 input_dim=self._model_kwargs.get('input_dim'),
@@ -112,21 +113,31 @@ class GATLSTMSupervisor():
         for var in tf.global_variables():
             self._logger.debug('{}, {}'.format(var.name, var.get_shape()))
 
+    def _graph_feed_dict(self, model):
+        """
+        The graph fed to the attention heads: the edge list (sparse attention) or the adjacency matrix repeated over the
+        batch.
+        """
+        adj_mx = self._data['adj_mx']
+        if model.sparse_attention:
+            return {model.edges: np.stack(utils.adj_to_edges(adj_mx))}
+        else:
+            return {model.adj_mx: np.tile(np.expand_dims(adj_mx, 0), [model.batch_size, 1, 1])}
+
     def run_epoch_generator(self, sess, model, data_generator, return_output=False, training=False, writer=None):
         losses = []
 
-        adj_mx = self._data['adj_mx']
-        adj_mx = np.expand_dims(adj_mx, 0)
-        adj_mx = np.tile(adj_mx, [self.batch_size, 1, 1])
+        graph_feed_dict = self._graph_feed_dict(model)
 
+        data_generator = utils.prefetch_iterator(data_generator, self._prefetch)
         for _, (x, y) in enumerate(data_generator):
             feed_dict = {
                 model.inputs: x,
                 model.labels: y,
-                model.adj_mx: adj_mx,
                 model.attn_drop: 0.6,
                 model.ffd_drop: 0.6
             }
+            feed_dict.update(graph_feed_dict)
             res = model.train(sess, feed_dict, self.model_summary_writer,
                               with_output=True)
             losses.append(res['loss'])
@@ -159,6 +170,8 @@ class GATLSTMSupervisor():
         y_preds = []
         y_truths = []
 
+        graph_feed_dict = self._graph_feed_dict(model)
+
         for ts in tqdm(range(test_data_norm.shape[0] - self._horizon - self._seq_len)):
 
             x = self._prepare_input_dcrnn(
@@ -172,6 +185,7 @@ class GATLSTMSupervisor():
             feed_dict = {
                 model.inputs: x,
             }
+            feed_dict.update(graph_feed_dict)
 
             res = model.test(sess, feed_dict, with_output=True)
 
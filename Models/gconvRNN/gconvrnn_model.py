@@ -1,10 +1,13 @@
 import collections
+import hashlib
+import weakref
 
 import numpy as np
 import tensorflow as tf
 
 import Models.gconvRNN.graph as graph
 from Models.gconvRNN.gconvrnn_utils import show_all_variables
+from lib import utils
 from lib.metrics import masked_mae_tf, masked_mse_tf
 
 # Test for tf1.0
@@ -26,51 +29,83 @@ else:
     tfversion = "new"
 
 
-def cheby_conv(x, L, lmax, feat_out, K, W):
-    '''
-    x : [batch_size, N_node, feat_in] - input of each time step
-    nSample : number of samples = batch_size
-    nNode : number of node in graph
-    feat_in : number of input feature
-    feat_out : number of output feature
-    L : laplacian
-    lmax : ?
-    K : size of kernel(number of cheby coefficients)
-    W : cheby_conv weight [K * feat_in, feat_out]
-    '''
+_rescaled_laplacian_cache = weakref.WeakKeyDictionary()
+
+
+def rescaled_laplacian(L, lmax):
+    """
+    Sparse tensor of the rescaled Laplacian (eigenvalues in [-1, 1]), built once per Laplacian content and shared by
+    all the cells, time-steps and model copies of the default graph.
+    :param L: scipy sparse Laplacian (left unchanged).
+    :param lmax: upper-bound on the spectrum of L.
+    :return: tf.SparseTensor
+    """
+    tf_graph = tf.get_default_graph()
+    graph_cache = _rescaled_laplacian_cache.setdefault(tf_graph, {})
+    L = L.tocsr()
+    key = (L.shape, L.dtype.str, float(lmax),
+           hashlib.sha1(np.ascontiguousarray(L.indptr).tobytes() + np.ascontiguousarray(L.indices).tobytes() +
+                        np.ascontiguousarray(L.data).tobytes()).hexdigest())
+    if key not in graph_cache:
+        # The constant is created outside of the current scopes so that it can be reused by any model copy.
+        with tf_graph.as_default(), tf.name_scope(None):
+            graph_cache[key] = utils.build_sparse_matrix(graph.rescale_L(L, lmax))
+    return graph_cache[key]
+
+
+def cheby_basis(x, L, K):
+    """
+    Chebyshev polynomials T_k(L) x, k < K, of the input.
+    :param x: [batch_size, N_node, feat_in] - input of each time step
+    :param L: rescaled laplacian (tf.SparseTensor, see rescaled_laplacian)
+    :param K: size of kernel(number of cheby coefficients)
+    :return: [batch_size * N_node, feat_in * K]
+    """
     nSample, nNode, feat_in = x.get_shape()
     nSample, nNode, feat_in = int(nSample), int(nNode), int(feat_in)
-    L = graph.rescale_L(L, lmax)  # What is this operation?? --> rescale Laplacian
-    L = L.tocoo()
-
-    indices = np.column_stack((L.row, L.col))
-    L = tf.SparseTensor(indices, L.data, L.shape)
-    L = tf.sparse_reorder(L)
 
     x0 = tf.transpose(x, perm=[1, 2, 0])  # change it to [nNode, feat_in, nSample]
     x0 = tf.reshape(x0, [nNode, feat_in * nSample])
-    x = tf.expand_dims(x0, 0)  # make it [1, nNode, feat_in*nSample]
-
-    def concat(x, x_):
-        x_ = tf.expand_dims(x_, 0)
-        return tf.concat([x, x_], axis=0)
+    xs = [x0]
 
     if K > 1:
         x1 = tf.sparse_tensor_dense_matmul(L, x0)
-        x = concat(x, x1)
+        xs.append(x1)
 
     for k in range(2, K):
         x2 = 2 * tf.sparse_tensor_dense_matmul(L, x1) - x0
-        x = concat(x, x2)
+        xs.append(x2)
         x0, x1 = x1, x2
 
-    x = tf.reshape(x, [K, nNode, feat_in, nSample])
-    x = tf.transpose(x, perm=[3, 1, 2, 0])
-    x = tf.reshape(x, [nSample * nNode, feat_in * K])
+    # Stacked once: [nNode, feat_in * nSample, K]
+    x = tf.stack(xs, axis=-1)
+    x = tf.reshape(x, [nNode, feat_in, nSample, K])
+    x = tf.transpose(x, perm=[2, 0, 1, 3])
+    return tf.reshape(x, [nSample * nNode, feat_in * K])
 
-    x = tf.matmul(x, W)  # No Bias term?? -> Yes
-    out = tf.reshape(x, [nSample, nNode, feat_out])
-    return out
+
+def cheby_project(basis, W, nNode, feat_out):
+    """
+    :param basis: [batch_size * N_node, feat_in * K], see cheby_basis
+    :param W: cheby_conv weight [K * feat_in, feat_out]
+    :return: [batch_size, N_node, feat_out]
+    """
+    x = tf.matmul(basis, W)  # No Bias term?? -> Yes
+    return tf.reshape(x, [-1, nNode, feat_out])
+
+
+def cheby_conv(x, L, feat_out, K, W):
+    '''
+    x : [batch_size, N_node, feat_in] - input of each time step
+    nSample : number of samples = batch_size
+    nNode : number of node in graph
+    feat_in : number of input feature
+    feat_out : number of output feature
+    L : rescaled laplacian (tf.SparseTensor, see rescaled_laplacian)
+    K : size of kernel(number of cheby coefficients)
+    W : cheby_conv weight [K * feat_in, feat_out]
+    '''
+    return cheby_project(cheby_basis(x, L, K), W, int(x.get_shape()[1]), feat_out)
 
 
 # gconvLSTM
@@ -91,7 +126,11 @@ class LSTMStateTuple(_LSTMStateTuple):
 class gconvLSTMCell(RNNCell):
     def __init__(self, num_units, forget_bias=1.0,
                  state_is_tuple=True, activation=None, reuse=None,
-                 laplacian=None, lmax=None, K=None, feat_in=None, nNode=None):
+                 laplacian=None, K=None, feat_in=None, nNode=None):
+        """
+
+        :param laplacian: the rescaled laplacian (tf.SparseTensor, see rescaled_laplacian), shared by all the cells.
+        """
         super(gconvLSTMCell, self).__init__(_reuse=reuse)  # super what is it?
 
         self._num_units = num_units
@@ -99,7 +138,6 @@ class gconvLSTMCell(RNNCell):
         self._state_is_tuple = state_is_tuple
         self._activation = activation or tf.tanh
         self._laplacian = laplacian
-        self._lmax = lmax
         self._K = K
         self._feat_in = feat_in
         self._nNode = nNode
@@ -127,7 +165,6 @@ class gconvLSTMCell(RNNCell):
             else:
                 c, h = tf.split(value=state, num_or_size_splits=2, axis=1)
             laplacian = self._laplacian
-            lmax = self._lmax
             K = self._K
             feat_in = self._feat_in
 
@@ -188,24 +225,28 @@ class gconvLSTMCell(RNNCell):
                 bft = tf.get_variable("bft", [feat_out])
                 bot = tf.get_variable("bot", [feat_out])
 
-                # gconv Calculation
-                zxt = cheby_conv(inputs, laplacian, lmax, feat_out, K, Wzxt)  # Wxc * x_t
-                zht = cheby_conv(h, laplacian, lmax, feat_out, K, Wzht)  # Whc * h_(t-1)
+                # gconv Calculation: the Chebyshev basis of x_t and h_(t-1) is shared by the four gates
+                nNode = self._nNode
+                xt_basis = cheby_basis(inputs, laplacian, K)
+                ht_basis = cheby_basis(h, laplacian, K)
+
+                zxt = cheby_project(xt_basis, Wzxt, nNode, feat_out)  # Wxc * x_t
+                zht = cheby_project(ht_basis, Wzht, nNode, feat_out)  # Whc * h_(t-1)
                 zt = zxt + zht + bzt
                 zt = tf.tanh(zt)
 
-                ixt = cheby_conv(inputs, laplacian, lmax, feat_out, K, Wixt)
-                iht = cheby_conv(h, laplacian, lmax, feat_out, K, Wiht)
+                ixt = cheby_project(xt_basis, Wixt, nNode, feat_out)
+                iht = cheby_project(ht_basis, Wiht, nNode, feat_out)
                 it = ixt + iht + bit
                 it = tf.sigmoid(it)
 
-                fxt = cheby_conv(inputs, laplacian, lmax, feat_out, K, Wfxt)
-                fht = cheby_conv(h, laplacian, lmax, feat_out, K, Wfht)
+                fxt = cheby_project(xt_basis, Wfxt, nNode, feat_out)
+                fht = cheby_project(ht_basis, Wfht, nNode, feat_out)
                 ft = fxt + fht + bft
                 ft = tf.sigmoid(ft)
 
-                oxt = cheby_conv(inputs, laplacian, lmax, feat_out, K, Woxt)
-                oht = cheby_conv(h, laplacian, lmax, feat_out, K, Woht)
+                oxt = cheby_project(xt_basis, Woxt, nNode, feat_out)
+                oht = cheby_project(ht_basis, Woht, nNode, feat_out)
                 ot = oxt + oht + bot
                 ot = tf.sigmoid(ot)
 
@@ -310,7 +351,7 @@ class Model(object):
                     'bias': tf.Variable(tf.random_normal([n_classes]))}
             elif self.model_type == 'glstm':
                 cell = gconvLSTMCell(num_units=self.rnn_units, forget_bias=1.0,
-                                     laplacian=self.laplacian, lmax=self.lmax,
+                                     laplacian=rescaled_laplacian(self.laplacian, self.lmax),
                                      K=self.num_kernel,
                                      nNode=self.num_nodes)
                 cell = tf.nn.rnn_cell.DropoutWrapper(cell, output_keep_prob=0.8)
@@ -211,11 +211,21 @@ def plot_spectrum(L, algo='eig'):
     plt.ylim(ymin=0)
 
 
-def lanczos(L, X, K):
+def _column_chunks(N, chunk_size):
+    """Slices of at most chunk_size columns (a single slice if chunk_size is None)."""
+    if chunk_size is None or chunk_size >= N:
+        return [slice(0, N)]
+    return [slice(start, min(start + chunk_size, N)) for start in range(0, N, chunk_size)]
+
+
+def lanczos(L, X, K, chunk_size=None, out=None):
     """
     Given the graph Laplacian and a data matrix, return a data matrix which can
     be multiplied by the filter coefficients to filter X using the Lanczos
     polynomial approximation.
+    The columns of X are independent: they are filtered by chunks of chunk_size
+    columns to bound the memory of the Lanczos basis, and the result can be
+    written into out (e.g. a np.memmap of shape (K, M, N)).
     """
     M, N = X.shape
     assert L.dtype == X.dtype
@@ -225,6 +235,7 @@ def lanczos(L, X, K):
         Lanczos algorithm which computes the orthogonal matrix V and the
         tri-diagonal matrix H.
         """
+        N = X.shape[1]
         a = np.empty((K, N), L.dtype)
         b = np.zeros((K, N), L.dtype)
         V = np.empty((K, M, N), L.dtype)
@@ -241,6 +252,7 @@ def lanczos(L, X, K):
 
     def diag_H(a, b, K):
         """Diagonalize the tri-diagonal H matrix."""
+        N = a.shape[1]
         H = np.zeros((K * K, N), a.dtype)
         H[:K ** 2:K + 1, :] = a
         H[1:(K - 1) * K:K + 1, :] = b[1:, :]
@@ -249,13 +261,16 @@ def lanczos(L, X, K):
         Q = np.swapaxes(Q, 1, 2).T
         return Q
 
-    V, a, b = basis(L, X, K)
-    Q = diag_H(a, b, K)
-    Xt = np.empty((K, M, N), L.dtype)
-    for n in range(N):
-        Xt[..., n] = Q[..., n].T.dot(V[..., n])
-    Xt *= Q[0, :, np.newaxis, :]
-    Xt *= np.linalg.norm(X, axis=0)
+    Xt = np.empty((K, M, N), L.dtype) if out is None else out
+    for cols in _column_chunks(N, chunk_size):
+        _X = X[:, cols]
+        V, a, b = basis(L, _X, K)
+        Q = diag_H(a, b, K)
+        # Projection on the basis of every column at once: Xt[..., n] = Q[..., n].T.dot(V[..., n])
+        _Xt = np.einsum('jkn,jmn->kmn', Q, V)
+        _Xt *= Q[0, :, np.newaxis, :]
+        _Xt *= np.linalg.norm(_X, axis=0)
+        Xt[..., cols] = _Xt
     return Xt  # Q[0, ...]
 
 
@@ -263,6 +278,8 @@ def rescale_L(L, lmax=2):
     """Rescale the Laplacian eigenvalues in [-1,1]."""
     M, M = L.shape
     I = scipy.sparse.identity(M, format='csr', dtype=L.dtype)
+    # Rescaled on a copy: the caller's Laplacian is left unchanged.
+    L = L.copy()
     L /= lmax / 2
     # L -= I
 
@@ -272,21 +289,29 @@ def rescale_L(L, lmax=2):
     return L
 
 
-def chebyshev(L, X, K):
+def chebyshev(L, X, K, chunk_size=None, out=None):
     """Return T_k X where T_k are the Chebyshev polynomials of order up to K.
-    Complexity is O(KMN)."""
+    Complexity is O(KMN).
+    The columns of X are filtered by chunks of chunk_size columns (the sparse
+    products only touch M x chunk_size blocks), and the result can be written
+    into out (e.g. a np.memmap of shape (K, M, N))."""
     M, N = X.shape
     assert L.dtype == X.dtype
 
     # L = rescale_L(L, lmax)
     # Xt = T @ X: MxM @ MxN.
-    Xt = np.empty((K, M, N), L.dtype)
-    # Xt_0 = T_0 X = I X = X.
-    Xt[0, ...] = X
-    # Xt_1 = T_1 X = L X.
-    if K > 1:
-        Xt[1, ...] = L.dot(X)
-    # Xt_k = 2 L Xt_k-1 - Xt_k-2.
-    for k in range(2, K):
-        Xt[k, ...] = 2 * L.dot(Xt[k - 1, ...]) - Xt[k - 2, ...]
+    Xt = np.empty((K, M, N), L.dtype) if out is None else out
+    for cols in _column_chunks(N, chunk_size):
+        # Xt_0 = T_0 X = I X = X.
+        x0 = np.asarray(X[:, cols])
+        Xt[0, :, cols] = x0
+        if K < 2:
+            continue
+        # Xt_1 = T_1 X = L X.
+        x1 = L.dot(x0)
+        Xt[1, :, cols] = x1
+        # Xt_k = 2 L Xt_k-1 - Xt_k-2.
+        for k in range(2, K):
+            x0, x1 = x1, 2 * L.dot(x1) - x0
+            Xt[k, :, cols] = x1
     return Xt
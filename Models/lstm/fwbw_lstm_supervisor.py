@@ -12,6 +12,8 @@ from lib import utils
 
 
 class FwbwLstmRegression(AbstractModel):
+    # No dropout at test time (the keras Dropout layers are only active in training).
+    _deterministic_test_model = True
 
     def __init__(self, is_training=False, **kwargs):
         super(FwbwLstmRegression, self).__init__(**kwargs)
@@ -218,14 +220,8 @@ class FwbwLstmRegression(AbstractModel):
         n_metrics = 4
         # Metrics: MSE, MAE, RMSE, MAPE, ER
         metrics_summary = np.zeros(shape=(self._run_times + 3, self._horizon * n_metrics + 1))
-        for i in range(self._run_times):
-            print('|--- Running time: {}/{}'.format(i, self._run_times))
-
-            test_results = self._run_tm_prediction(runId=i)
-
-            metrics_summary = self._calculate_metrics(prediction_results=test_results, metrics_summary=metrics_summary,
-                                                      scaler=self._data['scaler'],
-                                                      runId=i, data_norm=self._data['test_data_norm'])
+        metrics_summary = self._test_runs(lambda runId: self._run_tm_prediction(runId=runId),
+                                          metrics_summary=metrics_summary, data_norm=self._data['test_data_norm'])
 
         self._summarize_results(metrics_summary=metrics_summary, n_metrics=n_metrics)
 
@@ -1,16 +1,22 @@
+import logging
+import traceback
+from multiprocessing import Process, Pipe, cpu_count
+
 import matplotlib
 import numpy as np
 import pandas as pd
 from pmdarima.arima import auto_arima
 from sklearn.preprocessing import StandardScaler
-from tqdm import tqdm
 
 from common.DataPreprocessing import prepare_train_test_2d
+from lib.indicator import save_indicator
 
 matplotlib.use('Agg')
 
+logger = logging.getLogger(__name__)
+
 
-def build_auto_arima(data):
+def build_auto_arima(data, trace=False):
     model = auto_arima(data, start_p=1, start_q=1,
                        test='adf',  # use adftest to find optimal 'd'
                        max_p=3, max_q=3,  # maximum p and q
@@ -19,7 +25,7 @@ def build_auto_arima(data):
                        seasonal=False,  # No Seasonality
                        start_P=0,
                        D=0,
-                       trace=True,
+                       trace=trace,
                        error_action='ignore',
                        suppress_warnings=True,
                        stepwise=True)
@@ -29,6 +35,157 @@ def build_auto_arima(data):
     return model
 
 
+def _valid_prediction(yhat, max_value, min_value):
+    if np.any(np.isinf(yhat)):
+        return max_value
+    elif np.any(np.isnan(yhat)):
+        return min_value
+    return yhat
+
+
+def predict_arima_flows(init_data, test_data, measured_matrix, arima_step, refresh_step, ims, ims_step,
+                        max_value, min_value):
+    """
+    Online prediction of a group of flows. The order of each flow's ARIMA model is selected (auto_arima) at the
+    first time-step and every #refresh_step time-steps; in between, the fitted model is updated with the new
+    observations (warm-started from its current parameters).
+
+    :param init_data: shape(#arima_step, #nflows)
+    :param test_data: shape(#time-steps, #nflows)
+    :param measured_matrix: shape(#time-steps, #nflows)
+    :param arima_step: length of the history used for the order selection.
+    :param refresh_step: number of time-steps between two order selections (<= 0: every #arima_step time-steps, so
+    that the history of the updated models stays bounded).
+    :param ims:
+    :param ims_step:
+    :param max_value: replacement of the inf predictions.
+    :param min_value: replacement of the nan predictions.
+    :return: pred_tm (measured or predicted values), predicted_tm (predicted values), ims_pred_tm
+    """
+    n_timesteps, n_flows = test_data.shape
+    pred_tm = np.zeros(shape=test_data.shape)
+    predicted_tm = np.zeros(shape=test_data.shape)
+    ims_pred_tm = np.zeros(shape=(n_timesteps - ims_step + 1, n_flows))
+
+    if refresh_step is None or refresh_step <= 0:
+        refresh_step = arima_step
+
+    history = [list(init_data[:, flow_id].astype(float)) for flow_id in range(n_flows)]
+    models = [None] * n_flows
+    # Length of the history already seen by each model (fitted or updated)
+    n_seen = [0] * n_flows
+
+    for ts in range(n_timesteps):
+        refresh = ts % refresh_step == 0
+        for flow_id in range(n_flows):
+            if refresh or models[flow_id] is None:
+                try:
+                    models[flow_id] = build_auto_arima(history[flow_id][-arima_step:])
+                    n_seen[flow_id] = len(history[flow_id])
+                except Exception as e:
+                    logger.warning('ARIMA order selection of flow {} failed at time-step {} ({}), the previous model '
+                                   'is kept'.format(flow_id, ts, e))
+            if models[flow_id] is not None and n_seen[flow_id] < len(history[flow_id]):
+                # Update with all the observations the model has not seen (several after a failed refresh/update)
+                try:
+                    models[flow_id].update(history[flow_id][n_seen[flow_id]:])
+                    n_seen[flow_id] = len(history[flow_id])
+                except Exception as e:
+                    logger.warning('ARIMA update of flow {} failed at time-step {} ({})'.format(flow_id, ts, e))
+            model = models[flow_id]
+
+            if model is None:
+                output = [history[flow_id][-1]] * (ims_step if ims else 1)
+            elif ims and (ts <= n_timesteps - ims_step):
+                output = model.predict(n_periods=ims_step)
+            else:
+                output = model.predict(n_periods=1)
+
+            if ims and (ts <= n_timesteps - ims_step):
+                ims_pred_tm[ts, flow_id] = _valid_prediction(output[-1], max_value, min_value)
+
+            yhat = _valid_prediction(output[0], max_value, min_value)
+
+            # Partial monitoring
+            if measured_matrix[ts, flow_id]:
+                history[flow_id].append(test_data[ts, flow_id])
+            else:
+                history[flow_id].append(yhat)
+            pred_tm[ts, flow_id] = history[flow_id][-1]
+            predicted_tm[ts, flow_id] = yhat
+
+    return pred_tm, predicted_tm, ims_pred_tm
+
+
+def _predict_arima_flows_worker(connection, *args, **kwargs):
+    """
+    Run predict_arima_flows in a Process: always send back either the results or the error (with its traceback).
+    """
+    try:
+        connection.send((True, predict_arima_flows(*args, **kwargs)))
+    except Exception:
+        connection.send((False, traceback.format_exc()))
+    finally:
+        connection.close()
+
+
+def parallel_predict_arima_flows(init_data, test_data, measured_matrix, nproc=None, **kwargs):
+    """
+    Split the flows over #nproc processes; each process runs predict_arima_flows on its flows.
+    :return: pred_tm, predicted_tm, ims_pred_tm
+    """
+    n_flows = test_data.shape[1]
+    if nproc is None or nproc <= 0:
+        nproc = cpu_count()
+    nproc = min(nproc, n_flows)
+    if nproc == 1:
+        return predict_arima_flows(init_data, test_data, measured_matrix, **kwargs)
+
+    quota = int(n_flows / nproc)
+    flow_ranges = [(proc_id * quota, (proc_id + 1) * quota if proc_id < (nproc - 1) else n_flows)
+                   for proc_id in range(nproc)]
+
+    p = [0] * nproc
+    connections = []
+    for proc_id in range(nproc):
+        connections.append(Pipe(duplex=False))
+
+    for proc_id, (_start, _end) in enumerate(flow_ranges):
+        p[proc_id] = Process(target=_predict_arima_flows_worker,
+                             args=(connections[proc_id][1],
+                                   init_data[:, _start:_end],
+                                   test_data[:, _start:_end],
+                                   measured_matrix[:, _start:_end]),
+                             kwargs=kwargs)
+        p[proc_id].start()
+        # Only the child keeps the sending end: recv() raises EOFError if the child dies without sending.
+        connections[proc_id][1].close()
+
+    ret = []
+    try:
+        for proc_id in range(nproc):
+            try:
+                success, result = connections[proc_id][0].recv()
+            except EOFError:
+                raise RuntimeError('ARIMA process {} exited without results'.format(proc_id))
+            if not success:
+                raise RuntimeError('ARIMA process {} failed:\n{}'.format(proc_id, result))
+            ret.append(result)
+    except Exception:
+        for proc in p:
+            proc.terminate()
+        raise
+    finally:
+        for proc in p:
+            proc.join()
+
+    for proc_id in range(nproc):
+        if p[proc_id].exitcode != 0:
+            raise RuntimeError('ARIMA process {} exited with code {}'.format(proc_id, p[proc_id].exitcode))
+
+    return tuple(np.concatenate([r[i] for r in ret], axis=1) for i in range(3))
+
+
 def ims_tm_test_data(test_data):
     ims_test_set = np.zeros(shape=(test_data.shape[0] - Config.ARIMA_IMS_STEP + 1, test_data.shape[1]))
 
@@ -116,91 +273,21 @@ def test_arima(data):
         ims_test_data = ims_tm_test_data(test_data=test_data)
         measured_matrix_ims = np.zeros(shape=ims_test_data.shape)
 
-        pred_tm2d = np.zeros(shape=test_data_normalize.shape)
-        ims_pred_tm2d = np.zeros(
-            (test_data_normalize.shape[0] - Config.ARIMA_IMS_STEP + 1, test_data_normalize.shape[1]))
-
         measured_matrix2d = np.random.choice(tf,
                                              size=test_data_normalize.shape,
                                              p=[Config.ARIMA_MON_RATIO, 1 - Config.ARIMA_MON_RATIO])
 
-        predicted_tm2d = np.zeros(shape=test_data_normalize.shape)
-
-        init_data_set_series = []
-        history = []
-        for flow_id in range(init_data_normalize.shape[1]):
-            flow_frame = pd.Series(init_data_normalize[:, flow_id])
-            init_data_set_series.append(flow_frame)
-
-            init_data_set_series[flow_id].dropna(inplace=True)
-            flow_train = init_data_set_series[flow_id].values
-
-            history.append([x for x in flow_train.astype(float)])
-
-        # prediction_times = pd.DataFrame(index=range(test_data_normalize.shape[0]), columns=['No', 'run_time'])
-        # pred_times = []
-
-        for ts in tqdm(range(test_data_normalize.shape[0])):
-
-            predictions = np.zeros(shape=(test_data_normalize.shape[1]))
-            predicted_traffic = np.zeros(shape=(test_data_normalize.shape[1]))
-
-            measured_flow = measured_matrix2d[ts]
-
-            predictions_ims = []
-
-            # start_time = time.time()
-
-            for flow_id in range(test_data_normalize.shape[1]):
-                print('')
-                print('----------------------------------------------------------------------------------------------')
-                print("|--- Run time: {} - ts: {} -- Mon: {}".format(running_time, ts, Config.ARIMA_MON_RATIO))
-
-                try:
-                    model = build_auto_arima(history[flow_id][-Config.ARIMA_STEP:])
-                except:
-                    pass
-
-                if Config.ARIMA_IMS and (ts <= test_data_normalize.shape[0] - Config.ARIMA_IMS_STEP):
-                    output = model.predict(n_periods=Config.ARIMA_IMS_STEP)
-                    if ts <= (test_data_normalize.shape[0] - Config.ARIMA_IMS_STEP):
-                        yhat_ims = output[-1]
-                        if np.any(np.isinf(yhat_ims)):
-                            yhat_ims = np.max(train_data_normalized2d)
-                            pass
-                        elif np.any(np.isnan(yhat_ims)):
-                            yhat_ims = np.min(train_data_normalized2d)
-
-                        predictions_ims.append(yhat_ims)
-
-                else:
-                    output = model.predict(n_periods=1)
-
-                yhat = output[0]
-                obs = test_data_normalize[ts, flow_id]
-
-                if np.any(np.isinf(yhat)):
-                    yhat = np.max(train_data_normalized2d)
-                elif np.any(np.isnan(yhat)):
-                    yhat = np.min(train_data_normalized2d)
-
-                # Partial monitoring
-                if measured_flow[flow_id]:
-                    history[flow_id].append(obs)
-                    predictions[flow_id] = obs
-                else:
-                    history[flow_id].append(yhat)
-                    predictions[flow_id] = yhat
-
-                predicted_traffic = yhat
-
-            pred_tm2d[ts, :] = predictions
-            predicted_tm2d[ts, :] = predicted_traffic
-            # stop_time = time.time()
-            # pred_times.append(stop_time - start_time)
-
-            if Config.ARIMA_IMS and (ts <= test_data_normalize.shape[0] - Config.ARIMA_IMS_STEP):
-                ims_pred_tm2d[ts] = predictions_ims
+        pred_tm2d, predicted_tm2d, ims_pred_tm2d = parallel_predict_arima_flows(
+            init_data=init_data_normalize,
+            test_data=test_data_normalize,
+            measured_matrix=measured_matrix2d,
+            nproc=getattr(Config, 'ARIMA_NPROC', None),
+            arima_step=Config.ARIMA_STEP,
+            refresh_step=getattr(Config, 'ARIMA_REFRESH_STEP', 0),
+            ims=Config.ARIMA_IMS,
+            ims_step=Config.ARIMA_IMS_STEP,
+            max_value=np.max(train_data_normalized2d),
+            min_value=np.min(train_data_normalized2d))
 
         pred_tm_invert2d = scaler.inverse_transform(pred_tm2d)
         predicted_tm_invert2d = scaler.inverse_transform(predicted_tm2d)
@@ -210,9 +297,10 @@ def test_arima(data):
         np.save(Config.RESULTS_PATH + '{}-{}-{}-{}/{}'.format(Config.DATA_NAME, Config.ALG, Config.TAG, Config.SCALER,
                                                               "Predicted_tm_{}".format(running_time)),
                 predicted_tm_invert2d)
-        np.save(Config.RESULTS_PATH + '{}-{}-{}-{}/{}'.format(Config.DATA_NAME, Config.ALG, Config.TAG, Config.SCALER,
-                                                              "M_indicator_{}".format(running_time)),
-                measured_matrix2d)
+        save_indicator(Config.RESULTS_PATH + '{}-{}-{}-{}/{}'.format(Config.DATA_NAME, Config.ALG, Config.TAG,
+                                                                     Config.SCALER,
+                                                                     "M_indicator_{}".format(running_time)),
+                       measured_matrix2d)
 
         # err.append(error_ratio(y_true=test_data,
         #                        y_pred=pred_tm_invert2d,
@@ -4,6 +4,7 @@ from tqdm import tqdm
 
 from Models.lstm.fwbw_lstm_supervisor import FwbwLstmRegression
 from common.error_utils import error_ratio, calculate_r2_score, calculate_rmse, calculate_mape
+from lib import data_correction as correction
 
 config_gpu = tf.ConfigProto()
 config_gpu.gpu_options.allow_growth = True
@@ -24,37 +25,8 @@ def prepare_input_online_prediction(data, labels):
 
 
 def data_correction_v3(rnn_input, pred_backward, labels):
-    # Shape = (#n_flows, #time-steps)
-    _rnn_input = np.copy(rnn_input.T)
-    _labels = np.copy(labels.T)
-
-    beta = np.zeros(_rnn_input.shape)
-    for i in range(_rnn_input.shape[1] - int(config['model']['seq_len'] / 3.0)):
-        mu = np.sum(_labels[:, i + 1:i + int(config['model']['seq_len'] / 3.0) + 1], axis=1) / int(
-            config['model']['seq_len'] / 3.0)
-
-        h = np.arange(1, int(config['model']['seq_len'] / 3.0) + 1)
-
-        rho = (1 / (np.log(int(config['model']['seq_len'] / 3.0)) + 1)) * np.sum(
-            _labels[:, i + 1:i + int(config['model']['seq_len'] / 3.0) + 1] / h, axis=1)
-
-        beta[:, i] = mu * rho
-
-    considered_backward = pred_backward[:, 1:]
-    considered_rnn_input = _rnn_input[:, 0:-1]
-
-    beta[beta > 0.5] = 0.5
-
-    alpha = 1.0 - beta
-
-    alpha = alpha[:, 0:-1]
-    beta = beta[:, 0:-1]
-    # gamma = gamma[:, 1:-1]
-
-    # corrected_data = considered_rnn_input * alpha + considered_rnn_input * beta + considered_backward * gamma
-    corrected_data = considered_rnn_input * alpha + considered_backward * beta
-
-    return corrected_data.T
+    return correction.data_correction_v3(rnn_input=rnn_input, pred_backward=pred_backward, labels=labels,
+                                         corrected_range=int(config['model']['seq_len'] / 3.0))
 
 
 def data_correction_v4(rnn_input, pred_backward, labels, fw_mon_ratio, seq_len):
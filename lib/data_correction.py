@@ -0,0 +1,47 @@
+import numpy as np
+
+from lib.windowing import sliding_windows, rolling_mean
+
+
+def data_correction_v3(rnn_input, pred_backward, labels, corrected_range):
+    """
+    Correct the input of the forward network by the backward predictions.
+    beta[:, i] = mu_i * rho_i (clipped at 0.5), where mu_i is the measurement ratio and rho_i the harmonic-weighted
+    measurement ratio of the #corrected_range time-steps following time-step i; alpha = 1 - beta.
+
+    :param rnn_input: shape(#seq_len, #nflows)
+    :param pred_backward: shape(#nflows, #seq_len)
+    :param labels: shape(#seq_len, #nflows): measurement matrix of the window.
+    :param corrected_range:
+    :return: corrected data of the time-steps [0: seq_len - 1], shape(#seq_len - 1, #nflows)
+    """
+    if corrected_range <= 0:
+        # No time-step to correct from (seq_len < r): the input is left unchanged.
+        return rnn_input[0:-1]
+
+    seq_len = rnn_input.shape[0]
+    n_windows = max(seq_len - corrected_range, 0)
+
+    # Shape = (#time-steps, #n_flows)
+    beta = np.zeros(rnn_input.shape)
+    if n_windows > 0:
+        # Windows labels[i + 1: i + corrected_range + 1] for every i, computed all at once.
+        _labels = labels[1:].astype('float64')
+        mu = rolling_mean(_labels, corrected_range)[:n_windows]
+
+        h = np.arange(1, corrected_range + 1)
+        rho = (1 / (np.log(corrected_range) + 1)) * np.einsum(
+            'ith,t->ih', sliding_windows(_labels, corrected_range, n_windows=n_windows), 1.0 / h)
+
+        beta[:n_windows] = mu * rho
+
+    beta[beta > 0.5] = 0.5
+
+    alpha = 1.0 - beta
+
+    alpha = alpha[0:-1]
+    beta = beta[0:-1]
+
+    corrected_data = rnn_input[0:-1] * alpha + pred_backward[:, 1:].T * beta
+
+    return corrected_data
@@ -0,0 +1,56 @@
+import unittest
+
+import numpy as np
+
+from lib.data_correction import data_correction_v3
+
+
+def _data_correction_v3_loop(rnn_input, pred_backward, labels, corrected_range):
+    # Reference: the per-time-step loop of the supervisors.
+    _rnn_input = np.copy(rnn_input.T)
+    _labels = np.copy(labels.T)
+
+    beta = np.zeros(_rnn_input.shape)
+    for i in range(_rnn_input.shape[1] - corrected_range):
+        mu = np.sum(_labels[:, i + 1:i + corrected_range + 1], axis=1) / corrected_range
+
+        h = np.arange(1, corrected_range + 1)
+
+        rho = (1 / (np.log(corrected_range) + 1)) * np.sum(
+            _labels[:, i + 1:i + corrected_range + 1] / h, axis=1)
+
+        beta[:, i] = mu * rho
+
+    beta[beta > 0.5] = 0.5
+    alpha = 1.0 - beta
+
+    corrected_data = _rnn_input[:, 0:-1] * alpha[:, 0:-1] + pred_backward[:, 1:] * beta[:, 0:-1]
+    return corrected_data.T
+
+
+class DataCorrectionTestCase(unittest.TestCase):
+    def setUp(self):
+        np.random.seed(0)
+        self.seq_len, self.nflows = 12, 5
+        self.rnn_input = np.random.rand(self.seq_len, self.nflows)
+        self.pred_backward = np.random.rand(self.nflows, self.seq_len)
+        self.labels = np.random.choice([1.0, 0.0], size=(self.seq_len, self.nflows), p=(0.6, 0.4))
+
+    def test_same_as_loop(self):
+        for corrected_range in [1, 3, 4, 6, 12]:
+            np.testing.assert_allclose(
+                _data_correction_v3_loop(self.rnn_input, self.pred_backward, self.labels, corrected_range),
+                data_correction_v3(self.rnn_input, self.pred_backward, self.labels, corrected_range))
+
+    def test_uint8_labels(self):
+        np.testing.assert_allclose(
+            _data_correction_v3_loop(self.rnn_input, self.pred_backward, self.labels, 4),
+            data_correction_v3(self.rnn_input, self.pred_backward, self.labels.astype('uint8'), 4))
+
+    def test_empty_range(self):
+        corrected_data = data_correction_v3(self.rnn_input, self.pred_backward, self.labels, 0)
+        np.testing.assert_array_equal(self.rnn_input[:-1], corrected_data)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,76 @@
+import numpy as np
+
+
+def calculate_consecutive_loss(m_indicator):
+    """
+    Number of time-steps since the last measurement of each flow in the window.
+    (1 if the flow is measured at the last time-step, #seq_len if it is not measured in the window)
+    :param m_indicator: shape(#seq_len, #nflows)
+    :return: shape(#nflows)
+    """
+    seq_len = m_indicator.shape[0]
+    measured = m_indicator == 1
+    # Index of the last measurement of each flow
+    last_measured_idx = seq_len - 1 - np.argmax(measured[::-1], axis=0)
+    return np.where(np.any(measured, axis=0), seq_len - last_measured_idx, seq_len)
+
+
+class ConsecutiveLossTracker(object):
+    """
+    Keep the consecutive loss of each flow over a sliding window of #seq_len time-steps, updated in O(#nflows)
+    from each new row of the measurement matrix.
+    """
+
+    def __init__(self, m_indicator, end):
+        """
+
+        :param m_indicator: the current window, shape(#seq_len, #nflows)
+        :param end: index (in the full measurement matrix) of the time-step following the window.
+        """
+        self.seq_len = m_indicator.shape[0]
+        self.end = end
+        self.consecutive_losses = calculate_consecutive_loss(m_indicator)
+
+    def update(self, sampling):
+        """
+        Slide the window by one time-step.
+        :param sampling: the new row of the measurement matrix, shape(#nflows)
+        :return:
+        """
+        self.consecutive_losses = np.where(sampling == 1, 1, np.minimum(self.consecutive_losses + 1, self.seq_len))
+        self.end += 1
+        return self.consecutive_losses
+
+
+def masked_mae_per_flow(preds, labels, m_indicator):
+    """
+    MAE of each flow over its measured time-steps, i.e. for every flow_id:
+    metrics.masked_mae_np(preds=preds[:, flow_id][m_indicator[:, flow_id] == 1.0],
+                          labels=labels[:, flow_id][m_indicator[:, flow_id] == 1.0])
+    :param preds: shape(#time-steps, #nflows)
+    :param labels: shape(#time-steps, #nflows)
+    :param m_indicator: shape(#time-steps, #nflows)
+    :return: shape(#nflows), nan for the flows which are not measured.
+    """
+    measured = m_indicator == 1.0
+    valid = measured & ~np.isnan(labels)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mae = np.nan_to_num(np.abs(np.subtract(preds, labels)).astype('float32'))
+        mae = np.sum(np.where(valid, mae, 0.0), axis=0) / np.sum(valid, axis=0)
+    mae[np.sum(valid, axis=0) == 0] = 0.0
+    mae[np.sum(measured, axis=0) == 0] = np.nan
+    return mae
+
+
+def smallest_k_indices(values, k):
+    """
+    Indices of the k smallest values (unordered), same set as np.argsort(values)[:k] when there are no ties.
+    :param values: shape(#n)
+    :param k:
+    :return:
+    """
+    if k <= 0:
+        return np.array([], dtype=int)
+    if k >= values.shape[0]:
+        return np.arange(values.shape[0])
+    return np.argpartition(values, k - 1)[:k]
@@ -0,0 +1,78 @@
+import unittest
+import warnings
+
+import numpy as np
+
+from lib import flow_selection
+
+
+def _consecutive_loss_loop(m_indicator):
+    # Reference: the per-flow loop of the supervisors.
+    consecutive_losses = []
+    for flow_id in range(m_indicator.shape[1]):
+        flows_labels = m_indicator[:, flow_id]
+        if flows_labels[-1] == 1:
+            consecutive_losses.append(1)
+        else:
+            measured_idx = np.argwhere(flows_labels == 1)
+            if measured_idx.size == 0:
+                consecutive_losses.append(m_indicator.shape[0])
+            else:
+                consecutive_losses.append(m_indicator.shape[0] - measured_idx[-1][0])
+    return np.asarray(consecutive_losses)
+
+
+def _masked_mae_np(preds, labels):
+    # Reference: metrics.masked_mae_np (null_val=np.nan).
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mask = (~np.isnan(labels)).astype('float32')
+        mask /= np.mean(mask)
+        mae = np.abs(np.subtract(preds, labels)).astype('float32')
+        mae = np.nan_to_num(mae * mask)
+        return np.mean(mae)
+
+
+class FlowSelectionTestCase(unittest.TestCase):
+    def setUp(self):
+        np.random.seed(0)
+        self.m_indicator = np.random.choice([1.0, 0.0], size=(60, 8), p=(0.2, 0.8))
+        # Never measured flow
+        self.m_indicator[:, 3] = 0.0
+
+    def test_consecutive_loss(self):
+        for end in range(1, 13):
+            window = self.m_indicator[end:end + 12]
+            np.testing.assert_array_equal(_consecutive_loss_loop(window),
+                                          flow_selection.calculate_consecutive_loss(window))
+
+    def test_consecutive_loss_tracker(self):
+        seq_len = 12
+        tracker = flow_selection.ConsecutiveLossTracker(self.m_indicator[:seq_len], end=seq_len)
+        for end in range(seq_len + 1, self.m_indicator.shape[0] + 1):
+            tracker.update(self.m_indicator[end - 1])
+            self.assertEqual(end, tracker.end)
+            np.testing.assert_array_equal(_consecutive_loss_loop(self.m_indicator[end - seq_len:end]),
+                                          tracker.consecutive_losses)
+
+    def test_masked_mae_per_flow(self):
+        preds = np.random.rand(*self.m_indicator.shape)
+        labels = np.random.rand(*self.m_indicator.shape)
+        labels[5, 0] = np.nan
+        with warnings.catch_warnings():
+            # Mean of the empty slice of the never measured flow (nan)
+            warnings.simplefilter('ignore', RuntimeWarning)
+            expected = np.array([_masked_mae_np(preds=preds[:, flow_id][self.m_indicator[:, flow_id] == 1.0],
+                                                labels=labels[:, flow_id][self.m_indicator[:, flow_id] == 1.0])
+                                 for flow_id in range(self.m_indicator.shape[1])])
+        mae = flow_selection.masked_mae_per_flow(preds=preds, labels=labels, m_indicator=self.m_indicator)
+        np.testing.assert_allclose(expected, mae, rtol=1e-6)
+        self.assertTrue(np.isnan(mae[3]))
+
+    def test_smallest_k_indices(self):
+        values = np.random.permutation(20).astype(float)
+        for k in [0, 1, 5, 19, 20, 25]:
+            self.assertEqual(set(np.argsort(values)[:k]), set(flow_selection.smallest_k_indices(values, k)))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,56 @@
+import os
+
+import numpy as np
+
+# In-memory dtype of the measurement matrices: they only hold 0/1, and numpy promotes uint8 in the float arithmetic
+# (pred * (1.0 - sampling), m_indicator.sum(axis=0) / n, ...) and in the assignments to float arrays.
+INDICATOR_DTYPE = 'uint8'
+
+
+def to_indicator(m_indicator):
+    """
+    :param m_indicator: a 0/1 (or boolean) array of any dtype.
+    :return: the uint8 measurement matrix (1 byte per entry).
+    """
+    return (np.asarray(m_indicator) != 0).astype(INDICATOR_DTYPE)
+
+
+def save_indicator(filename, m_indicator):
+    """
+    Save a measurement matrix with 1 bit per entry (.npz file with the packed bits and the shape).
+    :param filename: path of the file (.npz is appended if missing).
+    :param m_indicator: a 0/1 array.
+    :return: the path of the saved file.
+    """
+    if not filename.endswith('.npz'):
+        filename += '.npz'
+    m_indicator = np.asarray(m_indicator)
+    np.savez(filename, bits=np.packbits(m_indicator != 0, axis=None), shape=np.array(m_indicator.shape))
+    return filename
+
+
+def load_indicator(filename, dtype=INDICATOR_DTYPE):
+    """
+    Load a measurement matrix saved by save_indicator (or a legacy .npy file).
+    :param filename:
+    :param dtype: dtype of the returned array (e.g. bool, or float32 for the model inputs).
+    :return:
+    """
+    if filename.endswith('.npy'):
+        return np.load(filename).astype(dtype, copy=False)
+
+    with np.load(filename) as f:
+        bits, shape = f['bits'], tuple(int(d) for d in f['shape'])
+    return np.unpackbits(bits)[:int(np.prod(shape))].reshape(shape).astype(dtype, copy=False)
+
+
+def find_indicator(filename):
+    """
+    Path of a saved measurement matrix: the packed .npz file, or the legacy .npy file of the same name.
+    :param filename: path without extension.
+    :return: the path, or None if neither exists.
+    """
+    for ext in ['.npz', '.npy']:
+        if os.path.isfile(filename + ext):
+            return filename + ext
+    return None
@@ -0,0 +1,45 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+from lib import indicator
+
+
+class IndicatorTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_save_load(self):
+        m_indicator = np.random.choice([1.0, 0.0], size=(101, 13), p=(0.3, 0.7))
+        filename = indicator.save_indicator(os.path.join(self.tmp_dir, 'm_indicator0'), m_indicator)
+        self.assertTrue(filename.endswith('.npz'))
+
+        loaded = indicator.load_indicator(filename)
+        self.assertEqual(np.uint8, loaded.dtype)
+        np.testing.assert_array_equal(m_indicator, loaded)
+        np.testing.assert_array_equal(m_indicator, indicator.load_indicator(filename, dtype='float32'))
+        self.assertLess(os.path.getsize(filename), m_indicator.size)
+
+    def test_find_legacy(self):
+        m_indicator = np.random.choice([1.0, 0.0], size=(20, 4))
+        filename = os.path.join(self.tmp_dir, 'm_indicator0')
+        self.assertIsNone(indicator.find_indicator(filename))
+        np.save(filename, m_indicator)
+        self.assertEqual(filename + '.npy', indicator.find_indicator(filename))
+        np.testing.assert_array_equal(m_indicator, indicator.load_indicator(indicator.find_indicator(filename)))
+
+    def test_arithmetic(self):
+        sampling = indicator.to_indicator(np.array([1.0, 0.0, 1.0]))
+        pred = np.array([1.5, 2.5, 3.5], dtype=np.float32)
+        ground_true = np.array([1.0, 2.0, 3.0], dtype=np.float32)
+        np.testing.assert_allclose([1.0, 2.5, 3.0], pred * (1.0 - sampling) + ground_true * sampling)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,7 +1,13 @@
+import hashlib
+import json
 import logging
 import os
 import pickle
+import shutil
 import sys
+import threading
+import weakref
+from queue import Queue, Full
 
 import numpy as np
 import pandas as pd
@@ -13,6 +19,9 @@ from scipy.sparse import linalg
 from sklearn.preprocessing import MinMaxScaler
 from tqdm import tqdm
 
+from lib.indicator import to_indicator, save_indicator, load_indicator
+from lib.windowing import sliding_windows, windowed_correlation, sample_measurements, RollingRatioTracker
+
 
 class DataLoader(object):
     def __init__(self, xs, ys, batch_size, pad_with_last_sample=True, shuffle=False):
@@ -108,6 +117,154 @@ class DataLoader_dcrnn_fwbw(object):
         return _wrapper()
 
 
+class WindowDataLoader(object):
+    def __init__(self, data, m_indicator, seq_len, horizon, batch_size, input_dim=2, labels=None,
+                 pad_with_last_sample=True, shuffle=False, mon_ratio=None, eps=None):
+        """
+        Same as DataLoader, but only keeps the 2-D series and cuts the (seq_len, nodes, input_dim) windows
+        of each batch on demand.
+
+        :param data: shape(#time-steps, #nodes): encoder input series.
+        :param m_indicator: shape(#time-steps, #nodes) or None (the indicator channel is then left as zeros).
+        :param seq_len:
+        :param horizon:
+        :param batch_size:
+        :param input_dim:
+        :param labels: shape(#time-steps, #nodes): series of the labels (default: data).
+        :param pad_with_last_sample: pad with the last sample to make number of samples divisible to batch_size.
+        :param shuffle:
+        :param mon_ratio: on-the-fly masking: data is the clean series and a new monitoring mask (and noisy fill)
+        is drawn for every batch with this ratio, or with a ratio drawn from a (low, high) range for every sample.
+        m_indicator is then ignored.
+        :param eps: half-width of the noise of the unmeasured values (default: data.std()).
+        """
+
+        self.data = data
+        self.m_indicator = m_indicator
+        self.labels = data if labels is None else labels
+        self.mon_ratio = mon_ratio
+        self.eps = data.std() if mon_ratio is not None and eps is None else eps
+        self.seq_len = seq_len
+        self.horizon = horizon
+        self.input_dim = input_dim
+
+        self.batch_size = batch_size
+        self.current_ind = 0
+
+        # Only the start index of each sample is stored; padding and shuffling only touch this array.
+        indices = self._sample_indices()
+        if pad_with_last_sample:
+            num_padding = (batch_size - (len(indices) % batch_size)) % batch_size
+            indices = np.concatenate([indices, np.repeat(indices[-1:], num_padding)])
+        self.size = len(indices)
+        self.num_batch = int(self.size // self.batch_size)
+        if shuffle:
+            indices = indices[np.random.permutation(self.size)]
+        self.indices = indices
+
+    def _sample_indices(self):
+        return np.arange(self.data.shape[0] - self.seq_len - self.horizon)
+
+    def _windows(self, series, start_ind, length):
+        # shape(#batch, #length, #nodes)
+        return series[start_ind[:, None] + np.arange(length)]
+
+    def _get_batch(self, start_ind):
+        x = np.zeros(shape=(len(start_ind), self.seq_len, self.data.shape[1], self.input_dim), dtype='float32')
+        if self.mon_ratio is not None:
+            x[..., 0], x[..., 1] = sample_measurements(self._windows(self.data, start_ind, self.seq_len),
+                                                       self.mon_ratio, self.eps)
+        else:
+            x[..., 0] = self._windows(self.data, start_ind, self.seq_len)
+            if self.m_indicator is not None:
+                x[..., 1] = self._windows(self.m_indicator, start_ind, self.seq_len)
+
+        y = np.expand_dims(self._windows(self.labels, start_ind + self.seq_len, self.horizon), axis=3)
+        return x, y.astype('float32')
+
+    def get_iterator(self):
+        self.current_ind = 0
+
+        def _wrapper():
+            while self.current_ind < self.num_batch:
+                start_ind = self.batch_size * self.current_ind
+                end_ind = min(self.size, self.batch_size * (self.current_ind + 1))
+                yield self._get_batch(self.indices[start_ind: end_ind])
+                self.current_ind += 1
+
+        return _wrapper()
+
+
+class WindowDataLoader_dcrnn_fwbw(WindowDataLoader):
+    """
+    Same as DataLoader_dcrnn_fwbw, but cuts the windows on demand from the 2-D series.
+    Yields (inputs, dec_labels_fw, enc_labels_bw).
+    """
+
+    def _sample_indices(self):
+        # Samples start from #horizon, as in create_data_dcrnn_fwbw (whose first #horizon samples are zeros).
+        return np.arange(self.horizon, self.data.shape[0] - self.seq_len - self.horizon)
+
+    def _get_batch(self, start_ind):
+        inputs, dec_labels_fw = super(WindowDataLoader_dcrnn_fwbw, self)._get_batch(start_ind)
+        enc_labels_bw = np.expand_dims(self._windows(self.labels, start_ind - 1, self.seq_len), axis=3)
+        return inputs, dec_labels_fw, enc_labels_bw.astype('float32')
+
+
+def prefetch_iterator(iterator, buffer_size):
+    """
+    Prepare the next #buffer_size batches of the iterator on a background thread, so that the batch preparation
+    overlaps with the current training step. Works with the iterator of every DataLoader.
+    :param iterator:
+    :param buffer_size: number of prefetched batches (<= 0: no prefetching).
+    :return:
+    """
+    if buffer_size is None or buffer_size <= 0:
+        return iterator
+
+    queue = Queue(maxsize=buffer_size)
+    stop_event = threading.Event()
+    end_of_data = object()
+
+    def _put(item):
+        while not stop_event.is_set():
+            try:
+                queue.put(item, timeout=0.1)
+                return True
+            except Full:
+                continue
+        return False
+
+    def _producer():
+        try:
+            for item in iterator:
+                if not _put((item, None)):
+                    return
+        except Exception as e:
+            _put((None, e))
+            return
+        _put((end_of_data, None))
+
+    thread = threading.Thread(target=_producer, name='prefetch_iterator')
+    thread.daemon = True
+    thread.start()
+
+    def _wrapper():
+        try:
+            while True:
+                item, error = queue.get()
+                if error is not None:
+                    raise error
+                if item is end_of_data:
+                    break
+                yield item
+        finally:
+            # Release the producer if the consumer stops early.
+            stop_event.set()
+
+    return _wrapper()
+
+
 class StandardScaler:
     """
     Standard the input
@@ -199,6 +356,86 @@ def calculate_scaled_laplacian(adj_mx, lambda_max=2, undirected=True):
     return L.astype(np.float32)
 
 
+# Supports (scipy) of each (adjacency, filter type), shared by all the cells of the process.
+_supports_cache = {}
+# Sparse tensors of the supports, per graph.
+_sparse_supports_cache = weakref.WeakKeyDictionary()
+
+
+def _supports_key(adj_mx, filter_type):
+    adj_mx = np.ascontiguousarray(adj_mx)
+    return filter_type, adj_mx.shape, adj_mx.dtype.str, hashlib.sha1(adj_mx.tobytes()).hexdigest()
+
+
+def calculate_supports(adj_mx, filter_type):
+    """
+    Diffusion supports of the graph convolution, computed once per adjacency content and filter type.
+    :param adj_mx:
+    :param filter_type: "laplacian", "random_walk", "dual_random_walk".
+    :return: a list of scipy sparse matrices.
+    """
+    key = _supports_key(adj_mx, filter_type)
+    if key not in _supports_cache:
+        supports = []
+        if filter_type == "laplacian":
+            supports.append(calculate_scaled_laplacian(adj_mx, lambda_max=None))
+        elif filter_type == "random_walk":
+            supports.append(calculate_random_walk_matrix(adj_mx).T)
+        elif filter_type == "dual_random_walk":
+            supports.append(calculate_random_walk_matrix(adj_mx).T)
+            supports.append(calculate_random_walk_matrix(adj_mx.T).T)
+        else:
+            supports.append(calculate_scaled_laplacian(adj_mx))
+        _supports_cache[key] = supports
+    return _supports_cache[key]
+
+
+def build_sparse_matrix(L):
+    L = L.tocoo()
+    indices = np.column_stack((L.row, L.col))
+    L = tf.SparseTensor(indices, L.data, L.shape)
+    return tf.sparse_reorder(L)
+
+
+def support_density(support):
+    """
+    :param support: scipy sparse matrix
+    :return: the fraction of non-zero entries.
+    """
+    return support.nnz / float(support.shape[0] * support.shape[1])
+
+
+def build_supports(adj_mx, filter_type, dense_threshold=None):
+    """
+    Tensors of the supports. All the cells (and model copies) of the default graph share the same constants.
+    :param dense_threshold: the supports whose density is >= dense_threshold are dense tensors (dense matmul is faster
+    than the sparse one for dense-ish graphs); None: always sparse.
+    :return: a list of tf.SparseTensor / tf.Tensor.
+    """
+    graph = tf.get_default_graph()
+    graph_cache = _sparse_supports_cache.setdefault(graph, {})
+    key = _supports_key(adj_mx, filter_type) + (dense_threshold,)
+    if key not in graph_cache:
+        supports = []
+        # The constants are created outside of the current scopes so that they can be reused by any model copy.
+        with graph.as_default(), tf.name_scope(None):
+            for support in calculate_supports(adj_mx, filter_type):
+                if dense_threshold is not None and support_density(support) >= dense_threshold:
+                    supports.append(tf.constant(support.toarray(), dtype=tf.float32))
+                else:
+                    supports.append(build_sparse_matrix(support))
+        graph_cache[key] = supports
+    return list(graph_cache[key])
+
+
+def build_sparse_supports(adj_mx, filter_type):
+    """
+    Sparse tensors of the supports, shared by all the cells of the default graph.
+    :return: a list of tf.SparseTensor.
+    """
+    return build_supports(adj_mx, filter_type, dense_threshold=None)
+
+
 def adj_to_bias(adj, sizes, nhood=1):
     nb_graphs = adj.shape[0]
     mt = np.empty(adj.shape)
@@ -213,6 +450,62 @@ def adj_to_bias(adj, sizes, nhood=1):
     return -1e9 * (1.0 - mt)
 
 
+def adj_to_edges(adj_mx):
+    """
+    Edge list of the attention graph: the pairs (i, j) with (adj_mx + I)[i, j] > 0, i.e. the entries that
+    adj_to_bias(nhood=1) does not mask.
+    :param adj_mx: (num_nodes, num_nodes)
+    :return: (rows, cols) int32 arrays, sorted by row.
+    """
+    adj_mx = np.asarray(adj_mx)
+    rows, cols = np.nonzero(adj_mx + np.eye(adj_mx.shape[0], dtype=adj_mx.dtype) > 0.0)
+    return rows.astype(np.int32), cols.astype(np.int32)
+
+
+def support_edges(adj_mx, filter_type, edges):
+    """
+    The supports restricted to the attention edges: an attention-weighted support is zero outside of them.
+    :param edges: (rows, cols) of the attention edges, see adj_to_edges.
+    :return: for each support, (idx, rows, cols, values): the indices of the attention edges on which the support is
+    non-zero, their rows and cols, and the support's values on them, shape(#edges, 1).
+    """
+    rows, cols = edges
+    supports = []
+    for support in calculate_supports(adj_mx, filter_type):
+        values = np.asarray(support.tocsr()[rows, cols], dtype=np.float32).ravel()
+        idx = np.nonzero(values)[0].astype(np.int32)
+        supports.append((idx, rows[idx], cols[idx], np.expand_dims(values[idx], 1)))
+    return supports
+
+
+def edge_softmax(logits, rows, num_nodes):
+    """
+    Softmax of the edge logits over the edges of each row (the sparse counterpart of a softmax over the last axis of
+    the masked (num_nodes, num_nodes) logits).
+    :param logits: (num_edges, ...) tensor.
+    :param rows: (num_edges,) row of each edge.
+    :param num_nodes:
+    :return: (num_edges, ...) tensor.
+    """
+    logits = logits - tf.gather(tf.unsorted_segment_max(logits, rows, num_nodes), rows)
+    exp_logits = tf.exp(logits)
+    return exp_logits / tf.gather(tf.unsorted_segment_sum(exp_logits, rows, num_nodes), rows)
+
+
+def edge_matmul(values, rows, cols, x, num_nodes):
+    """
+    Batched product of sparse matrices sharing the same edges with a node-major tensor:
+    out[i, b] = sum over the edges e of row i of values[e, b] * x[cols[e], b].
+    :param values: (num_edges, batch_size) values of the edges.
+    :param rows: (num_edges,)
+    :param cols: (num_edges,)
+    :param x: (num_nodes, batch_size, dim)
+    :param num_nodes:
+    :return: (num_nodes, batch_size, dim)
+    """
+    return tf.unsorted_segment_sum(tf.expand_dims(values, -1) * tf.gather(x, cols), rows, num_nodes)
+
+
 def config_logging(log_dir, log_filename='info.log', level=logging.INFO):
     # Add file handler and stdout handler
     formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
@@ -262,6 +555,25 @@ def get_total_trainable_parameter_size():
     return total_parameters
 
 
+def rnn_encoder(cells, inputs, encoder_type='static'):
+    """
+    Run the encoder over the input sequence.
+    Both types create the same variables (scope 'rnn'), so the checkpoints are interchangeable.
+    :param cells: the (multi-layer) rnn cell.
+    :param inputs: a list of #seq_len tensors of shape (batch_size, input_size).
+    :param encoder_type: 'static' (unrolled graph, static_rnn) or 'dynamic' (tf.while_loop, dynamic_rnn): the graph
+    size does not depend on seq_len.
+    :return: outputs: a list of #seq_len tensors of shape (batch_size, output_size), the final state.
+    """
+    if encoder_type == 'static':
+        return tf.contrib.rnn.static_rnn(cells, inputs, dtype=tf.float32)
+    elif encoder_type == 'dynamic':
+        outputs, state = tf.nn.dynamic_rnn(cells, tf.stack(inputs, axis=1), dtype=tf.float32)
+        return tf.unstack(outputs, axis=1), state
+    else:
+        raise ValueError('Unknown encoder type: {}'.format(encoder_type))
+
+
 def prepare_train_valid_test_2d(data, day_size):
     n_timeslots = data.shape[0]
     n_days = n_timeslots / day_size
@@ -278,37 +590,33 @@ def prepare_train_valid_test_2d(data, day_size):
 
 
 def create_data_dcrnn(data, label, seq_len, horizon, input_dim):
-    x = np.zeros(shape=(data.shape[0] - seq_len - horizon, seq_len, data.shape[1], input_dim), dtype='float32')
-    y = np.zeros(shape=(data.shape[0] - seq_len - horizon, horizon, data.shape[1], 1), dtype='float32')
-
-    for idx in range(data.shape[0] - seq_len - horizon):
-        _x = data[idx: idx + seq_len]
-        # _label = label[idx: idx + seq_len]
-
-        x[idx, :, :, 0] = _x
-        # x[idx, :, :, 1] = _label
+    n_samples = data.shape[0] - seq_len - horizon
+    x = np.zeros(shape=(n_samples, seq_len, data.shape[1], input_dim), dtype='float32')
+    y = np.zeros(shape=(n_samples, horizon, data.shape[1], 1), dtype='float32')
 
-        _y = data[idx + seq_len:idx + seq_len + horizon]
+    x[..., 0] = sliding_windows(data, seq_len, n_windows=n_samples)
+    # x[..., 1] = sliding_windows(label, seq_len, n_windows=n_samples)
 
-        y[idx] = np.expand_dims(_y, axis=2)
+    y[..., 0] = sliding_windows(data[seq_len:], horizon, n_windows=n_samples)
 
     return x, y
 
 
 def create_data_gatlstm(data, num_nodes, input_dim, day_size):
-    x = np.zeros(shape=(data.shape[0] - day_size * (input_dim), num_nodes, input_dim), dtype='float32')
-    y = np.zeros(shape=(data.shape[0] - day_size * (input_dim), num_nodes, 1), dtype='float32')
-
-    i = 0
-    for time_slot in tqdm(range(data.shape[0] - day_size * (input_dim))):
-        x[i, :, :-1] = data[time_slot: time_slot + (input_dim - 1) * day_size: day_size].T
+    n_samples = data.shape[0] - day_size * (input_dim)
+    x = np.zeros(shape=(n_samples, num_nodes, input_dim), dtype='float32')
+    y = np.zeros(shape=(n_samples, num_nodes, 1), dtype='float32')
 
-        x[i, :, -1] = np.random.uniform(data[time_slot + (input_dim - 1) * day_size] - data.std(),
-                                        data[time_slot + (input_dim - 1) * day_size] + data.std())
+    # Day-lagged windows: x[i, :, k] = data[i + k * day_size]
+    x[:, :, :-1] = sliding_windows(data, input_dim - 1, step=day_size, n_windows=n_samples).transpose((0, 2, 1))
+    y[:, :, 0] = data[(input_dim - 1) * day_size:(input_dim - 1) * day_size + n_samples]
 
-        y[i, :, 0] = data[time_slot + (input_dim - 1) * day_size]
+    # Noisy last channel: data[i + (input_dim - 1) * day_size] +/- data.std(), drawn in a single call (same random
+    # stream as drawing the samples one by one)
+    std = data.std()
+    last = data[(input_dim - 1) * day_size:(input_dim - 1) * day_size + n_samples]
+    x[:, :, -1] = np.random.uniform(last - std, last + std)
 
-        i += 1
     return x, y
 
 
@@ -320,33 +628,25 @@ def create_data_dcrnn_weighted(data, seq_len, horizon, input_dim, mon_ratio, eps
 
     _data[_labels == 0.0] = np.random.uniform(_data[_labels == 0.0] - eps, _data[_labels == 0.0] + eps)
 
-    x = np.zeros(shape=(_data.shape[0] - seq_len - seq_len - horizon, seq_len, _data.shape[1], input_dim),
-                 dtype='float32')
-    y = np.zeros(shape=(_data.shape[0] - seq_len - seq_len - horizon, horizon, _data.shape[1], 1), dtype='float32')
+    n_samples = _data.shape[0] - seq_len - seq_len - horizon
+    x = np.zeros(shape=(n_samples, seq_len, _data.shape[1], input_dim), dtype='float32')
+    y = np.zeros(shape=(n_samples, horizon, _data.shape[1], 1), dtype='float32')
 
-    for idx in range(_data.shape[0] - seq_len - seq_len - horizon):
-        _x = _data[idx + seq_len: idx + seq_len + seq_len]
-        _label = _labels[idx + seq_len: idx + seq_len + seq_len]
+    # _mr[j]: measurement ratio of each flow over _labels[j:j + seq_len] (same tracker as the test loop)
+    tracker = RollingRatioTracker(_labels.shape[0], _labels.shape[1])
+    tracker.extend(_labels)
+    _mr = tracker.ratios(np.arange(seq_len, _labels.shape[0] + 1), seq_len)
 
-        _w = np.zeros(shape=(seq_len, _data.shape[1], 1))
-        for i in range(seq_len):
-            _mr = _labels[(idx + i):(idx + seq_len + i)].sum(axis=0) / seq_len
-            _w[i] = np.expand_dims(_mr, axis=1)
+    x[..., 0] = sliding_windows(_data[seq_len:], seq_len, n_windows=n_samples)
+    x[..., 1] = sliding_windows(_labels[seq_len:], seq_len, n_windows=n_samples)
+    x[..., 2] = sliding_windows(_mr, seq_len, n_windows=n_samples)
 
-        # x[idx] = np.stack([_x, _label, _w], axis=2)
-
-        _x = np.expand_dims(_x, axis=2)
-        _label = np.expand_dims(_label, axis=2)
-        x[idx] = np.concatenate([_x, _label, _w], axis=2)
-
-        _y = data[idx + seq_len + seq_len:idx + seq_len + seq_len + horizon]
-
-        y[idx] = np.expand_dims(_y, axis=2)
+    y[..., 0] = sliding_windows(data[seq_len + seq_len:], horizon, n_windows=n_samples)
 
     return x, y
 
 
-def create_data_dcrnn_fwbw(data, seq_len, horizon, input_dim, mon_ratio, eps):
+def create_data_dcrnn_fwbw(data, seq_len, horizon, input_dim, mon_ratio, eps, seed=None):
     """
 
     :param data:
@@ -355,83 +655,62 @@ def create_data_dcrnn_fwbw(data, seq_len, horizon, input_dim, mon_ratio, eps):
     :param input_dim:
     :param mon_ratio:
     :param eps:
+    :param seed: seed of the measurement mask (see create_sampled_data).
     :return:
     """
-    _tf = np.array([1.0, 0.0])
-    _m_indicators = np.random.choice(_tf, size=data.shape, p=(mon_ratio, 1.0 - mon_ratio))
-    _m_indicators = _m_indicators.astype('float32')
-    _data = np.copy(data)
-
-    _data[_m_indicators == 0.0] = np.random.uniform(_data[_m_indicators == 0.0] - eps,
-                                                    _data[_m_indicators == 0.0] + eps)
-
-    inputs = np.zeros(shape=(data.shape[0] - seq_len - horizon, seq_len, data.shape[1], input_dim), dtype='float32')
-    dec_labels_fw = np.zeros(shape=(data.shape[0] - seq_len - horizon, horizon, data.shape[1], 1), dtype='float32')
-    enc_labels_bw = np.zeros(shape=(data.shape[0] - seq_len - horizon, seq_len, data.shape[1], 1), dtype='float32')
+    _data, _m_indicators = create_sampled_data(data, mon_ratio, eps, seed=seed)
 
-    for idx in range(horizon, _data.shape[0] - seq_len - horizon, 1):
-        _input = _data[idx: idx + seq_len]
-        _m = _m_indicators[idx: idx + seq_len]
+    n_samples = data.shape[0] - seq_len - horizon
+    inputs = np.zeros(shape=(n_samples, seq_len, data.shape[1], input_dim), dtype='float32')
+    dec_labels_fw = np.zeros(shape=(n_samples, horizon, data.shape[1], 1), dtype='float32')
+    enc_labels_bw = np.zeros(shape=(n_samples, seq_len, data.shape[1], 1), dtype='float32')
 
-        inputs[idx, :, :, 0] = _input
-        inputs[idx, :, :, 1] = _m
+    # The first #horizon samples are left as zeros.
+    n_windows = n_samples - horizon
+    inputs[horizon:, :, :, 0] = sliding_windows(_data[horizon:], seq_len, n_windows=n_windows)
+    inputs[horizon:, :, :, 1] = sliding_windows(_m_indicators[horizon:], seq_len, n_windows=n_windows)
 
-        _dec_labels_fw = data[idx + seq_len:idx + seq_len + horizon]
-        dec_labels_fw[idx] = np.expand_dims(_dec_labels_fw, axis=2)
+    dec_labels_fw[horizon:, :, :, 0] = sliding_windows(data[horizon + seq_len:], horizon, n_windows=n_windows)
 
-        _enc_labels_bw = data[idx - 1:idx + seq_len - 1]
-        enc_labels_bw[idx] = np.expand_dims(_enc_labels_bw, axis=2)
+    enc_labels_bw[horizon:, :, :, 0] = sliding_windows(data[horizon - 1:], seq_len, n_windows=n_windows)
 
     # return inputs, dec_labels_fw, enc_labels_bw
     return inputs, dec_labels_fw, enc_labels_bw
 
 
 def correlation_matrix(data, seq_len):
-    corr_matrices = np.zeros(shape=(data.shape[0] - seq_len, data.shape[1], data.shape[1]), dtype='float32')
+    # Mean of the correlation matrices of the valid sliding windows.
+    return windowed_correlation(data, seq_len, n_windows=data.shape[0] - seq_len).astype('float32')
 
-    for i in tqdm(range(data.shape[0] - seq_len)):
-        data_corr = data[i:i + seq_len]
-        df = pd.DataFrame(data_corr, index=range(data_corr.shape[0]),
-                          columns=['{}'.format(x + 1) for x in range(data_corr.shape[1])])
 
-        corr_mx = df.corr().values
-        corr_matrices[i] = corr_mx
-
-    nan_idx = []
-    for i in range(corr_matrices.shape[0]):
-        if not np.any(np.isnan(corr_matrices[i])) and not np.any(np.isinf(corr_matrices[i])):
-            nan_idx.append(i)
-
-    corr_matrices = corr_matrices[nan_idx]
-    corr_matrix = np.mean(corr_matrices, axis=0)
+def _same_key_matrix(keys, sparse=False):
+    """
+    Adjacency matrix of the flows sharing (at least) one of the keys, built from the flow/key incidence matrices.
+    :param keys: list of arrays of shape(#nflows), e.g. [flow_index['d'].values]
+    :param sparse: return a scipy.sparse.csr_matrix instead of a dense array.
+    :return: shape(#nflows, #nflows), adj[i, j] = 1.0 if keys[k][i] == keys[k][j] for some k.
+    """
+    nflow = keys[0].shape[0]
+    adj_matrix = sp.csr_matrix((nflow, nflow), dtype='float64')
+    for key in keys:
+        codes, uniques = pd.factorize(key)
+        incidence = sp.csr_matrix((np.ones(nflow), (np.arange(nflow), codes)), shape=(nflow, uniques.shape[0]))
+        adj_matrix = adj_matrix + incidence.dot(incidence.T)
+    adj_matrix.data[:] = 1.0
 
-    return corr_matrix
+    if sparse:
+        return adj_matrix
+    return adj_matrix.toarray()
 
 
-def od_flow_matrix(flow_index_file='./Dataset/demands.csv'):
+def od_flow_matrix(flow_index_file='./Dataset/demands.csv', sparse=False):
     flow_index = pd.read_csv(flow_index_file)
-    nflow = flow_index['index'].size
-    adj_matrix = np.zeros(shape=(nflow, nflow))
+    return _same_key_matrix([flow_index['d'].values], sparse=sparse)
 
-    for i in range(nflow):
-        for j in range(nflow):
-            if flow_index.iloc[i].d == flow_index.iloc[j].d:
-                adj_matrix[i, j] = 1.0
 
-    return adj_matrix
-
-
-def sd_flow_matrix(flow_index_file='./Dataset/demands.csv'):
+def sd_flow_matrix(flow_index_file='./Dataset/demands.csv', sparse=False):
     flow_index = pd.read_csv(flow_index_file)
-    nflow = flow_index['index'].size
-    adj_matrix = np.zeros(shape=(nflow, nflow))
-
-    for i in range(nflow):
-        for j in range(nflow):
-            if (flow_index.iloc[i].d == flow_index.iloc[j].d) or (flow_index.iloc[i].o == flow_index.iloc[j].o):
-                adj_matrix[i, j] = 1.0
-
-    return adj_matrix
+    return _same_key_matrix([flow_index['d'].values, flow_index['o'].values], sparse=sparse)
 
 
 def ppa_representation(data, seq_len):
@@ -623,44 +902,116 @@ def load_dataset_dcrnn_att(seq_len, horizon, input_dim, mon_ratio,
     return data
 
 
-def create_sampled_data(data, mon_ratio):
+def create_sampled_data(data, mon_ratio, eps=None, seed=None):
+    """
+    :param seed: draw the mask and the noise from a RandomState(seed) instead of the global generator (e.g. to keep
+    the same validation mask across runs and epochs).
+    """
+    if eps is None:
+        eps = data.std()
+    rng = np.random if seed is None else np.random.RandomState(seed)
     _tf = np.array([1.0, 0.0])
-    label = np.random.choice(_tf, size=data.shape, p=(mon_ratio, 1.0 - mon_ratio))
+    label = rng.choice(_tf, size=data.shape, p=(mon_ratio, 1.0 - mon_ratio))
     label = label.astype('float32')
     sampled_data = np.copy(data)
 
-    sampled_data[label == 0.0] = np.random.uniform(sampled_data[label == 0.0] - data.std(),
-                                                   sampled_data[label == 0.0] + data.std())
+    sampled_data[label == 0.0] = rng.uniform(sampled_data[label == 0.0] - eps,
+                                             sampled_data[label == 0.0] + eps)
 
     return sampled_data, label
 
 
-def _prepare_training_data(dataset_dir, data_name, day_size, scaler_type, mon_ratio):
-    if os.path.isfile(os.path.join(dataset_dir, data_name + '/train_set_{}.npy'.format(mon_ratio))):
-        print('|--- Load data set')
-        train_set = np.load(os.path.join(dataset_dir, data_name + '/train_set_{}.npy'.format(mon_ratio)))
-        train_label = np.load(os.path.join(dataset_dir, data_name + '/train_label_{}.npy'.format(mon_ratio)))
-        valid_set = np.load(os.path.join(dataset_dir, data_name + '/valid_set_{}.npy'.format(mon_ratio)))
-        valid_label = np.load(os.path.join(dataset_dir, data_name + '/valid_label_{}.npy'.format(mon_ratio)))
-        test_set = np.load(os.path.join(dataset_dir, data_name + '/test_set_{}.npy'.format(mon_ratio)))
-        scaler = pickle.load(open(os.path.join(dataset_dir, data_name + '/scaler_{}'.format(mon_ratio)), 'rb'))
-        return train_set, train_label, valid_set, valid_label, test_set, scaler
-    else:
-        print('|--- Prepare data set')
-        train_data_norm, valid_data_norm, test_set, scaler = \
-            normalizing_data(dataset_dir, data_name, day_size, scaler_type)
+# Bump when the preparation changes so that the old prepared copies are not reused.
+_PREPARED_DATA_VERSION = 2
+_PREPARED_DATA_FILES = ['train_set', 'train_label', 'valid_set', 'valid_label', 'test_set']
+# Measurement matrices, stored with 1 bit per entry (lib.indicator).
+_PREPARED_INDICATOR_FILES = ['train_label', 'valid_label']
+
+
+def _prepared_data_dir(dataset_dir, data_name, day_size, scaler_type, mon_ratio, seed=None):
+    """
+    Directory of the prepared data, addressed by the hash of all the preparation parameters (and of the raw data file).
+    :return: the directory, the parameters
+    """
+    raw_file = os.path.join(dataset_dir, '{}/{}.npy'.format(data_name, data_name))
+    raw_stat = os.stat(raw_file)
+    params = {
+        'version': _PREPARED_DATA_VERSION,
+        'data_name': data_name,
+        'day_size': day_size,
+        'scaler_type': scaler_type,
+        'mon_ratio': mon_ratio,
+        'seed': seed,
+        'raw_file': {'size': raw_stat.st_size, 'mtime': int(raw_stat.st_mtime)}
+    }
+    key = hashlib.sha1(json.dumps(params, sort_keys=True).encode('utf-8')).hexdigest()[:16]
+    return os.path.join(dataset_dir, data_name, 'prepared', key), params
+
+
+def _load_prepared_data(prepared_dir, names):
+    # Copy-on-write maps: the arrays are writable like freshly prepared ones, the prepared files are never modified.
+    arrays = [load_indicator(os.path.join(prepared_dir, name + '.npz')) if name in _PREPARED_INDICATOR_FILES
+              else np.load(os.path.join(prepared_dir, name + '.npy'), mmap_mode='c') for name in names]
+    with open(os.path.join(prepared_dir, 'scaler.pkl'), 'rb') as f:
+        scaler = pickle.load(f)
+    return arrays, scaler
+
+
+def _prepare_training_data(dataset_dir, data_name, day_size, scaler_type, mon_ratio, seed=None):
+    """
+    Normalized and sampled data sets, prepared once per parameters and always returned memory-mapped (copy-on-write)
+    from the prepared copy (the measurement matrices are bit-packed on disk and loaded as uint8).
+    :return: train_set, train_label, valid_set, valid_label, test_set, scaler
+    """
+    prepared_dir, params = _prepared_data_dir(dataset_dir, data_name, day_size, scaler_type, mon_ratio, seed)
+    if os.path.isfile(os.path.join(prepared_dir, 'manifest.json')):
+        print('|--- Load data set: {}'.format(prepared_dir))
+        arrays, scaler = _load_prepared_data(prepared_dir, _PREPARED_DATA_FILES)
+        return tuple(arrays) + (scaler,)
+
+    print('|--- Prepare data set: {}'.format(prepared_dir))
+    train_data_norm, valid_data_norm, test_set, scaler = \
+        normalizing_data(dataset_dir, data_name, day_size, scaler_type)
+
+    train_set, train_label = create_sampled_data(train_data_norm, mon_ratio)
+    valid_set, valid_label = create_sampled_data(valid_data_norm, mon_ratio)
+    train_label, valid_label = to_indicator(train_label), to_indicator(valid_label)
+
+    # Written in a temporary directory first: the prepared copy only appears once it is complete.
+    tmp_dir = prepared_dir + '.tmp{}'.format(os.getpid())
+    os.makedirs(tmp_dir)
+    arrays = [train_set, train_label, valid_set, valid_label, test_set]
+    for name, array in zip(_PREPARED_DATA_FILES, arrays):
+        if name in _PREPARED_INDICATOR_FILES:
+            save_indicator(os.path.join(tmp_dir, name), array)
+        else:
+            np.save(os.path.join(tmp_dir, name), array)
+    with open(os.path.join(tmp_dir, 'scaler.pkl'), 'wb') as f:
+        pickle.dump(scaler, f)
+    manifest = dict(params, files={name: {'shape': list(array.shape), 'dtype': array.dtype.str}
+                                   for name, array in zip(_PREPARED_DATA_FILES, arrays)})
+    with open(os.path.join(tmp_dir, 'manifest.json'), 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    try:
+        os.rename(tmp_dir, prepared_dir)
+    except OSError:
+        # Prepared by another process in the meantime: its copy is used.
+        shutil.rmtree(tmp_dir, ignore_errors=True)
 
-        train_set, train_label = create_sampled_data(train_data_norm, mon_ratio)
-        valid_set, valid_label = create_sampled_data(valid_data_norm, mon_ratio)
+    # Loaded back so that the first run gets the same kind of arrays as the next ones.
+    arrays, scaler = _load_prepared_data(prepared_dir, _PREPARED_DATA_FILES)
+    return tuple(arrays) + (scaler,)
 
-        np.save(os.path.join(dataset_dir, data_name + '/train_set_{}'.format(mon_ratio)), train_set)
-        np.save(os.path.join(dataset_dir, data_name + '/train_label_{}'.format(mon_ratio)), train_label)
-        np.save(os.path.join(dataset_dir, data_name + '/valid_set_{}'.format(mon_ratio)), valid_set)
-        np.save(os.path.join(dataset_dir, data_name + '/valid_label_{}'.format(mon_ratio)), valid_label)
-        np.save(os.path.join(dataset_dir, data_name + '/test_set_{}'.format(mon_ratio)), test_set)
-        pickle.dump(scaler, open(os.path.join(dataset_dir, data_name + '/scaler_{}'.format(mon_ratio)), 'wb'))
 
-        return train_set, train_label, valid_set, valid_label, test_set, scaler
+def _load_test_data(dataset_dir, data_name, day_size, scaler_type, mon_ratio, seed=None):
+    """
+    :return: test_set (memory-mapped, copy-on-write), scaler
+    """
+    prepared_dir, _ = _prepared_data_dir(dataset_dir, data_name, day_size, scaler_type, mon_ratio, seed)
+    if not os.path.isfile(os.path.join(prepared_dir, 'manifest.json')):
+        _prepare_training_data(dataset_dir, data_name, day_size, scaler_type, mon_ratio, seed)
+    (test_set,), scaler = _load_prepared_data(prepared_dir, ['test_set'])
+    return test_set, scaler
 
 
 def load_dataset_dcrnn(seq_len, horizon, input_dim, mon_ratio, batch_size, scaler_type='SD', is_training=False,
@@ -669,12 +1020,42 @@ def load_dataset_dcrnn(seq_len, horizon, input_dim, mon_ratio, batch_size, scale
     dataset_dir = kwargs.get('data_dir')
     data_size = kwargs.get('data_size')
     day_size = kwargs.get('day_size')
+    lazy_loader = kwargs.get('lazy_loader', False)
+    online_masking = kwargs.get('online_masking', False)
     data = {}
 
-    if is_training:
+    if is_training and online_masking:
+        # The training masks are drawn for every batch from the clean series (no sampled data set on disk).
+        train_data_norm, valid_data_norm, _, scaler = normalizing_data(dataset_dir, data_name, day_size, scaler_type)
+        _mon_ratio = kwargs.get('mon_ratio_range') or mon_ratio
+        eps = train_data_norm.std()
+
+        data['scaler'] = scaler
 
+        data['train_loader'] = WindowDataLoader(train_data_norm, None, seq_len, horizon, batch_size,
+                                                input_dim=input_dim, shuffle=True, mon_ratio=_mon_ratio, eps=eps)
+        # The validation mask is drawn once, with a fixed seed, so that the validation loss only changes with the model.
+        valid_set, valid_label = create_sampled_data(valid_data_norm, mon_ratio, eps=eps,
+                                                     seed=kwargs.get('seed') or 0)
+        data['val_loader'] = WindowDataLoader(valid_set, valid_label, seq_len, horizon, batch_size,
+                                              input_dim=input_dim, labels=valid_data_norm, shuffle=False)
+
+    elif is_training and lazy_loader:
         train_set, train_label, valid_set, valid_label, test_set, scaler = \
-            _prepare_training_data(dataset_dir, data_name, day_size, scaler_type, mon_ratio)
+            _prepare_training_data(dataset_dir, data_name, day_size, scaler_type, mon_ratio, kwargs.get('seed'))
+
+        data['scaler'] = scaler
+
+        # The indicator channel is left as zeros, as in create_data_dcrnn.
+        data['train_loader'] = WindowDataLoader(train_set, None, seq_len, horizon, batch_size,
+                                                input_dim=input_dim, shuffle=True)
+        data['val_loader'] = WindowDataLoader(valid_set, None, seq_len, horizon, batch_size,
+                                              input_dim=input_dim, shuffle=False)
+
+    elif is_training:
+
+        train_set, train_label, valid_set, valid_label, test_set, scaler = \
+            _prepare_training_data(dataset_dir, data_name, day_size, scaler_type, mon_ratio, kwargs.get('seed'))
 
         x_train, y_train = create_data_dcrnn(data=train_set, label=train_label,
                                              seq_len=seq_len, horizon=horizon, input_dim=input_dim)
@@ -695,8 +1076,7 @@ def load_dataset_dcrnn(seq_len, horizon, input_dim, mon_ratio, batch_size, scale
         data['val_loader'] = DataLoader(data['x_val'], data['y_val'], batch_size, shuffle=False)
 
     else:
-        test_set = np.load(os.path.join(dataset_dir, data_name + '/test_set_{}.npy'.format(mon_ratio)))
-        scaler = pickle.load(open(os.path.join(dataset_dir, data_name + '/scaler_{}'.format(mon_ratio)), 'rb'))
+        test_set, scaler = _load_test_data(dataset_dir, data_name, day_size, scaler_type, mon_ratio, kwargs.get('seed'))
 
         data['test_set'] = test_set
         data['scaler'] = scaler
@@ -816,6 +1196,20 @@ def load_dataset_dcrnn_weighted(seq_len, horizon, input_dim, mon_ratio,
     return data
 
 
+def _add_eval_data_dcrnn_fwbw(data, test_data_norm, seq_len, horizon, input_dim, mon_ratio, eps, eval_batch_size,
+                              seed=None):
+    """
+    Materialise the eval set (small, and read as arrays by the supervisor's evaluate()) and its ordered loader.
+    """
+    data['inputs_eval'], data['dec_labels_fw_eval'], data['enc_labels_bw_eval'] = create_data_dcrnn_fwbw(
+        data=test_data_norm, seq_len=seq_len, horizon=horizon, input_dim=input_dim, mon_ratio=mon_ratio, eps=eps,
+        seed=seed)
+    data['eval_loader'] = DataLoader_dcrnn_fwbw(data['inputs_eval'],
+                                                data['dec_labels_fw_eval'],
+                                                data['enc_labels_bw_eval'],
+                                                eval_batch_size, shuffle=False)
+
+
 def load_dataset_dcrnn_fwbw(seq_len, horizon, input_dim, mon_ratio,
                             dataset_dir, data_size, day_size, batch_size, eval_batch_size,
                             pos_thres, neg_thres, val_batch_size, adj_method='CORR1', scaler_type='SD',
@@ -829,7 +1223,32 @@ def load_dataset_dcrnn_fwbw(seq_len, horizon, input_dim, mon_ratio,
     # x(num_sample, seq_len, num_node, input_dim): encoder input
     # y(num_sample, horizon, num_node, output_dim): decoder output
     # l(num_sample, seq_len, num_node, output_dim): encoder output
-    if is_training:
+    if is_training and kwargs.get('online_masking', False):
+        # The training masks are drawn for every batch from the clean series (no sampled data set). The val/eval
+        # masks are drawn once, with a fixed seed, so that the validation loss only changes with the model.
+        eps = train_data_norm.std()
+        mask_seed = kwargs.get('seed') or 0
+        data['train_loader'] = WindowDataLoader_dcrnn_fwbw(train_data_norm, None, seq_len, horizon, batch_size,
+                                                           input_dim=input_dim, shuffle=True,
+                                                           mon_ratio=kwargs.get('mon_ratio_range') or mon_ratio,
+                                                           eps=eps)
+        valid_set, valid_label = create_sampled_data(valid_data_norm, mon_ratio, eps=eps, seed=mask_seed)
+        data['val_loader'] = WindowDataLoader_dcrnn_fwbw(valid_set, valid_label, seq_len, horizon, val_batch_size,
+                                                         input_dim=input_dim, labels=valid_data_norm, shuffle=False)
+        _add_eval_data_dcrnn_fwbw(data, test_data_norm, seq_len, horizon, input_dim, mon_ratio, eps=eps,
+                                  eval_batch_size=eval_batch_size, seed=mask_seed)
+
+    elif is_training and kwargs.get('lazy_loader', False):
+        for category, _data_norm, _batch_size, _shuffle in [('train', train_data_norm, batch_size, True),
+                                                             ('val', valid_data_norm, val_batch_size, False)]:
+            _data, _m_indicators = create_sampled_data(_data_norm, mon_ratio, eps=train_data_norm.std())
+            data[category + '_loader'] = WindowDataLoader_dcrnn_fwbw(_data, _m_indicators, seq_len, horizon,
+                                                                     _batch_size, input_dim=input_dim,
+                                                                     labels=_data_norm, shuffle=_shuffle)
+        _add_eval_data_dcrnn_fwbw(data, test_data_norm, seq_len, horizon, input_dim, mon_ratio,
+                                  eps=train_data_norm.std(), eval_batch_size=eval_batch_size)
+
+    elif is_training:
         inputs_train, dec_labels_fw_train, enc_labels_bw_train = create_data_dcrnn_fwbw(
             data=train_data_norm,
             seq_len=seq_len,
@@ -1041,20 +1460,16 @@ def load_dataset_fwbw_lstm_ed(seq_len, horizon, input_dim, mon_ratio,
 
 
 def create_data_lstm(data, label, seq_len, input_dim):
-    data_x = np.zeros(shape=((data.shape[0] - seq_len) * data.shape[1], seq_len, input_dim), dtype='float32')
-    data_y = np.zeros(shape=((data.shape[0] - seq_len) * data.shape[1], 1), dtype='float32')
-    i = 0
-    for flow in range(data.shape[1]):
-        for idx in range(data.shape[0] - seq_len):
-            _x = data[idx: idx + seq_len, flow]
-            _label = label[idx: idx + seq_len, flow]
+    n_windows = data.shape[0] - seq_len
+    data_x = np.zeros(shape=(n_windows * data.shape[1], seq_len, input_dim), dtype='float32')
+    data_y = np.zeros(shape=(n_windows * data.shape[1], 1), dtype='float32')
 
-            data_x[i, :, 0] = _x
-            data_x[i, :, 1] = _label
+    # Samples are ordered flow by flow: i = flow * n_windows + idx
+    _data_x = data_x.reshape((data.shape[1], n_windows, seq_len, input_dim))
+    _data_x[..., 0] = sliding_windows(data, seq_len, n_windows=n_windows).transpose((2, 0, 1))
+    _data_x[..., 1] = sliding_windows(label, seq_len, n_windows=n_windows).transpose((2, 0, 1))
 
-            data_y[i] = data[idx + seq_len, flow]
-
-            i += 1
+    data_y[:, 0] = data[seq_len:].T.reshape(-1)
 
     return data_x, data_y
 
@@ -1069,7 +1484,7 @@ def load_dataset_lstm(seq_len, horizon, input_dim, mon_ratio,
 
     if is_training:
         train_set, train_label, valid_set, valid_label, test_set, scaler = \
-            _prepare_training_data(dataset_dir, data_name, day_size, scaler_type, mon_ratio)
+            _prepare_training_data(dataset_dir, data_name, day_size, scaler_type, mon_ratio, kwargs.get('seed'))
 
         x_train, y_train = create_data_lstm(data=train_set, label=train_label,
                                             seq_len=seq_len, input_dim=input_dim)
@@ -1088,8 +1503,7 @@ def load_dataset_lstm(seq_len, horizon, input_dim, mon_ratio,
         data['val_loader'] = DataLoader(data['x_val'], data['y_val'], batch_size, shuffle=False)
 
     else:
-        test_set = np.load(os.path.join(dataset_dir, data_name + '/test_set_{}.npy'.format(mon_ratio)))
-        scaler = pickle.load(open(os.path.join(dataset_dir, data_name + '/scaler_{}'.format(mon_ratio)), 'rb'))
+        test_set, scaler = _load_test_data(dataset_dir, data_name, day_size, scaler_type, mon_ratio, kwargs.get('seed'))
 
         data['test_set'] = test_set
 
@@ -1168,27 +1582,18 @@ def load_dataset_lstm_ed(seq_len, horizon, input_dim, mon_ratio,
 def create_data_conv_lstm(data, seq_len, wide, high, channel, mon_ratio, eps):
     _tf = np.array([1.0, 0.0])
     _labels = np.random.choice(_tf, size=data.shape, p=(mon_ratio, 1 - mon_ratio))
-    data_x = np.zeros(shape=((data.shape[0] - seq_len), seq_len, wide, high, channel), dtype='float32')
-    data_y = np.zeros(shape=((data.shape[0] - seq_len), wide * high), dtype='float32')
+    n_samples = data.shape[0] - seq_len
+    data_x = np.zeros(shape=(n_samples, seq_len, wide, high, channel), dtype='float32')
+    data_y = np.zeros(shape=(n_samples, wide * high), dtype='float32')
 
     _data = np.copy(data)
 
     _data[_labels == 0.0] = np.random.uniform(_data[_labels == 0.0] - eps, _data[_labels == 0.0] + eps)
 
-    i = 0
-    for idx in range(_data.shape[0] - seq_len):
-        _x = _data[idx: idx + seq_len]
-        _label = _labels[idx: idx + seq_len]
-
-        _x = np.reshape(_x, newshape=(seq_len, wide, high))
-        _label = np.reshape(_label, newshape=(seq_len, wide, high))
-
-        data_x[i, ..., 0] = _x
-        data_x[i, ..., 1] = _label
-
-        data_y[i] = data[idx + seq_len]
+    data_x[..., 0] = sliding_windows(_data.reshape((-1, wide, high)), seq_len, n_windows=n_samples)
+    data_x[..., 1] = sliding_windows(_labels.reshape((-1, wide, high)), seq_len, n_windows=n_samples)
 
-        i += 1
+    data_y[:] = data[seq_len:]
 
     return data_x, data_y
 
@@ -0,0 +1,50 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+import pandas as pd
+
+from lib import utils
+
+
+def _flow_matrix_loop(flow_index, sd=False):
+    # Reference: the per-pair loops of od_flow_matrix/sd_flow_matrix.
+    nflow = flow_index['index'].size
+    adj_matrix = np.zeros(shape=(nflow, nflow))
+    for i in range(nflow):
+        for j in range(nflow):
+            if (flow_index.iloc[i].d == flow_index.iloc[j].d) or \
+                    (sd and flow_index.iloc[i].o == flow_index.iloc[j].o):
+                adj_matrix[i, j] = 1.0
+    return adj_matrix
+
+
+class FlowMatrixTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        np.random.seed(0)
+        nflow = 30
+        self.flow_index = pd.DataFrame({'index': np.arange(nflow),
+                                        'o': np.random.randint(0, 6, size=nflow),
+                                        'd': np.random.randint(0, 6, size=nflow)})
+        self.flow_index_file = os.path.join(self.tmp_dir, 'demands.csv')
+        self.flow_index.to_csv(self.flow_index_file, index=False)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_od_flow_matrix(self):
+        expected = _flow_matrix_loop(self.flow_index)
+        np.testing.assert_array_equal(expected, utils.od_flow_matrix(self.flow_index_file))
+        np.testing.assert_array_equal(expected, utils.od_flow_matrix(self.flow_index_file, sparse=True).toarray())
+
+    def test_sd_flow_matrix(self):
+        expected = _flow_matrix_loop(self.flow_index, sd=True)
+        np.testing.assert_array_equal(expected, utils.sd_flow_matrix(self.flow_index_file))
+        np.testing.assert_array_equal(expected, utils.sd_flow_matrix(self.flow_index_file, sparse=True).toarray())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,179 @@
+import numpy as np
+from numpy.lib.stride_tricks import as_strided
+
+
+def sliding_windows(data, window, step=1, n_windows=None, copy=False):
+    """
+    Create the sliding windows over the first axis of data by using strided views (no data is copied).
+    :param data: shape(#time-steps, ...)
+    :param window: number of time-steps in each window.
+    :param step: distance between two consecutive time-steps of a window (e.g. day_size for day-lagged windows).
+    :param n_windows: number of windows to return (default: all the complete windows).
+    :param copy: return a contiguous (writable) copy instead of a read-only view.
+    :return: shape(#n_windows, #window, ...)
+    """
+    data = np.asarray(data)
+    max_windows = data.shape[0] - (window - 1) * step
+    if n_windows is None:
+        n_windows = max_windows
+    if n_windows < 0 or n_windows > max_windows:
+        raise ValueError('Cannot create {} windows of size {} (step {}) from {} time-steps!'.format(
+            n_windows, window, step, data.shape[0]))
+
+    windows = as_strided(data,
+                         shape=(n_windows, window) + data.shape[1:],
+                         strides=(data.strides[0], data.strides[0] * step) + data.strides[1:],
+                         writeable=False)
+    if copy:
+        windows = np.array(windows)
+    return windows
+
+
+def rolling_sum(data, window):
+    """
+    Sum of every window of consecutive time-steps, computed from the cumulative sum.
+    :param data: shape(#time-steps, ...)
+    :param window:
+    :return: shape(#time-steps - window + 1, ...): out[i] = data[i:i + window].sum(axis=0)
+    """
+    data = np.asarray(data)
+    cumsum = np.zeros(shape=(data.shape[0] + 1,) + data.shape[1:], dtype='float64')
+    np.cumsum(data, axis=0, out=cumsum[1:])
+    return cumsum[window:] - cumsum[:-window]
+
+
+def rolling_mean(data, window):
+    """
+    Mean of every window of consecutive time-steps (e.g. the measurement ratio of each flow).
+    :param data: shape(#time-steps, ...)
+    :param window:
+    :return: shape(#time-steps - window + 1, ...)
+    """
+    return rolling_sum(data, window) / window
+
+
+class RollingRatioTracker(object):
+    """
+    Prefix sums of a measurement matrix which is filled one row at a time: the measurement ratio of each flow over
+    any window of the rows already added costs O(#nflows) (rolling_mean of a growing matrix).
+    """
+
+    def __init__(self, n_rows, n_flows):
+        """
+
+        :param n_rows: maximum number of rows of the matrix.
+        :param n_flows:
+        """
+        self.prefix = np.zeros(shape=(n_rows + 1, n_flows), dtype='float64')
+        self.n_rows = 0
+
+    def append(self, row):
+        """
+        :param row: the next row of the measurement matrix, shape(#nflows)
+        """
+        self.prefix[self.n_rows + 1] = self.prefix[self.n_rows] + row
+        self.n_rows += 1
+
+    def extend(self, rows):
+        """
+        :param rows: the next rows of the measurement matrix, shape(#rows, #nflows)
+        """
+        n = rows.shape[0]
+        np.cumsum(rows, axis=0, out=self.prefix[self.n_rows + 1:self.n_rows + n + 1])
+        self.prefix[self.n_rows + 1:self.n_rows + n + 1] += self.prefix[self.n_rows]
+        self.n_rows += n
+
+    def ratios(self, ends, length):
+        """
+        Measurement ratio of each flow over the windows of #length rows ending (exclusive) at ends, i.e.
+        m_indicator[end - length:end].mean(axis=0) for each end.
+        :param ends: array of the ends of the windows (<= number of rows already added).
+        :param length: number of rows of the windows (> 0).
+        :return: shape(#ends, #nflows)
+        """
+        ends = np.asarray(ends)
+        return (self.prefix[ends] - self.prefix[ends - length]) / length
+
+
+def sample_measurements(data, mon_ratio, eps):
+    """
+    Draw the monitoring mask of a batch of clean windows and fill the unmeasured values with uniform noise
+    (same sampling as lib.utils.create_sampled_data, but a new realisation for every call).
+    :param data: shape(#batch, ...): clean (normalized) windows.
+    :param mon_ratio: the monitoring ratio, or a (low, high) range from which a ratio is drawn for each window.
+    :param eps: half-width of the uniform noise around the true value of the unmeasured flows.
+    :return: sampled data, measurement indicator (float32, same shape as data).
+    """
+    data = np.asarray(data)
+    if np.ndim(mon_ratio) == 0:
+        ratio = mon_ratio
+    else:
+        low, high = mon_ratio
+        ratio = np.random.uniform(low, high, size=(data.shape[0],) + (1,) * (data.ndim - 1))
+    m_indicator = (np.random.rand(*data.shape) < ratio).astype('float32')
+    noise = np.random.uniform(-eps, eps, size=data.shape)
+    sampled_data = np.where(m_indicator == 1.0, data, data + noise).astype(data.dtype)
+    return sampled_data, m_indicator
+
+
+def windowed_correlation(data, window, n_windows=None, fill_invalid=None, max_block_elements=2 ** 22):
+    """
+    Mean (over the sliding windows) of the Pearson correlation matrix of the flows, i.e.
+    np.mean([pd.DataFrame(data[i:i + window]).corr().values for i in range(n_windows)], axis=0)
+    without storing the per-window matrices (O(#nflows^2) memory).
+    With d_w = 1 / std_w and s_w the sum of window w, the sum of the correlation matrices is
+    sum_w sum_(t in w) (x_t * d_w)(x_t * d_w)^T - sum_w (s_w * d_w)(s_w * d_w)^T / window,
+    which is computed by matrix products over blocks of windows.
+
+    :param data: shape(#time-steps, #nflows)
+    :param window: number of time-steps in each window.
+    :param n_windows: number of windows (default: all the complete windows).
+    :param fill_invalid: value of the undefined correlations (flow which is constant in the window). If None, the
+    windows having undefined correlations are dropped.
+    :param max_block_elements: memory budget of a block of windows.
+    :return: shape(#nflows, #nflows)
+    """
+    data = np.asarray(data, dtype='float64')
+    nflows = data.shape[1]
+    if n_windows is None:
+        n_windows = data.shape[0] - window + 1
+    # Centering does not change the correlation but reduces the cancellation in cov = sxy - s * s / window.
+    x = data[:n_windows + window - 1] - data[:n_windows + window - 1].mean(axis=0)
+
+    s = rolling_sum(x, window)[:n_windows]
+    var = np.maximum(rolling_sum(x ** 2, window)[:n_windows] - s ** 2 / window, 0)
+    windows = sliding_windows(x, window, n_windows=n_windows)
+
+    corr_sum = np.zeros(shape=(nflows, nflows), dtype='float64')
+    n_valid_pairs = np.zeros(shape=(nflows, nflows), dtype='float64')
+    count = 0
+
+    block_size = max(1, int(max_block_elements / (window * nflows)))
+    for start in range(0, n_windows, block_size):
+        end = min(start + block_size, n_windows)
+        # Flows which are constant in a window have an undefined correlation.
+        valid = (np.ptp(windows[start:end], axis=1) != 0) & (var[start:end] > 0)
+        if fill_invalid is None:
+            keep = np.all(valid, axis=1)
+            if not np.any(keep):
+                continue
+            block_idx = np.arange(start, end)[keep]
+            valid = valid[keep]
+        else:
+            block_idx = np.arange(start, end)
+
+        d = np.zeros(shape=valid.shape, dtype='float64')
+        d[valid] = 1.0 / np.sqrt(var[block_idx][valid])
+
+        y = (windows[block_idx] * d[:, None, :]).reshape((-1, nflows))
+        z = s[block_idx] * d
+        corr_sum += np.dot(y.T, y) - np.dot(z.T, z) / window
+        if fill_invalid is not None:
+            n_valid_pairs += np.dot(valid.T.astype('float64'), valid.astype('float64'))
+        count += block_idx.shape[0]
+
+    if fill_invalid is not None:
+        corr_sum += fill_invalid * (count - n_valid_pairs)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.clip(corr_sum / count, -1.0, 1.0)
@@ -0,0 +1,108 @@
+import unittest
+
+import numpy as np
+
+from lib import windowing
+
+
+class WindowingTestCase(unittest.TestCase):
+    def test_sliding_windows(self):
+        data = np.arange(20, dtype=np.float32).reshape((10, 2))
+        windows = windowing.sliding_windows(data, 3)
+        self.assertEqual((8, 3, 2), windows.shape)
+        for i in range(8):
+            np.testing.assert_array_equal(data[i:i + 3], windows[i])
+
+    def test_sliding_windows_is_view(self):
+        data = np.arange(20, dtype=np.float32).reshape((10, 2))
+        windows = windowing.sliding_windows(data, 3, n_windows=4)
+        self.assertEqual((4, 3, 2), windows.shape)
+        self.assertFalse(windows.flags.writeable)
+        data[2, 0] = -1.
+        self.assertEqual(-1., windows[1, 1, 0])
+
+    def test_sliding_windows_copy(self):
+        data = np.arange(20, dtype=np.float32).reshape((10, 2))
+        windows = windowing.sliding_windows(data, 3, copy=True)
+        self.assertTrue(windows.flags.writeable)
+        data[2, 0] = -1.
+        self.assertEqual(4., windows[1, 1, 0])
+
+    def test_sliding_windows_step(self):
+        data = np.arange(12, dtype=np.float32)
+        windows = windowing.sliding_windows(data, 3, step=4)
+        np.testing.assert_array_equal(np.array([
+            [0, 4, 8],
+            [1, 5, 9],
+            [2, 6, 10],
+            [3, 7, 11],
+        ], dtype=np.float32), windows)
+
+    def test_sliding_windows_too_many(self):
+        data = np.zeros(shape=(5, 2))
+        with self.assertRaises(ValueError):
+            windowing.sliding_windows(data, 3, n_windows=4)
+
+    def test_rolling_mean(self):
+        labels = np.random.choice([1.0, 0.0], size=(30, 4))
+        mr = windowing.rolling_mean(labels, 6)
+        self.assertEqual((25, 4), mr.shape)
+        for i in range(25):
+            np.testing.assert_allclose(labels[i:i + 6].sum(axis=0) / 6, mr[i])
+
+    def test_windowed_correlation(self):
+        data = np.random.rand(60, 5)
+        corr = windowing.windowed_correlation(data, 8, n_windows=50, max_block_elements=100)
+        expected = np.mean([np.corrcoef(data[i:i + 8].T) for i in range(50)], axis=0)
+        np.testing.assert_allclose(expected, corr, rtol=1e-6, atol=1e-9)
+
+    def test_windowed_correlation_constant_flow(self):
+        data = np.random.rand(40, 3)
+        data[10:25, 1] = 2.
+        corrs = []
+        for i in range(40 - 8 + 1):
+            with np.errstate(divide='ignore', invalid='ignore'):
+                corrs.append(np.corrcoef(data[i:i + 8].T))
+        corrs = np.array(corrs)
+
+        dropped = windowing.windowed_correlation(data, 8)
+        valid = np.all(np.isfinite(corrs), axis=(1, 2))
+        np.testing.assert_allclose(np.mean(corrs[valid], axis=0), dropped, rtol=1e-6, atol=1e-9)
+
+        filled = windowing.windowed_correlation(data, 8, fill_invalid=0)
+        corrs[~np.isfinite(corrs)] = 0
+        np.testing.assert_allclose(np.mean(corrs, axis=0), filled, rtol=1e-6, atol=1e-9)
+
+    def test_rolling_ratio_tracker(self):
+        labels = np.random.choice([1.0, 0.0], size=(40, 5))
+        tracker = windowing.RollingRatioTracker(40, 5)
+        tracker.extend(labels[:10])
+        for row in labels[10:]:
+            tracker.append(row)
+        np.testing.assert_allclose(windowing.rolling_mean(labels, 6), tracker.ratios(np.arange(6, 41), 6))
+        for end, length in [(3, 3), (17, 4), (40, 40)]:
+            np.testing.assert_allclose(labels[end - length:end].mean(axis=0), tracker.ratios([end], length)[0])
+
+    def test_sample_measurements(self):
+        np.random.seed(0)
+        data = np.random.rand(64, 12, 30).astype(np.float32)
+        sampled_data, m_indicator = windowing.sample_measurements(data, 0.3, eps=0.5)
+        self.assertEqual(data.shape, m_indicator.shape)
+        self.assertEqual(np.float32, sampled_data.dtype)
+        self.assertAlmostEqual(0.3, m_indicator.mean(), places=1)
+        measured = m_indicator == 1.0
+        np.testing.assert_array_equal(data[measured], sampled_data[measured])
+        self.assertTrue(np.all(np.abs(sampled_data - data)[~measured] <= 0.5))
+        self.assertTrue(np.any(sampled_data[~measured] != data[~measured]))
+
+    def test_sample_measurements_ratio_range(self):
+        np.random.seed(0)
+        data = np.zeros((500, 12, 30), dtype=np.float32)
+        _, m_indicator = windowing.sample_measurements(data, (0.1, 0.9), eps=1.0)
+        ratios = m_indicator.reshape((500, -1)).mean(axis=1)
+        self.assertTrue(np.all(ratios > 0.0) and np.all(ratios < 1.0))
+        self.assertGreater(ratios.std(), 0.1)
+
+
+if __name__ == '__main__':
+    unittest.main()
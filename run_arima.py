@@ -18,6 +18,8 @@ def print_arima_info():
     print('|--- GPU:\t{}'.format(Config.GPU))
 
     print('|--- MON_RATIO:\t{}'.format(Config.ARIMA_MON_RATIO))
+    print('|--- REFRESH_STEP:\t{}'.format(getattr(Config, 'ARIMA_REFRESH_STEP', 0)))
+    print('|--- NPROC:\t{}'.format(getattr(Config, 'ARIMA_NPROC', None)))
     print('            -----------            ')
 
     if Config.ARIMA_IMS: